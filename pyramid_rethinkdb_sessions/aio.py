@@ -0,0 +1,325 @@
+"""
+ # Copyright (c) 2017 Boolein Integer Indonesia, PT.
+ # suryakencana 1/8/17 @author nanang.suryadi@boolein.id
+ #
+ # You are hereby granted a non-exclusive, worldwide, royalty-free license to
+ # use, copy, modify, and distribute this software in source code or binary
+ # form for use in connection with the web services and APIs provided by
+ # Boolein.
+ #
+ # As with any software that integrates with the Boolein platform, your use
+ # of this software is subject to the Boolein Developer Principles and
+ # Policies [http://developers.Boolein.com/policy/]. This copyright notice
+ # shall be included in all copies or substantial portions of the software.
+ #
+ # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ # THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ # DEALINGS IN THE SOFTWARE
+ #
+ # aio
+"""
+# asyncio session backend, Python 3.5+ only. Sessions are stored in the same
+# document layout as ``RethinkDBSession`` so sync and async applications can
+# share a sessions table.
+import asyncio
+import binascii
+import os
+import socket
+import threading
+import time
+from collections.abc import MutableMapping
+
+import rethinkdb as r
+import rethinkdb.net
+
+from .cluster import NoHostAvailableError
+from .compat import cPickle, text_type
+from .connection import _merge_url, host_selector
+from .util import (
+    R_TABLE,
+    _generate_session_id,
+    live_session,
+    new_session_state,
+    session_document,
+    state_from_document,
+)
+
+_loop_type_lock = threading.Lock()
+_asyncio_connection_type = None
+
+
+def _get_asyncio_connection_type():
+    """
+    Load the driver's asyncio connection class. ``r.set_loop_type`` swaps
+    the connection class used by every ``r.connect`` in the process, so the
+    previous class is restored to keep sync connections working.
+    """
+    global _asyncio_connection_type
+    with _loop_type_lock:
+        if _asyncio_connection_type is None:
+            previous = rethinkdb.net.connection_type
+            try:
+                r.set_loop_type('asyncio')
+                _asyncio_connection_type = rethinkdb.net.connection_type
+            finally:
+                rethinkdb.net.connection_type = previous
+    return _asyncio_connection_type
+
+
+async def connect(url=None,
+                  host='localhost',
+                  port=28015,
+                  db=None,
+                  user='admin',
+                  password=None,
+                  timeout=20,
+                  ssl=None,
+                  io_loop=None):
+    """
+    Open an asyncio RethinkDB connection; the counterpart of
+    ``pyramid_rethinkdb_sessions.connection.connect``. Queries are run on it
+    with ``await query.run(conn)``.
+
+    A multi-host ``url`` goes through the same process-wide ``HostSelector``
+    as sync connections, failing over to the next node when one is down.
+    """
+    options = _merge_url(url, dict(host=host, port=port, db=db, user=user,
+                                   password=password))
+    hosts = options.pop('hosts', None)
+    connection_type = _get_asyncio_connection_type()
+
+    async def open_connection(host, port):
+        conn = connection_type(host, port, options['db'], None,
+                               options['user'], options['password'], timeout,
+                               ssl or dict(), 10, io_loop=io_loop)
+        return await conn.reconnect(timeout=timeout)
+
+    if hosts:
+        return await _connect_selected(host_selector(hosts), open_connection)
+    return await open_connection(options['host'], options.get('port', 28015))
+
+
+async def _connect_selected(selector, open_connection):
+    # HostSelector.connect for coroutines: the best available node first,
+    # failing over to the next one on error
+    errors = []
+    for node in selector.candidates():
+        if not selector._claim(node):
+            continue
+        started = time.time()
+        try:
+            conn = await open_connection(node.host, node.port)
+        except (r.ReqlDriverError, socket.error) as e:
+            selector.record_failure(node)
+            errors.append('%r: %s' % (node, e))
+            continue
+        except BaseException:
+            selector.release_probe(node)
+            raise
+        selector.record_success(node, time.time() - started)
+        return conn
+    if not errors:
+        raise NoHostAvailableError(
+            'All RethinkDB hosts are unavailable: %s' % selector.nodes)
+    raise NoHostAvailableError(
+        'Could not connect to any RethinkDB host: %s' % '; '.join(errors))
+
+
+class AsyncConnectionPool(object):
+    """
+    A small set of asyncio connections shared by every in-flight request.
+    The asyncio driver multiplexes concurrent queries over one socket, so
+    connections are handed out round robin rather than checked out.
+
+    Parameters:
+
+    ``connect``
+    A coroutine function taking no arguments that opens a connection.
+
+    ``size``
+    The number of connections to keep open. Default: ``2``.
+    """
+    def __init__(self, connect, size=2):
+        self.connect = connect
+        self.size = size
+        self._conns = [None] * size
+        self._locks = [asyncio.Lock() for _ in range(size)]
+        self._next = 0
+
+    async def get(self):
+        """Return an open connection, reconnecting its slot if needed."""
+        slot = self._next
+        self._next = (self._next + 1) % self.size
+        conn = self._conns[slot]
+        if conn is not None and conn.is_open():
+            return conn
+        async with self._locks[slot]:
+            conn = self._conns[slot]
+            if conn is None or not conn.is_open():
+                conn = self._conns[slot] = await self.connect()
+        return conn
+
+    async def close(self):
+        conns, self._conns = self._conns, [None] * self.size
+        for conn in conns:
+            if conn is not None:
+                await conn.close(noreply_wait=False)
+
+
+class AsyncRethinkDBSession(MutableMapping):
+    """
+    An asyncio counterpart of ``RethinkDBSession``. Load it with
+    ``await AsyncRethinkDBSession.load(conn, session_id)``, use it like a
+    dict, then ``await session.flush()`` to write any changes in one query.
+
+    Unlike the Pyramid session, mutations are not written as they happen, and
+    a new session is only inserted into RethinkDB when it is first flushed
+    with data in it.
+
+    Sessions are read from and written to the ``pyramid_sessions`` table as
+    a single payload: time-bucketed tables (``bucket_interval``) are not
+    supported, and a session stored one field per key (``field_storage``)
+    is read but written back as a single payload.
+    """
+    def __init__(self,
+                 conn,
+                 session_id,
+                 state,
+                 new,
+                 serialize=cPickle.dumps,
+                 deserialize=cPickle.loads,
+                 generator=_generate_session_id):
+        self.conn = conn
+        self.session_id = session_id
+        self.managed_dict = state['managed_dict']
+        self.created = state['created']
+        self.timeout = state['timeout']
+        self.new = new
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.generator = generator
+        self._dirty = False
+        self._stored = not new
+
+    @classmethod
+    async def load(cls,
+                   conn,
+                   session_id=None,
+                   timeout=1200,
+                   serialize=cPickle.dumps,
+                   deserialize=cPickle.loads,
+                   generator=_generate_session_id):
+        """
+        Fetch the session ``session_id`` (usually taken from a cookie), or
+        start a new one when it is ``None`` or not found.
+        """
+        persisted = None
+        if session_id is not None:
+            persisted = await live_session(session_id).run(conn)
+        if persisted is None:
+            return cls(conn, generator(), new_session_state(timeout), True,
+                       serialize, deserialize, generator)
+        return cls(conn, session_id,
+                   state_from_document(persisted, deserialize), False,
+                   serialize, deserialize, generator)
+
+    def to_r(self):
+        return self.serialize({
+            'managed_dict': self.managed_dict,
+            'created': self.created,
+            'timeout': self.timeout,
+        })
+
+    async def flush(self):
+        """
+        Write the session to RethinkDB if it changed since it was loaded.
+        Returns ``True`` when a write happened.
+        """
+        if not self._dirty:
+            return False
+        table = r.table(R_TABLE)
+        if self._stored:
+            document = session_document(self.session_id, self.timeout,
+                                        self.to_r())
+            await table.get(self.session_id).replace(document).run(self.conn)
+        else:
+            for _ in range(3):
+                document = session_document(self.session_id, self.timeout,
+                                            self.to_r())
+                result = await table.insert(
+                    document, conflict='error').run(self.conn)
+                if not result['errors']:
+                    break
+                error = result.get('first_error', '')
+                if 'Duplicate primary key' not in error:
+                    raise r.ReqlOpFailedError(error)
+                # the generated id is taken; pick another one
+                self.session_id = self.generator()
+            else:
+                raise KeyError(u'Could not insert a unique session id: %s' %
+                               result.get('first_error'))
+            self._stored = True
+        self._dirty = False
+        return True
+
+    async def invalidate(self):
+        """Delete the session and start a new, empty one in its place."""
+        if self._stored:
+            await r.table(R_TABLE).get(self.session_id).delete().run(
+                self.conn)
+        state = new_session_state(self.timeout)
+        self.session_id = self.generator()
+        self.managed_dict = state['managed_dict']
+        self.created = state['created']
+        self.new = True
+        self._dirty = False
+        self._stored = False
+
+    def changed(self):
+        """Mark the session as modified, e.g. after mutating a value."""
+        self._dirty = True
+
+    # MutableMapping provides the remaining dict methods on top of these
+    def __getitem__(self, key):
+        return self.managed_dict[key]
+
+    def __setitem__(self, key, value):
+        self.managed_dict[key] = value
+        self._dirty = True
+
+    def __delitem__(self, key):
+        del self.managed_dict[key]
+        self._dirty = True
+
+    def __iter__(self):
+        return iter(self.managed_dict)
+
+    def __len__(self):
+        return len(self.managed_dict)
+
+    def new_csrf_token(self):
+        token = text_type(binascii.hexlify(os.urandom(20)), 'ascii')
+        self['_csrft_'] = token
+        return token
+
+    def get_csrf_token(self):
+        token = self.get('_csrft_', None)
+        if token is None:
+            token = self.new_csrf_token()
+        return token
+
+    def flash(self, msg, queue='', allow_duplicate=True):
+        storage = self.setdefault('_f_' + queue, [])
+        if allow_duplicate or (msg not in storage):
+            storage.append(msg)
+            self.changed()
+
+    def peek_flash(self, queue=''):
+        return self.get('_f_' + queue, [])
+
+    def pop_flash(self, queue=''):
+        return self.pop('_f_' + queue, [])
@@ -0,0 +1,175 @@
+"""
+ # Copyright (c) 2017 Boolein Integer Indonesia, PT.
+ # suryakencana 1/8/17 @author nanang.suryadi@boolein.id
+ #
+ # You are hereby granted a non-exclusive, worldwide, royalty-free license to
+ # use, copy, modify, and distribute this software in source code or binary
+ # form for use in connection with the web services and APIs provided by
+ # Boolein.
+ #
+ # As with any software that integrates with the Boolein platform, your use
+ # of this software is subject to the Boolein Developer Principles and
+ # Policies [http://developers.Boolein.com/policy/]. This copyright notice
+ # shall be included in all copies or substantial portions of the software.
+ #
+ # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ # THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ # DEALINGS IN THE SOFTWARE
+ #
+ # buckets
+"""
+import logging
+import time
+
+from .util import R_TABLE, if_live
+
+import rethinkdb as r
+
+LOG = logging.getLogger(__name__)
+
+# key added to documents read through ``SessionBuckets.lookup``, naming the
+# table the session was found in; it is never stored
+TABLE_FIELD = 'table'
+
+
+class SessionBuckets(object):
+    """
+    Spreads sessions over one table per ``interval`` seconds of wall clock
+    time, named after the sessions table and the window's number
+    (``pyramid_sessions_412345``). A session is written to the table of the
+    window it is written in, moving out of an older table when it is
+    written to or touched, so once a window is more than ``timeout``
+    seconds past every session left in its table has expired and the whole
+    table is dropped: expiring sessions costs one ``table_drop`` per window
+    rather than a delete per row.
+
+    Requests never create tables: ``rotate`` creates them ahead of time, so
+    it has to run before the first request and then at least once per
+    ``interval`` (the reaper and ``rethinkdb_sessions_reap`` do this).
+
+    Parameters:
+
+    ``interval``
+    Seconds per table, e.g. ``3600`` for hourly tables.
+
+    ``timeout``
+    The sessions' timeout in seconds.
+
+    ``table``
+    Prefix of the table names. Default: ``pyramid_sessions``.
+
+    ``ahead``
+    Tables created ahead of the current one by ``rotate``. Default: ``1``.
+
+    ``grace``
+    Seconds of clock skew between application servers and RethinkDB
+    allowed for when deciding which tables may hold live sessions.
+    Default: ``60``.
+    """
+    def __init__(self,
+                 interval,
+                 timeout,
+                 table=R_TABLE,
+                 ahead=1,
+                 grace=60,
+                 clock=time.time):
+        if interval <= 0:
+            raise ValueError('bucket interval must be positive, not %r'
+                             % interval)
+        self.interval = interval
+        self.timeout = timeout
+        self.prefix = table + '_'
+        self.ahead = ahead
+        self.grace = grace
+        self.clock = clock
+
+    def bucket(self, when=None):
+        """Number of the window ``when`` (default: now) falls in."""
+        if when is None:
+            when = self.clock()
+        return int(when // self.interval)
+
+    def table_name(self, bucket):
+        return '%s%d' % (self.prefix, bucket)
+
+    def bucket_of(self, name):
+        """Window number of the table ``name``, or ``None`` for other tables."""
+        if not name.startswith(self.prefix):
+            return None
+        suffix = name[len(self.prefix):]
+        return int(suffix) if suffix.isdigit() else None
+
+    def current(self):
+        """Name of the table sessions are written to now."""
+        return self.table_name(self.bucket())
+
+    def candidates(self, now=None):
+        """Names of the tables that may hold live sessions, newest first."""
+        if now is None:
+            now = self.clock()
+        newest = self.bucket(now)
+        oldest = self.bucket(now - self.timeout - self.grace)
+        return [self.table_name(b) for b in range(newest, oldest - 1, -1)]
+
+    def expired(self, name, now=None):
+        """Whether every session the table ``name`` can hold has expired."""
+        bucket = self.bucket_of(name)
+        if bucket is None:
+            return False
+        if now is None:
+            now = self.clock()
+        return (bucket + 1) * self.interval + self.timeout + self.grace < now
+
+    def lookup(self, session_id, now=None):
+        """
+        ReQL query returning the live document of the session ``session_id``
+        from whichever candidate table holds it, with the table's name under
+        ``TABLE_FIELD``, or ``None``. This is a single query however many
+        tables are searched; they are all created by ``rotate``.
+        """
+        def find(name):
+            return r.table(name).get(session_id).do(
+                lambda document: r.branch(
+                    document.eq(None),
+                    None,
+                    document.merge({TABLE_FIELD: name}),
+                ))
+        return r.expr(self.candidates(now)).map(find).filter(
+            lambda document: document.ne(None)
+        ).nth(0).default(None).do(if_live)
+
+    def rotate(self, conn, now=None):
+        """
+        Create the current table and the ``ahead`` next ones, as well as any
+        older table that may still be looked up, and drop the tables whose
+        sessions have all expired. Returns the names of the tables
+        ``created`` and ``dropped``.
+        """
+        if now is None:
+            now = self.clock()
+        existing = set(r.table_list().run(conn))
+        created = []
+        dropped = []
+        current = self.bucket(now)
+        oldest = self.bucket(now - self.timeout - self.grace)
+        for bucket in range(oldest, current + self.ahead + 1):
+            name = self.table_name(bucket)
+            if name not in existing:
+                try:
+                    r.table_create(name).run(conn)
+                except r.ReqlOpFailedError:
+                    # created by another process meanwhile
+                    pass
+                else:
+                    created.append(name)
+        for name in sorted(existing):
+            if self.expired(name, now):
+                r.table_drop(name).run(conn)
+                dropped.append(name)
+        LOG.info('session buckets: created %s, dropped %s',
+                 created or 'none', dropped or 'none')
+        return {'created': created, 'dropped': dropped}
@@ -0,0 +1,417 @@
+"""
+ # Copyright (c) 2017 Boolein Integer Indonesia, PT.
+ # suryakencana 1/8/17 @author nanang.suryadi@boolein.id
+ #
+ # You are hereby granted a non-exclusive, worldwide, royalty-free license to
+ # use, copy, modify, and distribute this software in source code or binary
+ # form for use in connection with the web services and APIs provided by
+ # Boolein.
+ #
+ # As with any software that integrates with the Boolein platform, your use
+ # of this software is subject to the Boolein Developer Principles and
+ # Policies [http://developers.Boolein.com/policy/]. This copyright notice
+ # shall be included in all copies or substantial portions of the software.
+ #
+ # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ # THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ # DEALINGS IN THE SOFTWARE
+ #
+ # cache
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from .util import Counters, R_TABLE
+
+import rethinkdb as r
+
+LOG = logging.getLogger(__name__)
+
+# rough per entry overhead counted against ``max_bytes``, besides payloads
+ENTRY_OVERHEAD = 200
+
+
+def document_size(document):
+    """Approximate memory held by a cached session document, in bytes."""
+    size = ENTRY_OVERHEAD + len(document.get('id') or '')
+    if 'data' in document:
+        for key, payload in document['data'].items():
+            size += len(key) + len(payload)
+    else:
+        size += len(document.get('payload') or b'')
+    return size
+
+
+def same_session(cached, document):
+    """
+    Whether two documents of a session hold the same session data, whatever
+    their expiry times. ``document`` may be ``None`` for a deleted session.
+    """
+    if document is None:
+        return False
+    if 'data' in cached or 'data' in document:
+        return all(cached.get(key) == document.get(key)
+                   for key in ('data', 'created', 'timeout'))
+    return cached.get('payload') == document.get('payload')
+
+
+class SessionCache(object):
+    """
+    An in-process, least recently used cache of session documents, checked
+    before RethinkDB when a session is loaded and written through when a
+    session is flushed.
+
+    Documents are cached as stored, with serialized payloads, and are
+    deserialized for every request using them: requests never share the
+    objects in a session, only the bytes they were loaded from.
+
+    A session written by another process is only seen here once the entry
+    has been cached for ``ttl`` seconds, so ``ttl`` bounds how stale a
+    session can be when a user's requests hit different processes.
+
+    Parameters:
+
+    ``max_entries``
+    The most sessions held. Default: ``10000``.
+
+    ``max_bytes``
+    Upper bound on the approximate size of the cached sessions; sessions
+    bigger than this on their own are not cached. Default: ``None`` (no
+    limit).
+
+    ``ttl``
+    Seconds a cached session is used before it is read from RethinkDB
+    again. Default: ``5``.
+
+    ``shared``
+    A ``shared.SharedSessionCache`` consulted on misses, before RethinkDB,
+    and written through along with this cache. Default: ``None``.
+    """
+    def __init__(self, max_entries=10000, max_bytes=None, ttl=5.0,
+                 clock=time.time, shared=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.shared = shared
+        self.counters = Counters('hits', 'misses', 'evictions')
+        self._lock = threading.Lock()
+        # session id -> (cached at, size, document), least recently used
+        # first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        # bumped by every change; see ``put``
+        self.generation = 0
+        # session id -> generation of its last discard or write through,
+        # oldest first, for the last ``max_entries`` changed sessions
+        self._changed = collections.OrderedDict()
+        # changes older than this generation have been forgotten
+        self._forgotten = 0
+        # entries of the shared tier cached before this time are not used;
+        # see ``clear``
+        self._shared_since = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, session_id):
+        """
+        Return the cached document of ``session_id``, or ``None`` when it is
+        not cached, older than ``ttl`` or the session has expired.
+        """
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                cached_at, _, document = entry
+                expiry = document.get('expires_at')
+                if now - cached_at >= self.ttl or \
+                        (expiry is not None and expiry <= now):
+                    self._remove(session_id)
+                    entry = None
+                else:
+                    # most recently used last; no move_to_end on Python 2
+                    self._entries[session_id] = self._entries.pop(session_id)
+        if entry is None:
+            self.counters.incr('misses')
+            if self.shared is not None:
+                found = self.shared.get(session_id, self.ttl)
+                if found is not None and found[0] >= self._shared_since:
+                    cached_at, document = found
+                    # keeps its age, so the TTL holds across both tiers
+                    self._put(session_id, document, cached_at)
+                    return document
+            return None
+        self.counters.incr('hits')
+        return document
+
+    def put(self, session_id, document, generation=None):
+        """
+        Cache ``document`` as the current state of ``session_id``. Callers
+        that read ``document`` from RethinkDB pass the ``generation`` taken
+        before reading it: if the session was discarded or written through
+        meanwhile the document may already be stale, and it is not cached.
+        """
+        if self._put(session_id, document, generation=generation) and \
+                self.shared is not None:
+            self.shared.put(session_id, document)
+
+    def _put(self, session_id, document, cached_at=None, generation=None):
+        # cache locally only; returns False when skipped for ``generation``
+        size = document_size(document)
+        with self._lock:
+            if generation is not None:
+                if self._changed_since(session_id, generation):
+                    return False
+            elif cached_at is None:
+                # written through: reads begun earlier must not replace it
+                self._mark_changed(session_id)
+            self._remove(session_id)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return True
+            if cached_at is None:
+                cached_at = self.clock()
+            self._entries[session_id] = (cached_at, size, document)
+            self._bytes += size
+            evicted = 0
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and
+                    self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                evicted += 1
+        if evicted:
+            self.counters.incr('evictions', evicted)
+        return True
+
+    def load(self, session_id, fetch):
+        """
+        Return the cached document of ``session_id``, or the one returned by
+        ``fetch()``, caching it when it is not ``None``.
+        """
+        generation = self.generation
+        document = self.get(session_id)
+        if document is None:
+            document = fetch()
+            if document is not None:
+                self.put(session_id, document, generation)
+        return document
+
+    def discard(self, session_id):
+        with self._lock:
+            self._remove(session_id)
+            self._mark_changed(session_id)
+        if self.shared is not None:
+            self.shared.discard(session_id)
+
+    def changed(self, session_id, document):
+        """
+        Apply a change of ``session_id`` seen on a changefeed, ``document``
+        being its new state, or ``None`` once it was deleted. An entry that
+        already holds the same session data, such as this process's own
+        write coming back, is kept and takes the new expiry time; otherwise
+        the session is discarded. Returns ``True`` when it was discarded.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and same_session(entry[2], document):
+                cached_at, size, cached = entry
+                if 'expires_at' in document:
+                    cached = dict(cached, expires_at=document['expires_at'])
+                    self._entries[session_id] = (cached_at, size, cached)
+                return False
+            self._remove(session_id)
+            self._mark_changed(session_id)
+        if self.shared is not None:
+            found = None
+            if document is not None:
+                found = self.shared.get(session_id, self.ttl)
+            if found is None or not same_session(found[1], document):
+                self.shared.discard(session_id)
+        return True
+
+    def clear(self, shared=True):
+        """
+        Forget every cached session. With ``shared`` false the shared tier,
+        which other processes rely on, is left to its TTL: this cache only
+        stops reading the entries it holds from before now.
+        """
+        now = self.clock()
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.generation += 1
+            self._changed.clear()
+            self._forgotten = self.generation
+            self._shared_since = now
+        if shared and self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        """
+        Hit, miss and eviction counts along with the number of ``entries``
+        and their approximate size in ``bytes``.
+        """
+        stats = self.counters.snapshot()
+        with self._lock:
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
+
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _mark_changed(self, session_id):
+        # changes are tracked per session, so reads of other sessions can
+        # still be cached while sessions are written all over the fleet
+        self.generation += 1
+        self._changed.pop(session_id, None)
+        self._changed[session_id] = self.generation
+        while len(self._changed) > self.max_entries:
+            _, generation = self._changed.popitem(last=False)
+            self._forgotten = generation
+
+    def _changed_since(self, session_id, generation):
+        return self._changed.get(session_id, 0) > generation or \
+            self._forgotten > generation
+
+
+class CacheInvalidator(object):
+    """
+    Keeps the ``SessionCache`` of every process coherent by following a
+    changefeed on the sessions table in a daemon thread, evicting each
+    session written or deleted anywhere in the fleet. Sessions can then be
+    cached for long. Changes that leave a cached session's data as it is,
+    such as this process's own writes coming back, do not evict it.
+
+    Changefeeds cannot be resumed, so whenever the feed is (re)established
+    the process's own cache is cleared, and it ignores what the shared tier
+    held before then: changes made while it was down are unknown. The
+    shared tier itself is left to the other processes using it. While the
+    feed is down the cache falls back to ``fallback_ttl``.
+
+    Parameters:
+
+    ``cache``
+    The ``SessionCache`` to keep coherent; its ``ttl`` is used while the
+    feed is up.
+
+    ``connect``
+    A callable returning a new RethinkDB connection, held open by the feed,
+    such as a ``ConnectionPool``'s ``connect``.
+
+    ``table``
+    The sessions table. Default: ``pyramid_sessions``.
+
+    ``fallback_ttl``
+    The cache's TTL in seconds while the feed is down. Default: ``5``.
+
+    ``retry_interval``
+    Seconds between attempts to re-establish the feed. Default: ``1``.
+    """
+    def __init__(self,
+                 cache,
+                 connect,
+                 table=R_TABLE,
+                 fallback_ttl=5.0,
+                 retry_interval=1.0):
+        self.cache = cache
+        self.connect = connect
+        self.table = table
+        self.ttl = cache.ttl
+        self.fallback_ttl = min(fallback_ttl, cache.ttl)
+        self.retry_interval = retry_interval
+        self.counters = Counters('invalidations', 'subscriptions')
+        self.connected = False
+        cache.ttl = self.fallback_ttl
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = None
+        self._fork_hook = False
+
+    def feed(self):
+        """
+        ReQL changefeed of written and deleted sessions, as their ``id``
+        and ``new_val``, the new document or ``None``.
+        """
+        return r.table(self.table).changes(squash=True).map(
+            lambda change: {
+                'id': change['new_val']['id'].default(
+                    change['old_val']['id']),
+                'new_val': change['new_val'],
+            })
+
+    def start(self):
+        """
+        Start following the feed; in processes forked from this one it is
+        started again, as threads do not survive ``fork()``.
+        """
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='rethinkdb-sessions-cache-invalidator')
+        self._thread.daemon = True
+        self._thread.start()
+
+        register_at_fork = getattr(os, 'register_at_fork', None)
+        if register_at_fork is not None and not self._fork_hook:
+            register_at_fork(after_in_child=self._after_fork)
+            self._fork_hook = True
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        conn = self._conn
+        if conn is not None:
+            # unblocks the thread waiting on the feed
+            conn.close(noreply_wait=False)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run_once(self):
+        """
+        Subscribe and evict sessions as their changes arrive, until the feed
+        drops (raising the error) or the invalidator is stopped.
+        """
+        conn = self._conn = self.connect()
+        try:
+            cursor = self.feed().run(conn)
+            # only now is every later change sure to arrive
+            self.cache.clear(shared=False)
+            self.cache.ttl = self.ttl
+            self.connected = True
+            self.counters.incr('subscriptions')
+            for change in cursor:
+                if self.cache.changed(change['id'], change['new_val']):
+                    self.counters.incr('invalidations')
+                if self._stop.is_set():
+                    break
+        finally:
+            self.connected = False
+            self.cache.ttl = self.fallback_ttl
+            self._conn = None
+            conn.close(noreply_wait=False)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                if not self._stop.is_set():
+                    LOG.warning('session cache changefeed dropped, caching '
+                                'for %ss until it is back', self.fallback_ttl,
+                                exc_info=True)
+            self._stop.wait(self.retry_interval)
+
+    def _after_fork(self):
+        if self._thread is not None:
+            self._thread = None
+            self._conn = None
+            self.start()
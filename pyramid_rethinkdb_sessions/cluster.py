@@ -0,0 +1,183 @@
+"""
+ # Copyright (c) 2017 Boolein Integer Indonesia, PT.
+ # suryakencana 1/8/17 @author nanang.suryadi@boolein.id
+ #
+ # You are hereby granted a non-exclusive, worldwide, royalty-free license to
+ # use, copy, modify, and distribute this software in source code or binary
+ # form for use in connection with the web services and APIs provided by
+ # Boolein.
+ #
+ # As with any software that integrates with the Boolein platform, your use
+ # of this software is subject to the Boolein Developer Principles and
+ # Policies [http://developers.Boolein.com/policy/]. This copyright notice
+ # shall be included in all copies or substantial portions of the software.
+ #
+ # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ # THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ # DEALINGS IN THE SOFTWARE
+ #
+ # cluster
+"""
+import logging
+import socket
+import threading
+import time
+
+import rethinkdb as r
+
+LOG = logging.getLogger(__name__)
+
+
+class NoHostAvailableError(r.ReqlDriverError):
+    """
+    Raised when every RethinkDB node is down or has its circuit open.
+    """
+
+
+class _Node(object):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.latency = None
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+
+    def __repr__(self):
+        return '%s:%s' % (self.host, self.port)
+
+
+class HostSelector(object):
+    """
+    Chooses which node of a RethinkDB cluster to connect to.
+
+    Healthy nodes are tried nearest first, ranked by a moving average of how
+    long connecting to them took. A node that fails ``failure_threshold``
+    times in a row has its circuit opened: it is skipped for ``backoff``
+    seconds, doubling on each further failure up to ``max_backoff``. Once
+    that time has passed a single caller probes the node again. When every
+    circuit is open, ``connect`` fails immediately with
+    ``NoHostAvailableError`` instead of waiting on connect timeouts.
+
+    Parameters:
+
+    ``hosts``
+    A list of ``(host, port)`` tuples.
+
+    ``failure_threshold``
+    Consecutive failures before a node's circuit opens. Default: ``3``.
+
+    ``backoff``
+    Seconds a node is skipped after its circuit opens. Default: ``1``.
+
+    ``max_backoff``
+    Upper bound for the doubling backoff. Default: ``30``.
+
+    ``latency_decay``
+    Weight of the newest sample in the latency average. Default: ``0.3``.
+    """
+    def __init__(self,
+                 hosts,
+                 failure_threshold=3,
+                 backoff=1.0,
+                 max_backoff=30.0,
+                 latency_decay=0.3):
+        if not hosts:
+            raise ValueError('at least one RethinkDB host is required')
+        self.nodes = [_Node(host, port) for host, port in hosts]
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency_decay = latency_decay
+        self._lock = threading.Lock()
+
+    def candidates(self):
+        """
+        Return the nodes worth trying now, nearest first. Nodes never
+        connected to come first so their latency gets measured.
+        """
+        now = time.time()
+        with self._lock:
+            available = [node for node in self.nodes
+                         if node.open_until <= now]
+        return sorted(available, key=lambda node: node.latency or 0)
+
+    def connect(self, connect, **options):
+        """
+        Open a connection with ``connect(host=..., port=..., **options)`` on
+        the best available node, failing over to the next one on error.
+        """
+        errors = []
+        for node in self.candidates():
+            if not self._claim(node):
+                continue
+            started = time.time()
+            try:
+                conn = connect(host=node.host, port=node.port, **options)
+            except (r.ReqlDriverError, socket.error) as e:
+                self.record_failure(node)
+                errors.append('%r: %s' % (node, e))
+                continue
+            except Exception:
+                self.release_probe(node)
+                raise
+            self.record_success(node, time.time() - started)
+            return conn
+        if not errors:
+            raise NoHostAvailableError(
+                'All RethinkDB hosts are unavailable: %s' % self.nodes)
+        raise NoHostAvailableError(
+            'Could not connect to any RethinkDB host: %s' % '; '.join(errors))
+
+    def _claim(self, node):
+        """
+        A node whose circuit is half open (its backoff has expired) is probed
+        by one caller at a time; everyone else skips it meanwhile.
+        """
+        with self._lock:
+            if node.failures < self.failure_threshold:
+                return True
+            if node.probing:
+                return False
+            node.probing = True
+            return True
+
+    def release_probe(self, node):
+        """Let others probe ``node`` again after an attempt was abandoned."""
+        with self._lock:
+            node.probing = False
+
+    def record_success(self, node, latency):
+        with self._lock:
+            node.failures = 0
+            node.open_until = 0
+            node.probing = False
+            if node.latency is None:
+                node.latency = latency
+            else:
+                node.latency += self.latency_decay * (latency - node.latency)
+
+    def record_failure(self, node):
+        with self._lock:
+            node.failures += 1
+            node.probing = False
+            if node.failures >= self.failure_threshold:
+                delay = min(self.max_backoff, self.backoff *
+                            2 ** (node.failures - self.failure_threshold))
+                node.open_until = time.time() + delay
+                LOG.warning('RethinkDB host %r failed %s times, skipping it '
+                            'for %.1f seconds', node, node.failures, delay)
+
+    def stats(self):
+        """Return per-node latency, failure count and circuit state."""
+        now = time.time()
+        with self._lock:
+            return dict(('%r' % node, {
+                'latency': node.latency,
+                'failures': node.failures,
+                'open': node.open_until > now,
+            }) for node in self.nodes)
@@ -22,41 +22,161 @@
  # 
  # connection
 """
+import functools
+import logging
+import os
+import threading
 
-from .util import parse_url, R_DB, R_TABLE
+from .cluster import HostSelector
+from .pool import ConnectionPool
+from .util import parse_url
 import rethinkdb as r
-import logging
 
 LOG = logging.getLogger(__name__)
 
+# one HostSelector per list of hosts, so every connection to a cluster shares
+# its circuit breakers and latency averages
+_selectors = {}
+_selectors_lock = threading.Lock()
 
-def get_default_connection(request,
-                           url=None,
-                           **rethink_options):
 
-    conn = getattr(request.registry, '_r_conn', None)
+def host_selector(hosts, **options):
+    """
+    Return the process-wide ``HostSelector`` for ``hosts``, creating it with
+    ``options`` on first use.
+    """
+    key = tuple((host, port) for host, port in hosts)
+    with _selectors_lock:
+        selector = _selectors.get(key)
+        if selector is None:
+            selector = _selectors[key] = HostSelector(key, **options)
+    return selector
 
-    if conn is not None:
-        return conn
 
+def connect(url=None, **rethink_options):
+    """
+    Open a new RethinkDB connection. When ``url`` is given, its host, port,
+    db and credentials take precedence over ``rethink_options``.
+
+    The database and table are not created here; run ``provision`` (or the
+    ``rethinkdb_sessions_provision`` script) once per deployment instead.
+
+    With several ``hosts`` the connection goes through the process-wide
+    ``HostSelector`` for them, shared with the connection pool.
+    """
+    rethink_options = _merge_url(url, rethink_options)
+    hosts = rethink_options.pop('hosts', None)
+
+    LOG.debug(rethink_options)
+    if hosts:
+        return host_selector(hosts).connect(r.connect, **rethink_options)
+    return r.connect(**rethink_options)
+
+
+def _merge_url(url, rethink_options):
     if url is not None:
         rethink_options.pop('password', None)
         rethink_options.pop('user', None)
         rethink_options.pop('host', None)
+        rethink_options.pop('hosts', None)
         rethink_options.pop('port', None)
         rethink_options.pop('db', None)
 
         rethink_options.update(parse_url(url))
 
-    LOG.debug(rethink_options)
-    conn = r.connect(**rethink_options)
+    return rethink_options
 
-    if rethink_options.get('db', R_DB) not in r.db_list().run(conn):
-        r.db_create(R_DB).run(conn)
 
-    if R_TABLE not in r.table_list().run(conn):
-        r.table_create(R_TABLE).run(conn)
+def get_default_connection(request,
+                           url=None,
+                           **rethink_options):
+
+    conn = getattr(request.registry, '_r_conn', None)
+
+    # a connection opened before fork() shares its socket with the parent
+    # process, so each process opens its own
+    if conn is not None and \
+            getattr(request.registry, '_r_conn_pid', None) == os.getpid():
+        return conn
+
+    conn = connect(url=url, **rethink_options)
 
     setattr(request.registry, '_r_conn', conn)
+    setattr(request.registry, '_r_conn_pid', os.getpid())
 
     return conn
+
+
+def get_default_connection_pool(url=None,
+                                hosts=None,
+                                max_size=10,
+                                wait_timeout=None,
+                                max_lifetime=None,
+                                idle_check=30,
+                                failure_threshold=3,
+                                backoff=1.0,
+                                max_backoff=30.0,
+                                **rethink_options):
+    """
+    Build a ``ConnectionPool`` whose connections are opened with ``connect``
+    using ``url`` and ``rethink_options``.
+
+    When ``hosts`` (or a multi-host ``url``) names several cluster nodes,
+    connections go through a ``HostSelector`` configured with
+    ``failure_threshold``, ``backoff`` and ``max_backoff``, so the pool
+    connects to the nearest healthy node and fails over when one is down.
+    """
+    rethink_options['hosts'] = hosts
+    rethink_options = _merge_url(url, rethink_options)
+    hosts = rethink_options.pop('hosts', None)
+
+    open_connection = functools.partial(connect, **rethink_options)
+    if hosts:
+        selector = host_selector(hosts,
+                                 failure_threshold=failure_threshold,
+                                 backoff=backoff,
+                                 max_backoff=max_backoff)
+        open_connection = functools.partial(selector.connect, open_connection)
+
+    return ConnectionPool(
+        open_connection,
+        max_size=max_size,
+        wait_timeout=wait_timeout,
+        max_lifetime=max_lifetime,
+        idle_check=idle_check,
+    )
+
+
+def prewarm_connection_pool(connection_pool, count, after_fork=True):
+    """
+    Open ``count`` connections in ``connection_pool`` ahead of the first
+    requests.
+
+    With ``after_fork`` they are opened in every child process right after
+    ``fork()``, before a forked worker (e.g. under ``gunicorn --preload``)
+    starts accepting requests, and none are opened in the parent, which
+    would never use them. On Pythons without ``os.register_at_fork`` call
+    ``connection_pool.prewarm(count)`` from your server's post-fork hook
+    instead. Servers that do not fork pass ``after_fork=False`` to open the
+    connections now.
+    """
+    if not after_fork:
+        _prewarm(connection_pool, count)
+        return
+
+    register_at_fork = getattr(os, 'register_at_fork', None)
+    if register_at_fork is None:
+        LOG.warning('cannot prewarm RethinkDB connections after fork on this '
+                    'Python; call prewarm() from a post-fork hook instead')
+        return
+    register_at_fork(
+        after_in_child=functools.partial(_prewarm, connection_pool, count))
+
+
+def _prewarm(connection_pool, count):
+    try:
+        opened = connection_pool.prewarm(count)
+        LOG.debug('prewarmed %s RethinkDB connections', opened)
+    except Exception:
+        # a worker should still start if RethinkDB is briefly unreachable
+        LOG.exception('failed to prewarm RethinkDB connection pool')
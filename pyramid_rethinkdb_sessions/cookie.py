@@ -0,0 +1,153 @@
+"""
+ # Copyright (c) 2017 Boolein Integer Indonesia, PT.
+ # suryakencana 1/8/17 @author nanang.suryadi@boolein.id
+ #
+ # You are hereby granted a non-exclusive, worldwide, royalty-free license to
+ # use, copy, modify, and distribute this software in source code or binary
+ # form for use in connection with the web services and APIs provided by
+ # Boolein.
+ #
+ # As with any software that integrates with the Boolein platform, your use
+ # of this software is subject to the Boolein Developer Principles and
+ # Policies [http://developers.Boolein.com/policy/]. This copyright notice
+ # shall be included in all copies or substantial portions of the software.
+ #
+ # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ # THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ # DEALINGS IN THE SOFTWARE
+ #
+ # cookie
+"""
+import base64
+import binascii
+import collections
+import hashlib
+import hmac
+import struct
+import threading
+import time
+
+from .compat import text_type
+
+# flags, expiry (epoch seconds, 0 for none)
+HEADER = struct.Struct('>BI')
+# the cookie holds the session itself rather than its id
+FLAG_SESSION = 1
+# the session held is zlib compressed
+FLAG_COMPRESSED = 2
+
+SessionCookie = collections.namedtuple(
+    'SessionCookie', 'session_id payload compressed expires_at')
+
+
+def _bytes(secret):
+    if isinstance(secret, text_type):
+        return secret.encode('utf-8')
+    return secret
+
+
+class CookieCodec(object):
+    """
+    Encodes session cookies in a fixed binary layout, base64url encoded
+    without padding: a flags byte, a 4 byte expiry, the session id (or, for
+    sessions kept in the cookie, the serialized session) and an HMAC-SHA256
+    truncated to ``mac_size`` bytes. Nothing is deserialized before the MAC
+    has been checked, in constant time.
+
+    Parameters:
+
+    ``secret``
+    The secret cookies are signed with.
+
+    ``old_secrets``
+    Secrets cookies signed earlier are still accepted with, so that the
+    secret can be rotated without logging everyone out. Default: ``()``.
+
+    ``mac_size``
+    Bytes of the MAC kept, from 8 to 32. Default: ``16``.
+
+    ``cache_size``
+    Number of recently verified cookies whose decoded value is remembered,
+    so that the MAC of a cookie sent again and again is checked once.
+    Default: ``1024`` (``0`` disables the cache).
+    """
+    def __init__(self, secret, old_secrets=(), mac_size=16, cache_size=1024,
+                 clock=time.time):
+        if not 8 <= mac_size <= 32:
+            raise ValueError('mac_size must be between 8 and 32 bytes')
+        self._keys = [_bytes(s) for s in (secret,) + tuple(old_secrets)]
+        self.mac_size = mac_size
+        self.cache_size = cache_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._verified = collections.OrderedDict()
+
+    def _mac(self, key, message):
+        return hmac.new(key, message, hashlib.sha256).digest()[:self.mac_size]
+
+    def _encode(self, flags, expires_at, body):
+        message = HEADER.pack(flags, int(expires_at or 0)) + body
+        cookie = message + self._mac(self._keys[0], message)
+        return base64.urlsafe_b64encode(cookie).rstrip(b'=').decode('ascii')
+
+    def encode_id(self, session_id, expires_at=None):
+        """The cookie value for the session ``session_id``."""
+        return self._encode(0, expires_at, session_id.encode('utf-8'))
+
+    def encode_session(self, payload, expires_at, compressed=False):
+        """The cookie value holding the serialized session ``payload``."""
+        flags = FLAG_SESSION | (FLAG_COMPRESSED if compressed else 0)
+        return self._encode(flags, expires_at, payload)
+
+    def decode(self, cookieval):
+        """
+        Return the ``SessionCookie`` encoded in ``cookieval``, or ``None``
+        when it is malformed, not signed with a known secret or expired.
+        """
+        now = self.clock()
+        with self._lock:
+            cookie = self._verified.get(cookieval)
+            if cookie is not None:
+                self._verified[cookieval] = self._verified.pop(cookieval)
+        if cookie is None:
+            cookie = self._verify(cookieval)
+            if cookie is None:
+                return None
+            if self.cache_size:
+                with self._lock:
+                    self._verified[cookieval] = cookie
+                    while len(self._verified) > self.cache_size:
+                        self._verified.popitem(last=False)
+        if cookie.expires_at and cookie.expires_at <= now:
+            return None
+        return cookie
+
+    def _verify(self, cookieval):
+        try:
+            raw = base64.urlsafe_b64decode(
+                str(cookieval) + '=' * (-len(cookieval) % 4))
+        except (TypeError, ValueError, binascii.Error):
+            return None
+        if len(raw) < HEADER.size + self.mac_size:
+            return None
+        message, mac = raw[:-self.mac_size], raw[-self.mac_size:]
+        # every key is tried, so the time taken does not tell which matched
+        valid = False
+        for key in self._keys:
+            valid |= hmac.compare_digest(self._mac(key, message), mac)
+        if not valid:
+            return None
+        flags, expires_at = HEADER.unpack_from(message)
+        body = message[HEADER.size:]
+        if flags & FLAG_SESSION:
+            return SessionCookie(None, body, bool(flags & FLAG_COMPRESSED),
+                                 expires_at)
+        try:
+            session_id = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        return SessionCookie(session_id, None, False, expires_at)
@@ -0,0 +1,303 @@
+"""
+ # Copyright (c) 2017 Boolein Integer Indonesia, PT.
+ # suryakencana 1/8/17 @author nanang.suryadi@boolein.id
+ #
+ # You are hereby granted a non-exclusive, worldwide, royalty-free license to
+ # use, copy, modify, and distribute this software in source code or binary
+ # form for use in connection with the web services and APIs provided by
+ # Boolein.
+ #
+ # As with any software that integrates with the Boolein platform, your use
+ # of this software is subject to the Boolein Developer Principles and
+ # Policies [http://developers.Boolein.com/policy/]. This copyright notice
+ # shall be included in all copies or substantial portions of the software.
+ #
+ # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ # THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ # DEALINGS IN THE SOFTWARE
+ #
+ # pool
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import rethinkdb as r
+
+from .util import Counters
+
+LOG = logging.getLogger(__name__)
+
+# guards resetting a pool inherited across fork()
+_fork_lock = threading.Lock()
+
+
+def _close_inherited(conn):
+    """
+    Close this process's copy of a connection's socket inherited across
+    ``fork()``. Closing the connection itself would shut the socket down for
+    the parent process as well.
+    """
+    wrapper = getattr(getattr(conn, '_instance', None), '_socket', None)
+    sock = getattr(wrapper, '_socket', None)
+    if sock is None:
+        return
+    try:
+        sock.close()
+    except Exception:
+        LOG.debug('error closing inherited socket', exc_info=True)
+    wrapper._socket = None
+
+
+class PoolTimeoutError(r.ReqlDriverError):
+    """
+    Raised when no connection became available within ``wait_timeout``.
+    """
+
+
+class _PooledConnection(object):
+    def __init__(self, conn, created):
+        self.conn = conn
+        self.created = created
+        self.last_used = created
+
+
+class ConnectionPool(object):
+    """
+    A bounded, thread-safe pool of RethinkDB connections.
+
+    Each request checks a connection out with ``acquire`` and hands it back
+    with ``release``, so concurrent requests never share a socket.
+
+    Parameters:
+
+    ``connect``
+    A callable taking no arguments that opens and returns a new connection.
+
+    ``max_size``
+    The maximum number of connections open at once. Default: ``10``.
+
+    ``wait_timeout``
+    Seconds ``acquire`` waits for a free connection before raising
+    ``PoolTimeoutError``. Default: ``None`` (wait forever).
+
+    ``max_lifetime``
+    Seconds after which a connection is closed and replaced instead of being
+    reused. Default: ``None`` (no limit).
+
+    ``idle_check``
+    Connections idle for longer than this many seconds are pinged before
+    being handed out, and replaced if the ping fails. Default: ``30``.
+
+    The pool remembers the process it was created in. After a ``fork()`` the
+    child closes its copies of the inherited sockets, leaving the parent's
+    connections open, and opens its own on first use.
+    """
+    def __init__(self,
+                 connect,
+                 max_size=10,
+                 wait_timeout=None,
+                 max_lifetime=None,
+                 idle_check=30):
+        self.connect = connect
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.max_lifetime = max_lifetime
+        self.idle_check = idle_check
+        self._reset()
+
+    def _reset(self):
+        self.counters = Counters('created', 'discarded', 'checkouts',
+                                 'waits', 'wait_timeouts', 'wait_time')
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        """
+        Forget connections inherited from a parent process. Their sockets are
+        shared with the parent, so only this process's copies of them are
+        closed, and the locks are replaced because another thread may have
+        held them at the time of the fork.
+        """
+        if self._pid == os.getpid():
+            return
+        with _fork_lock:
+            if self._pid != os.getpid():
+                LOG.debug('fork detected, dropping inherited connections')
+                inherited = list(self._idle) + list(self._in_use.values())
+                self._reset()
+                for entry in inherited:
+                    _close_inherited(entry.conn)
+
+    def prewarm(self, count=None):
+        """
+        Open up to ``count`` connections (default: ``max_size``) and park them
+        in the pool, so the first requests do not pay for connecting.
+        Returns the number of connections opened.
+        """
+        self._check_pid()
+        count = self.max_size if count is None else count
+        opened = 0
+        while opened < count:
+            with self._cond:
+                if self._size >= self.max_size:
+                    break
+                self._size += 1
+            entry = self._open()
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+            opened += 1
+        return opened
+
+    def acquire(self):
+        """
+        Check out a connection, opening a new one if the pool is not full, or
+        waiting for one to be released otherwise.
+        """
+        self._check_pid()
+        deadline = None
+        started = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    entry = None
+                    break
+                if started is None:
+                    started = time.time()
+                    self.counters.incr('waits')
+                    if self.wait_timeout is not None:
+                        deadline = started + self.wait_timeout
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.counters.incr('wait_timeouts')
+                        self.counters.incr('wait_time', time.time() - started)
+                        raise PoolTimeoutError(
+                            'No RethinkDB connection available after '
+                            '%s seconds' % self.wait_timeout)
+                    self._cond.wait(remaining)
+        if started is not None:
+            self.counters.incr('wait_time', time.time() - started)
+
+        if entry is not None and not self._usable(entry):
+            self._discard(entry, reopen=True)
+            entry = None
+
+        if entry is None:
+            entry = self._open()
+
+        entry.last_used = time.time()
+        with self._cond:
+            self._in_use[id(entry.conn)] = entry
+        self.counters.incr('checkouts')
+        return entry.conn
+
+    def release(self, conn):
+        """
+        Return a connection previously handed out by ``acquire``.
+        """
+        if self._pid != os.getpid():
+            # checked out before a fork; the child must not reuse it
+            return
+        with self._cond:
+            entry = self._in_use.pop(id(conn), None)
+        if entry is None:
+            return
+        if not conn.is_open() or self._expired(entry, time.time()):
+            self._discard(entry)
+            return
+        entry.last_used = time.time()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager yielding a connection that is released on exit.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close every idle connection held by the pool."""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for entry in idle:
+            self._discard(entry)
+
+    def stats(self):
+        """
+        Return a dict of pool metrics: the counters plus current ``size``,
+        ``idle`` and ``in_use`` connection counts.
+        """
+        stats = self.counters.snapshot()
+        with self._cond:
+            stats.update(size=self._size,
+                         idle=len(self._idle),
+                         in_use=len(self._in_use))
+        return stats
+
+    def _open(self):
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self.counters.incr('created')
+        return _PooledConnection(conn, time.time())
+
+    def _discard(self, entry, reopen=False):
+        """
+        Close a connection and drop it from the pool. With ``reopen`` the
+        caller keeps the slot to open a replacement.
+        """
+        self.counters.incr('discarded')
+        try:
+            entry.conn.close(noreply_wait=False)
+        except Exception:
+            LOG.debug('error closing pooled connection', exc_info=True)
+        if not reopen:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+
+    def _expired(self, entry, now):
+        return (self.max_lifetime is not None and
+                now - entry.created >= self.max_lifetime)
+
+    def _usable(self, entry):
+        now = time.time()
+        if not entry.conn.is_open() or self._expired(entry, now):
+            return False
+        if self.idle_check is not None and \
+                now - entry.last_used >= self.idle_check:
+            try:
+                r.expr(1).run(entry.conn)
+            except r.ReqlError:
+                LOG.info('discarding unhealthy pooled connection')
+                return False
+        return True
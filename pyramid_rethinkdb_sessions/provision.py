@@ -0,0 +1,88 @@
+"""
+ # Copyright (c) 2017 Boolein Integer Indonesia, PT.
+ # suryakencana 1/8/17 @author nanang.suryadi@boolein.id
+ #
+ # You are hereby granted a non-exclusive, worldwide, royalty-free license to
+ # use, copy, modify, and distribute this software in source code or binary
+ # form for use in connection with the web services and APIs provided by
+ # Boolein.
+ #
+ # As with any software that integrates with the Boolein platform, your use
+ # of this software is subject to the Boolein Developer Principles and
+ # Policies [http://developers.Boolein.com/policy/]. This copyright notice
+ # shall be included in all copies or substantial portions of the software.
+ #
+ # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ # THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ # DEALINGS IN THE SOFTWARE
+ #
+ # provision
+"""
+import logging
+
+from .util import R_DB, R_TABLE, R_INDEXES, R_LEASE_TABLE
+
+import rethinkdb as r
+
+LOG = logging.getLogger(__name__)
+
+
+def provision(conn, db=R_DB, table=R_TABLE, indexes=R_INDEXES,
+              lease_table=R_LEASE_TABLE):
+    """
+    Create the database, the sessions table and its secondary indexes, and
+    the reaper's ``lease_table``, if they do not exist yet, then wait until
+    the tables and indexes are ready.
+
+    Run this once per deployment (the ``rethinkdb_sessions_provision`` console
+    script wraps it) rather than from web workers. It is safe to run
+    concurrently: objects created by someone else in the meantime are
+    treated as already provisioned.
+
+    Returns a dict listing what was created.
+    """
+    created = {'db': False, 'table': False, 'lease_table': False,
+               'indexes': []}
+
+    if db not in r.db_list().run(conn):
+        created['db'] = _create(r.db_create(db), conn)
+
+    tables = r.db(db).table_list().run(conn)
+    if table not in tables:
+        created['table'] = _create(r.db(db).table_create(table), conn)
+    if lease_table not in tables:
+        created['lease_table'] = _create(r.db(db).table_create(lease_table),
+                                         conn)
+    r.db(db).table(lease_table).wait().run(conn)
+
+    sessions = r.db(db).table(table)
+    sessions.wait().run(conn)
+
+    existing = sessions.index_list().run(conn)
+    for index in indexes:
+        if index not in existing and \
+                _create(sessions.index_create(index), conn):
+            created['indexes'].append(index)
+    if indexes:
+        sessions.index_wait(*indexes).run(conn)
+
+    LOG.info('provisioned %s.%s: %s', db, table, created)
+    return created
+
+
+def _create(query, conn):
+    """
+    Run a create query, returning ``False`` if another process won the race
+    to create the same object.
+    """
+    try:
+        query.run(conn)
+    except r.ReqlOpFailedError as e:
+        if 'already exists' not in str(e):
+            raise
+        return False
+    return True
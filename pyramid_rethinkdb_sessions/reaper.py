@@ -0,0 +1,264 @@
+"""
+ # Copyright (c) 2017 Boolein Integer Indonesia, PT.
+ # suryakencana 1/8/17 @author nanang.suryadi@boolein.id
+ #
+ # You are hereby granted a non-exclusive, worldwide, royalty-free license to
+ # use, copy, modify, and distribute this software in source code or binary
+ # form for use in connection with the web services and APIs provided by
+ # Boolein.
+ #
+ # As with any software that integrates with the Boolein platform, your use
+ # of this software is subject to the Boolein Developer Principles and
+ # Policies [http://developers.Boolein.com/policy/]. This copyright notice
+ # shall be included in all copies or substantial portions of the software.
+ #
+ # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ # THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ # DEALINGS IN THE SOFTWARE
+ #
+ # reaper
+"""
+import binascii
+import logging
+import os
+import socket
+import threading
+import time
+
+from .util import R_LEASE_TABLE, R_TABLE
+
+import rethinkdb as r
+
+LOG = logging.getLogger(__name__)
+
+# id of the lease document electing the worker that reaps, in the lease table
+LEASE_ID = '_reaper_lease'
+
+
+def expired_sessions(table=R_TABLE):
+    """
+    ReQL selection of the sessions that have expired, read from the
+    ``expires_at`` index so no full table scan is needed.
+    """
+    return r.table(table).between(
+        r.minval, r.now().to_epoch_time(), index='expires_at')
+
+
+def reap_expired(conn,
+                 batch_size=1000,
+                 max_rate=None,
+                 max_batches=None,
+                 table=R_TABLE,
+                 durability='soft',
+                 sleep=time.sleep):
+    """
+    Delete expired sessions, ``batch_size`` rows per query, until none are
+    left or ``max_batches`` batches have run.
+
+    Parameters:
+
+    ``conn``
+    A RethinkDB connection whose default database holds the sessions table.
+
+    ``batch_size``
+    Rows deleted per query. Default: ``1000``.
+
+    ``max_rate``
+    Upper bound on rows deleted per second; the reaper sleeps between
+    batches to stay under it. Default: ``None`` (no limit).
+
+    ``max_batches``
+    Stop after this many batches even if expired rows remain.
+    Default: ``None`` (run until done).
+
+    ``table``
+    The sessions table. Default: ``pyramid_sessions``.
+
+    ``durability``
+    Durability of the deletes; losing one on a crash only means the row is
+    reaped again later. Default: ``soft``.
+
+    Returns a dict with the number of rows ``deleted``, the ``batches`` run,
+    the ``elapsed`` seconds and the ``backlog`` of expired rows left.
+    """
+    expired = expired_sessions(table)
+    started = time.time()
+    deleted = batches = 0
+    while max_batches is None or batches < max_batches:
+        batch_started = time.time()
+        result = expired.limit(batch_size).delete(
+            durability=durability).run(conn)
+        batches += 1
+        deleted += result['deleted']
+        if result['deleted'] < batch_size:
+            break
+        if max_rate:
+            pause = result['deleted'] / float(max_rate) - \
+                (time.time() - batch_started)
+            if pause > 0:
+                sleep(pause)
+    backlog = expired.count().run(conn)
+    elapsed = time.time() - started
+    LOG.info('reaped %s expired sessions in %s batches (%.2fs), %s left',
+             deleted, batches, elapsed, backlog)
+    return {
+        'deleted': deleted,
+        'batches': batches,
+        'elapsed': elapsed,
+        'backlog': backlog,
+    }
+
+
+def acquire_lease(conn, holder, ttl, table=R_LEASE_TABLE,
+                  lease_id=LEASE_ID):
+    """
+    Take or renew the reaper lease for ``holder`` for ``ttl`` seconds with an
+    atomic ``replace``, in a single query. Returns ``True`` if ``holder`` now
+    holds the lease, ``False`` while another holder's lease is still running.
+    """
+    now = r.now().to_epoch_time()
+    lease = r.table(table).get(lease_id)
+    claim = lease.replace(lambda current: r.branch(
+        current.eq(None).or_(current['holder'].eq(holder)).or_(
+            current['expires_at'].le(now)),
+        {'id': lease_id, 'holder': holder, 'expires_at': now + ttl},
+        current,
+    ))
+    # a renewal within the same instant leaves the document unchanged, so
+    # the outcome is read back rather than taken from the write counts
+    return claim.do(
+        lambda result: lease['holder'].default(None).eq(holder)).run(conn)
+
+
+def release_lease(conn, holder, table=R_LEASE_TABLE, lease_id=LEASE_ID):
+    """Give the reaper lease up, if ``holder`` holds it."""
+    r.table(table).get(lease_id).replace(lambda lease: r.branch(
+        lease['holder'].default(None).eq(holder), None, lease,
+    )).run(conn)
+
+
+class Reaper(object):
+    """
+    Runs ``reap_expired`` every ``interval`` seconds in a daemon thread.
+
+    Every worker of a deployment can run one: they compete for a lease
+    document in RethinkDB (in ``lease_table``, created by ``provision``) and
+    only the holder reaps, renewing the lease each round. When the holder
+    dies its lease runs out after ``lease_ttl`` seconds and another worker
+    takes over.
+
+    Parameters:
+
+    ``connection_pool``
+    A ``pyramid_rethinkdb_sessions.pool.ConnectionPool`` to run queries on,
+    usually the session factory's.
+
+    ``interval``
+    Seconds between rounds. Default: ``60``.
+
+    ``lease_ttl``
+    Seconds a lease lasts without being renewed; keep it well above
+    ``interval``. Default: three times ``interval``.
+
+    ``batch_size``, ``max_rate``, ``max_batches``
+    Passed to ``reap_expired`` each round. ``max_batches`` defaults to
+    ``100`` so that a round ends well within the lease.
+
+    ``buckets``
+    The ``buckets.SessionBuckets`` of a factory storing sessions in
+    time-bucketed tables; each round then creates upcoming tables and drops
+    expired ones with ``SessionBuckets.rotate`` instead of deleting rows.
+    Default: ``None``.
+    """
+    def __init__(self,
+                 connection_pool,
+                 interval=60,
+                 lease_ttl=None,
+                 batch_size=1000,
+                 max_rate=None,
+                 max_batches=100,
+                 table=R_TABLE,
+                 buckets=None,
+                 lease_table=R_LEASE_TABLE):
+        self.connection_pool = connection_pool
+        self.interval = interval
+        self.lease_ttl = lease_ttl or 3 * interval
+        self.batch_size = batch_size
+        self.max_rate = max_rate
+        self.max_batches = max_batches
+        self.table = table
+        self.buckets = buckets
+        self.lease_table = lease_table
+        self.holder = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._fork_hook = False
+
+    def start(self):
+        """
+        Start the reaper thread; in processes forked from this one it is
+        started again, as threads do not survive ``fork()``.
+        """
+        self.holder = '%s:%s:%s' % (socket.gethostname(), os.getpid(),
+                                    binascii.hexlify(os.urandom(4)).decode())
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='rethinkdb-sessions-reaper')
+        self._thread.daemon = True
+        self._thread.start()
+
+        register_at_fork = getattr(os, 'register_at_fork', None)
+        if register_at_fork is not None and not self._fork_hook:
+            register_at_fork(after_in_child=self._after_fork)
+            self._fork_hook = True
+
+    def stop(self, timeout=None):
+        """Stop the thread and give the lease up so another worker can reap."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self.holder is None:
+            return
+        try:
+            with self.connection_pool.connection() as conn:
+                release_lease(conn, self.holder, self.lease_table)
+        except Exception:
+            LOG.exception('failed to release the reaper lease')
+
+    def run_once(self):
+        """
+        Run one round: reap if the lease could be taken or renewed. Returns
+        the ``reap_expired`` (or ``SessionBuckets.rotate``) result, or
+        ``None`` when another worker leads.
+        """
+        with self.connection_pool.connection() as conn:
+            if not acquire_lease(conn, self.holder, self.lease_ttl,
+                                 self.lease_table):
+                return None
+            if self.buckets is not None:
+                return self.buckets.rotate(conn)
+            return reap_expired(
+                conn,
+                batch_size=self.batch_size,
+                max_rate=self.max_rate,
+                max_batches=self.max_batches,
+                table=self.table,
+            )
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                # RethinkDB being away must not kill the thread
+                LOG.exception('session reaper round failed')
+
+    def _after_fork(self):
+        if self._thread is not None:
+            self._thread = None
+            self.start()
@@ -24,26 +24,65 @@
 """
 
 import binascii
+import functools
 import os
+import time
 
 from pyramid.compat import text_
 from pyramid.decorator import reify
 from pyramid.interfaces import ISession
 from zope.interface import implementer
 
+from .buckets import TABLE_FIELD
 from .compat import cPickle, text_type
-from .util import refresh, R_TABLE, persist
+from .tracking import track, untrack
+from .util import (
+    DEFAULT_WRITE_POLICY,
+    Counters,
+    payload_fingerprint,
+    refresh,
+    R_TABLE,
+    expires_at,
+    live_session,
+    persist,
+    fields_document,
+    new_session_state,
+    session_document,
+    state_from_document,
+)
 
 import rethinkdb as r
 
 
 class _SessionState(object):
-    def __init__(self, session_id, managed_dict, created, timeout, new):
+    def __init__(self, session_id, managed_dict, created, timeout, new,
+                 fingerprint=None, field_fingerprints=None, expires_at=None,
+                 table=None, cookie_payload=None):
         self.session_id = session_id
         self.managed_dict = managed_dict
         self.created = created
         self.timeout = timeout
         self.new = new
+        # set by @persist; the state is written out by flush()
+        self.dirty = False
+        # digest of the payload last read from or written to RethinkDB
+        self.fingerprint = fingerprint
+        # per key digests, for sessions stored with one field per key
+        self.field_fingerprints = field_fingerprints
+        # when the stored session expires, as last known; None for rows
+        # written before expiry times were stored
+        self.expires_at = expires_at
+        # set by refresh(); the expiry is extended by flush()
+        self.touch_pending = False
+        # the table holding the stored session; None until it is stored
+        self.table = table
+        # the serialized session when it is kept in the cookie instead of
+        # RethinkDB, and whether the cookie needs to be sent again
+        self.cookie_payload = cookie_payload
+        self.cookie_dirty = False
+
+    def mark_dirty(self):
+        self.dirty = True
 
 
 @implementer(ISession)
@@ -55,36 +94,107 @@ class RethinkDBSession(object):
                  new,
                  new_session,
                  serialize=cPickle.dumps,
-                 deserialize=cPickle.loads):
-
-        self.conn = conn
+                 deserialize=cPickle.loads,
+                 persisted=None,
+                 timeout=1200,
+                 counters=None,
+                 track_mutations=False,
+                 field_storage=False,
+                 write_policy=DEFAULT_WRITE_POLICY,
+                 refresh_fraction=0.25,
+                 buckets=None,
+                 cache=None,
+                 cookie_threshold=0,
+                 inline=False):
+
+        # a connection, or a function checking one out once a query runs
+        if callable(conn):
+            self._get_conn = conn
+        else:
+            self._get_conn = lambda: conn
         self.serialize = serialize
         self.deserialize = deserialize
         self._new_session = new_session
+        self._timeout = timeout
+        if counters is None:
+            counters = Counters('writes_performed', 'writes_skipped',
+                                'touches')
+        self.counters = counters
+        self._track_mutations = track_mutations
+        self._field_storage = field_storage
+        self.write_policy = write_policy
+        self._refresh_fraction = refresh_fraction
+        self._buckets = buckets
+        self._cache = cache
+        self._cookie_threshold = cookie_threshold
         self._session_state = self._make_session_state(
             session_id=session_id,
             new=new,
+            persisted=persisted,
+            inline=inline,
         )
 
+    @property
+    def conn(self):
+        return self._get_conn()
+
     @reify
     def _session_state(self):
         return self._make_session_state(
-            session_id=self._new_session(),
+            session_id=None,
             new=True,
         )
 
-    def _make_session_state(self, session_id, new):
-        persisted = self.from_r(session_id=session_id)
-        # self.from_redis needs to take a session_id here, because otherwise it
-        # would look up self.session_id, which is not ready yet as
-        # session_state has not been created yet.
-        return _SessionState(
+    def _make_session_state(self, session_id, new, persisted=None,
+                            inline=False):
+        # ``persisted`` is the session's document when the caller already
+        # fetched it, which saves reading it from RethinkDB a second time,
+        # or with ``inline`` the session read from the cookie.
+        # A new session without an id lives in memory only; it is inserted
+        # (and gets its id) the first time it is written to.
+        fingerprint = field_fingerprints = expires_at = table = None
+        cookie_payload = None
+        if inline:
+            cookie_payload = persisted['payload']
+        if persisted is None and session_id is not None:
+            persisted = self._fetch(session_id)
+        if persisted is not None:
+            expires_at = persisted.get('expires_at')
+            if not inline:
+                table = persisted.get(TABLE_FIELD, R_TABLE)
+            if 'data' in persisted:
+                field_fingerprints = dict(
+                    (key, payload_fingerprint(payload))
+                    for key, payload in persisted['data'].items())
+            else:
+                fingerprint = payload_fingerprint(persisted['payload'])
+            persisted = state_from_document(persisted, self.deserialize)
+        else:
+            persisted = new_session_state(self._timeout)
+        state = _SessionState(
             session_id=session_id,
             managed_dict=persisted['managed_dict'],
             created=persisted['created'],
             timeout=persisted['timeout'],
             new=new,
+            fingerprint=fingerprint,
+            field_fingerprints=field_fingerprints,
+            expires_at=expires_at,
+            table=table,
+            cookie_payload=cookie_payload,
         )
+        if self._track_mutations:
+            managed_dict = state.managed_dict
+            for key, value in managed_dict.items():
+                managed_dict[key] = track(value, state.mark_dirty)
+        return state
+
+    def _track(self, value):
+        # wrap lists and dicts stored in the session so that changing them in
+        # place marks the session dirty
+        if not self._track_mutations:
+            return value
+        return track(value, self._session_state.mark_dirty)
 
     @property
     def session_id(self):
@@ -113,23 +223,24 @@ class RethinkDBSession(object):
         Primarily used by the ``@persist`` decorator to save the current
         session state to Redis.
         """
-        return self.serialize({
-            'managed_dict': self.managed_dict,
-            'created': self.created,
-            'timeout': self.timeout,
-        })
+        return self.serialize(self._state())
 
     def from_r(self, session_id=None):
         """Get and deserialize the persisted data for this session from Redis.
         """
-        persisted = r.table(R_TABLE).get(session_id).run(self.conn)
+        persisted = self._fetch(session_id)
 
-        deserialized = self.deserialize(persisted['payload'])
+        deserialized = state_from_document(persisted, self.deserialize)
         return deserialized
 
     def invalidate(self):
         """Invalidate the session."""
-        r.table(R_TABLE).get(self.session_id).delete().run(self.conn)
+        if self._stored:
+            self.write_policy.run(
+                'invalidate', r.table(self._session_state.table).get(
+                    self.session_id).delete(), self.conn)
+            if self._cache is not None:
+                self._cache.discard(self.session_id)
         del self._session_state
         # Delete the self._session_state attribute so that direct access to or
         # indirect access via other methods and properties to .session_id,
@@ -144,11 +255,11 @@ class RethinkDBSession(object):
 
     @persist
     def __setitem__(self, key, value):
-        self.managed_dict[key] = value
+        self.managed_dict[key] = self._track(value)
 
     @persist
     def setdefault(self, key, default=None):
-        return self.managed_dict.setdefault(key, default)
+        return self.managed_dict.setdefault(key, self._track(default))
 
     @persist
     def clear(self):
@@ -160,6 +271,9 @@ class RethinkDBSession(object):
 
     @persist
     def update(self, other):
+        if self._track_mutations:
+            other = dict((key, self._track(value))
+                         for key, value in dict(other).items())
         return self.managed_dict.update(other)
 
     @persist
@@ -223,12 +337,58 @@ class RethinkDBSession(object):
             keys = self.managed_dict.keys()
         return keys
 
-    @persist
     def changed(self):
-        """ Persist all the data that needs to be persisted for this session
-        immediately with ``@persist``.
+        """ Mark the session as modified, e.g. after mutating a value stored
+        in it, so it is written to RethinkDB when it is flushed.
+        """
+        self._session_state.dirty = True
+
+    def flush(self):
+        """ Write the session to RethinkDB now if it was modified, instead of
+        waiting for the end of the request. Returns ``True`` when a write
+        happened.
         """
-        pass
+        if self._invalidated:
+            return False
+        state = self._session_state
+        written = False
+        if state.dirty:
+            written = self._write(state)
+            state.dirty = False
+            self.counters.incr(
+                'writes_performed' if written else 'writes_skipped')
+        if state.touch_pending and not written:
+            self._touch(state)
+        state.touch_pending = False
+        return written
+
+    def refresh(self):
+        """ Schedule extending the session's expiry for the next flush, once
+        more than ``refresh_fraction`` of its timeout has passed since it was
+        last extended. Called on reads by ``@refresh``.
+        """
+        state = self._session_state
+        if not (self._stored or self._in_cookie) or state.touch_pending:
+            return
+        if state.expires_at is not None:
+            touched = state.expires_at - state.timeout
+            if time.time() - touched < self._refresh_fraction * state.timeout:
+                return
+        state.touch_pending = True
+
+    def _touch(self, state):
+        if state.cookie_payload is not None:
+            # the cookie is sent again with the new expiry
+            state.expires_at = time.time() + state.timeout
+            state.cookie_dirty = True
+            return
+        # only the expiry time is sent, not the session data
+        self._update('touch', state, {'expires_at': expires_at(state.timeout)})
+        state.expires_at = time.time() + state.timeout
+        if self._cache is not None:
+            # read back with its new expiry when next needed
+            self._cache.discard(state.session_id)
+        self.counters.incr('touches')
 
     # session methods persist or refresh using above dict methods
     def new_csrf_token(self):
@@ -277,14 +437,244 @@ class RethinkDBSession(object):
         """
         return '_session_state' not in self.__dict__
 
-    def expire(self, session_id, timeout):
-        session_dict = {
-            'id': session_id,
-            'expired': timeout,
-            'payload': r.binary(self.to_r()),
+    @property
+    def _stored(self):
+        """
+        Boolean property indicating whether the session has a document in
+        RethinkDB. New sessions are not stored until they are written to.
+        """
+        return self._session_state.session_id is not None
+
+    @property
+    def _in_cookie(self):
+        """
+        Boolean property indicating whether the session is kept in the
+        cookie rather than in RethinkDB.
+        """
+        return self._session_state.cookie_payload is not None
+
+    def _state(self):
+        managed_dict = self.managed_dict
+        if self._track_mutations:
+            managed_dict = dict((key, untrack(value))
+                                for key, value in managed_dict.items())
+        return {
+            'managed_dict': managed_dict,
+            'created': self.created,
+            'timeout': self.timeout,
         }
-        results = r.table(R_TABLE).get(session_id).replace(session_dict).run(self.conn)
 
-        if results['errors'] > 0:
+    def expire(self, session_id, timeout):
+        """ Write the whole session to RethinkDB, inserting it if it is not
+        stored yet, whether or not it changed.
+        """
+        self._write(self._session_state, full=True)
+
+    def _write(self, state, full=False):
+        # Returns False when the session serializes to what is stored
+        if self._cookie_threshold and state.session_id is None:
+            written = self._write_cookie(state, full)
+            if written is not None:
+                return written
+        if self._field_storage:
+            return self._write_fields(state, full)
+        payload = self.to_r()
+        fingerprint = payload_fingerprint(payload)
+        if not full and state.session_id is not None and \
+                fingerprint == state.fingerprint:
+            return False
+        self._write_document(state, functools.partial(
+            session_document, timeout=state.timeout, payload=payload))
+        state.fingerprint = fingerprint
+        self._cache_write(state, payload=payload)
+        return True
+
+    def _write_cookie(self, state, full=False):
+        # keep a small session in the cookie; returns None once it has
+        # outgrown the cookie and has to be stored in RethinkDB instead
+        payload = self.to_r()
+        if len(payload) > self._cookie_threshold:
+            state.cookie_payload = None
+            state.fingerprint = None
+            return None
+        fingerprint = payload_fingerprint(payload)
+        if not full and state.cookie_payload is not None and \
+                fingerprint == state.fingerprint:
+            return False
+        state.cookie_payload = payload
+        state.fingerprint = fingerprint
+        state.expires_at = time.time() + state.timeout
+        state.cookie_dirty = True
+        return True
+
+    def _write_fields(self, state, full=False):
+        payloads = dict((key, self.serialize(value)) for key, value
+                        in self._state()['managed_dict'].items())
+        fingerprints = dict((key, payload_fingerprint(payload))
+                            for key, payload in payloads.items())
+        stored = state.field_fingerprints
+        # new, or stored as a single payload so far
+        full = full or state.session_id is None or stored is None
+        if not full:
+            changes = dict((key, r.binary(payloads[key]))
+                           for key, fingerprint in fingerprints.items()
+                           if stored.get(key) != fingerprint)
+            changes.update((key, r.literal())
+                           for key in stored if key not in fingerprints)
+            if not changes:
+                return False
+            # a row reaped or deleted meanwhile is written out whole again
+            full = not self._update('write', state, {
+                'data': changes,
+                'expires_at': expires_at(state.timeout),
+            })
+            state.expires_at = time.time() + state.timeout
+        if full:
+            self._write_document(state, functools.partial(
+                fields_document, timeout=state.timeout, created=state.created,
+                payloads=payloads))
+        state.field_fingerprints = fingerprints
+        self._cache_write(state, created=state.created, timeout=state.timeout,
+                          data=payloads)
+        return True
+
+    def _lookup(self, session_id):
+        if self._buckets is not None:
+            return self._buckets.lookup(session_id)
+        return live_session(session_id)
+
+    def _fetch(self, session_id):
+        # the session's document, from the cache when it holds it
+        def fetch():
+            return self._lookup(session_id).run(self.conn)
+        if self._cache is None:
+            return fetch()
+        return self._cache.load(session_id, fetch)
+
+    def _cache_write(self, state, **fields):
+        # write through: cache the document just written, as it was stored
+        if self._cache is None:
+            return
+        document = dict(fields, id=state.session_id,
+                        expires_at=state.expires_at)
+        document[TABLE_FIELD] = state.table
+        self._cache.put(state.session_id, document)
+
+    def _table(self):
+        # the table sessions are written to now
+        if self._buckets is None:
+            return R_TABLE
+        return self._buckets.current()
+
+    def _update(self, operation, state, patch):
+        # apply ``patch`` to the stored session; one left in an older bucket
+        # is moved into the current one, so its old table can be dropped.
+        # Returns False when the stored session no longer exists.
+        table = self._table()
+        stored = r.table(state.table).get(state.session_id)
+        if table == state.table:
+            query = stored.update(patch)
+        else:
+            query = stored.do(lambda document: r.branch(
+                document.eq(None),
+                {'skipped': 1},
+                r.expr([
+                    r.table(table).insert(document.merge(patch),
+                                          conflict='replace'),
+                    stored.delete(),
+                ])[0],
+            ))
+        results = self.write_policy.run(operation, query, self.conn)
+        # a write sent without waiting for the reply is assumed to apply
+        if results is not None and results.get('skipped', 0) > 0:
+            return False
+        state.table = table
+        return True
+
+    def _write_document(self, state, make_document):
+        state.expires_at = time.time() + state.timeout
+        table = self._table()
+        if state.session_id is None:
+            # first write to a new session: insert it under a unique id
+            state.session_id = self._new_session(make_document=make_document,
+                                                 table=table)
+            state.table = table
+            # the cookie now has to carry the new id instead of any session
+            # it held until now
+            state.cookie_payload = None
+            state.fingerprint = None
+            state.cookie_dirty = True
+            return
+        session_id = state.session_id
+        stored = r.table(state.table).get(session_id)
+        if table == state.table:
+            query = stored.replace(make_document(session_id))
+        else:
+            query = r.expr([
+                r.table(table).insert(make_document(session_id),
+                                      conflict='replace'),
+                stored.delete(),
+            ])[0]
+        results = self.write_policy.run('write', query, self.conn)
+        state.table = table
+
+        if results is not None and results['errors'] > 0:
             raise KeyError(u'Session ID (%s) conflicts with an existing session' % session_id)
 
+
+@implementer(ISession)
+class LazyRethinkDBSession(object):
+    """
+    Proxy returned by the session factory. It defers checking out a
+    connection and loading the session from RethinkDB until the session is
+    first used, so requests that never read ``request.session`` (or only
+    reach it through code paths not taken) pay nothing for it.
+
+    ``loader`` is a callable returning the real ``RethinkDBSession``.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+
+    def _load(self):
+        # not a reify: an AttributeError raised by the loader would make
+        # Python fall back to __getattr__ and hide it
+        try:
+            return self.__dict__['_session']
+        except KeyError:
+            session = self.__dict__['_session'] = self._loader()
+            return session
+
+    @property
+    def loaded(self):
+        """Whether the underlying session has been loaded yet."""
+        return '_session' in self.__dict__
+
+    def __getattr__(self, name):
+        if name == '_session':
+            # not loaded yet; never forward the proxy's own names
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def flush(self):
+        # a session that was never loaded has nothing to write
+        if not self.loaded:
+            return False
+        return self._load().flush()
+
+    # special methods are looked up on the type, so they cannot go through
+    # __getattr__
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+
+    def __delitem__(self, key):
+        del self._load()[key]
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
@@ -0,0 +1,266 @@
+"""
+ # Copyright (c) 2017 Boolein Integer Indonesia, PT.
+ # suryakencana 1/8/17 @author nanang.suryadi@boolein.id
+ #
+ # You are hereby granted a non-exclusive, worldwide, royalty-free license to
+ # use, copy, modify, and distribute this software in source code or binary
+ # form for use in connection with the web services and APIs provided by
+ # Boolein.
+ #
+ # As with any software that integrates with the Boolein platform, your use
+ # of this software is subject to the Boolein Developer Principles and
+ # Policies [http://developers.Boolein.com/policy/]. This copyright notice
+ # shall be included in all copies or substantial portions of the software.
+ #
+ # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ # THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ # DEALINGS IN THE SOFTWARE
+ #
+ # shared
+"""
+import contextlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from .compat import cPickle
+from .util import Counters
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # not on Windows
+    fcntl = None
+
+MAGIC = b'RSC1'
+# magic, slots, slot size, ways
+HEADER = struct.Struct('<4sIII')
+HEADER_SIZE = 64
+# version, cached at, expires at, key length, value length, referenced
+SLOT = struct.Struct('<QddHIBx')
+# offset of the reference bit within a slot
+REF = SLOT.size - 2
+MAX_KEY = 255
+
+
+class SharedSessionCache(object):
+    """
+    A cache of session documents shared by every process on a host through
+    a memory-mapped file, as a second tier behind each process's
+    ``cache.SessionCache``: a user whose requests land on different workers
+    of the same box is read from RethinkDB once.
+
+    The file is a hash table of fixed-size slots grouped in sets of
+    ``ways``; a session can only live in its set, which is evicted with the
+    clock algorithm (a hit sets a slot's reference bit, eviction takes the
+    first slot whose bit is clear, clearing bits on the way). Writers lock
+    the set with ``fcntl``; readers do not lock, but check the slot's version
+    stamp, odd while a write is in progress, before and after copying the
+    slot and treat any change as a miss.
+
+    Documents are pickled into the slots, so the file is created readable
+    by its owner only.
+
+    Parameters:
+
+    ``path``
+    The file to map, created if needed; ``/dev/shm`` keeps it in memory.
+    Every process sharing it must use the same ``slots``, ``slot_size``
+    and ``ways``: a file laid out differently is reset.
+
+    ``slots``
+    Number of slots. Default: ``4096``.
+
+    ``slot_size``
+    Bytes per slot; sessions that do not fit are not cached here.
+    Default: ``4096``.
+
+    ``ways``
+    Slots per set. Default: ``4``.
+
+    ``ttl``
+    Seconds an entry is used, unless the caller asks for less.
+    Default: ``5``.
+    """
+    def __init__(self, path, slots=4096, slot_size=4096, ways=4, ttl=5.0,
+                 clock=time.time):
+        if fcntl is None:  # pragma: no cover
+            raise RuntimeError('a shared session cache needs fcntl')
+        if slots % ways:
+            raise ValueError('slots must be a multiple of ways')
+        if slot_size <= SLOT.size + MAX_KEY:
+            raise ValueError('slot_size must exceed %s bytes'
+                             % (SLOT.size + MAX_KEY))
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ways = ways
+        self.ttl = ttl
+        self.clock = clock
+        self.counters = Counters('hits', 'misses', 'evictions')
+        # fcntl locks belong to the process, so threads also need this
+        self._lock = threading.Lock()
+        self._size = HEADER_SIZE + slots * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._map = self._open()
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _open(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            header = os.read(self._fd, HEADER.size)
+            expected = HEADER.pack(MAGIC, self.slots, self.slot_size,
+                                   self.ways)
+            if header != expected:
+                # new file, or laid out differently: start afresh
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self._size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, expected)
+            return mmap.mmap(self._fd, self._size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _key(self, session_id):
+        key = session_id.encode('utf-8')
+        if len(key) > MAX_KEY:
+            raise ValueError('session id too long for the shared cache')
+        return key
+
+    def _set(self, key):
+        sets = self.slots // self.ways
+        first = (zlib.crc32(key) & 0xffffffff) % sets * self.ways
+        return [HEADER_SIZE + (first + way) * self.slot_size
+                for way in range(self.ways)]
+
+    def _read(self, offset, key):
+        # (cached at, expires at, value) of the slot if it holds ``key``
+        version, cached_at, expires_at, key_len, value_len, _ = \
+            SLOT.unpack_from(self._map, offset)
+        if version & 1 or key_len != len(key):
+            return None
+        start = offset + SLOT.size
+        if self._map[start:start + key_len] != key:
+            return None
+        value = self._map[start + key_len:start + key_len + value_len]
+        if SLOT.unpack_from(self._map, offset)[0] != version:
+            # overwritten while being copied
+            return None
+        return cached_at, expires_at, value
+
+    def get(self, session_id, ttl=None):
+        """
+        Return ``(cached_at, document)`` for ``session_id``, or ``None`` when
+        it is not cached, older than ``ttl`` (default: the cache's) or the
+        session has expired.
+        """
+        key = self._key(session_id)
+        now = self.clock()
+        if ttl is None:
+            ttl = self.ttl
+        for offset in self._set(key):
+            found = self._read(offset, key)
+            if found is None:
+                continue
+            cached_at, expires_at, value = found
+            if now - cached_at >= ttl or (expires_at and expires_at <= now):
+                break
+            # reference bit, for the clock
+            struct.pack_into('<B', self._map, offset + REF, 1)
+            self.counters.incr('hits')
+            return cached_at, cPickle.loads(value)
+        self.counters.incr('misses')
+        return None
+
+    @contextlib.contextmanager
+    def _locked(self, offsets):
+        # lock the contiguous slots at ``offsets`` against other writers
+        length = len(offsets) * self.slot_size
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offsets[0])
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offsets[0])
+
+    def _write(self, offset, cached_at=0.0, expires_at=0.0, key=b'',
+               value=b''):
+        version = SLOT.unpack_from(self._map, offset)[0]
+        # odd while the slot is inconsistent
+        struct.pack_into('<Q', self._map, offset, version + 1)
+        start = offset + SLOT.size
+        self._map[start:start + len(key) + len(value)] = key + value
+        SLOT.pack_into(self._map, offset, version + 1, cached_at, expires_at,
+                       len(key), len(value), 0)
+        struct.pack_into('<Q', self._map, offset, version + 2)
+
+    def put(self, session_id, document, cached_at=None):
+        """Cache ``document`` for ``session_id``."""
+        key = self._key(session_id)
+        value = cPickle.dumps(document, 2)
+        fits = SLOT.size + len(key) + len(value) <= self.slot_size
+        offsets = self._set(key)
+        with self._locked(offsets):
+            slot = None
+            for offset in offsets:
+                if self._read(offset, key) is not None:
+                    slot = offset
+                    break
+            if not fits:
+                # an older copy must not outlive this write
+                if slot is not None:
+                    self._write(slot)
+                return
+            evicted = False
+            if slot is None:
+                slot = self._victim(offsets)
+                evicted = SLOT.unpack_from(self._map, slot)[3] != 0
+            self._write(slot, cached_at or self.clock(),
+                        document.get('expires_at') or 0.0, key, value)
+        if evicted:
+            self.counters.incr('evictions')
+
+    def _victim(self, offsets):
+        for offset in offsets:
+            if SLOT.unpack_from(self._map, offset)[3] == 0:
+                return offset
+        # second chance: the first slot not referenced since the last sweep
+        for offset in offsets:
+            if not struct.unpack_from('<B', self._map, offset + REF)[0]:
+                return offset
+            struct.pack_into('<B', self._map, offset + REF, 0)
+        return offsets[0]
+
+    def discard(self, session_id):
+        key = self._key(session_id)
+        offsets = self._set(key)
+        with self._locked(offsets):
+            for offset in offsets:
+                if self._read(offset, key) is not None:
+                    self._write(offset)
+
+    def clear(self):
+        offsets = [HEADER_SIZE + i * self.slot_size
+                   for i in range(self.slots)]
+        with self._locked(offsets):
+            for offset in offsets:
+                if SLOT.unpack_from(self._map, offset)[3]:
+                    self._write(offset)
+
+    def stats(self):
+        """Hit, miss and eviction counts of this process."""
+        return self.counters.snapshot()
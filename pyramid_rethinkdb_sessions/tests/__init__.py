@@ -12,6 +12,10 @@ class DummySession(object):
         self.serialize = serialize
         self.managed_dict = {}
         self.created = float()
+        self.refreshed = 0
+
+    def refresh(self):
+        self.refreshed += 1
 
     def to_redis(self):
         return self.serialize({
@@ -86,3 +90,496 @@ class DummyPipeline(object):
 
     def execute(self):
         pass
+
+
+def _term_name(term):
+    from rethinkdb import ql2_pb2
+    types = ql2_pb2.Term.TermType
+    for name in dir(types):
+        if name.isupper() and getattr(types, name) == term.tt:
+            return name
+    raise NotImplementedError(term.tt)
+
+
+class _Literal(object):
+    def __init__(self, *value):
+        self.value = value
+
+
+class DummyConnection(object):
+    """
+    A stand-in for a RethinkDB connection which evaluates the small subset of
+    ReQL used by this package against in-memory tables, and counts the number
+    of queries sent (``round_trips``) so tests can assert on them.
+    """
+    def __init__(self, db='rsessions', tables=('pyramid_sessions',),
+                 host='localhost', port=28015, now=None):
+        import time
+        self.db = db
+        self.host = host
+        self.port = port
+        self.dbs = {db: dict((name, {}) for name in tables)}
+        self.indexes = {}
+        self.round_trips = 0
+        self.queries = []
+        self.closed = False
+        self.clock = now or time.time
+        # changes delivered to ``changes()`` feeds; ``None`` drops the feed
+        try:
+            import queue
+        except ImportError:  # Python 2
+            import Queue as queue
+        self.changefeed = queue.Queue()
+
+    # connection API
+    def is_open(self):
+        return not self.closed
+
+    def close(self, noreply_wait=True):
+        self.closed = True
+        # wakes a changefeed waiting for changes
+        self.changefeed.put(None)
+
+    def reconnect(self, noreply_wait=True, timeout=None):
+        self.closed = False
+        return self
+
+    def _start(self, term, **global_optargs):
+        import rethinkdb as r
+        if self.closed:
+            raise r.ReqlDriverError('Connection is closed.')
+        self.round_trips += 1
+        self.queries.append((term, global_optargs))
+        result = self._eval(term, {})
+        if global_optargs.get('noreply'):
+            return None
+        return result
+
+    # helpers for tests
+    def table(self, name='pyramid_sessions', db=None):
+        return self.dbs[db or self.db][name]
+
+    # evaluator
+    def _eval(self, term, scope):
+        from rethinkdb import ast
+        if isinstance(term, ast.Datum):
+            return term.data
+        if isinstance(term, ast.Binary) and not term._args:
+            import base64
+            return base64.b64decode(term.base64_data)
+        name = _term_name(term)
+        handler = getattr(self, '_t_' + name.lower(), None)
+        if handler is None:
+            raise NotImplementedError(name)
+        return handler(term, scope)
+
+    def _args(self, term, scope):
+        return [self._eval(a, scope) for a in term._args]
+
+    def _opt(self, term, key, scope, default=None):
+        if key in term.optargs:
+            return self._eval(term.optargs[key], scope)
+        return default
+
+    def _t_make_array(self, term, scope):
+        return self._args(term, scope)
+
+    def _t_make_obj(self, term, scope):
+        return dict((k, self._eval(v, scope))
+                    for k, v in term.optargs.items())
+
+    def _t_binary(self, term, scope):
+        return self._args(term, scope)[0]
+
+    def _t_literal(self, term, scope):
+        return _Literal(*self._args(term, scope))
+
+    def _t_var(self, term, scope):
+        return scope[self._eval(term._args[0], scope)]
+
+    def _t_func(self, term, scope):
+        var_ids = self._eval(term._args[0], scope)
+        body = term._args[1]
+
+        def call(*values):
+            inner = dict(scope)
+            inner.update(zip(var_ids, values))
+            return self._eval(body, inner)
+        return call
+
+    def _t_funcall(self, term, scope):
+        func = self._eval(term._args[0], scope)
+        return func(*[self._eval(a, scope) for a in term._args[1:]])
+
+    def _t_branch(self, term, scope):
+        args = term._args
+        for i in range(0, len(args) - 1, 2):
+            if self._eval(args[i], scope) not in (None, False):
+                return self._eval(args[i + 1], scope)
+        return self._eval(args[-1], scope)
+
+    def _t_default(self, term, scope):
+        try:
+            value = self._eval(term._args[0], scope)
+        except (KeyError, IndexError, TypeError):
+            value = None
+        if value is None:
+            return self._eval(term._args[1], scope)
+        return value
+
+    def _t_eq(self, term, scope):
+        a, b = self._args(term, scope)
+        return a == b
+
+    def _t_ne(self, term, scope):
+        a, b = self._args(term, scope)
+        return a != b
+
+    def _t_lt(self, term, scope):
+        a, b = self._args(term, scope)
+        return a < b
+
+    def _t_le(self, term, scope):
+        a, b = self._args(term, scope)
+        return a <= b
+
+    def _t_gt(self, term, scope):
+        a, b = self._args(term, scope)
+        return a > b
+
+    def _t_ge(self, term, scope):
+        a, b = self._args(term, scope)
+        return a >= b
+
+    def _t_add(self, term, scope):
+        args = self._args(term, scope)
+        total = args[0]
+        for arg in args[1:]:
+            total = total + arg
+        return total
+
+    def _t_sub(self, term, scope):
+        a, b = self._args(term, scope)
+        return a - b
+
+    def _t_or(self, term, scope):
+        for arg in term._args:
+            value = self._eval(arg, scope)
+            if value not in (None, False):
+                return value
+        return False
+
+    def _t_and(self, term, scope):
+        value = True
+        for arg in term._args:
+            value = self._eval(arg, scope)
+            if value in (None, False):
+                return False
+        return value
+
+    def _t_not(self, term, scope):
+        return self._args(term, scope)[0] in (None, False)
+
+    def _t_now(self, term, scope):
+        return self.clock()
+
+    def _t_to_epoch_time(self, term, scope):
+        return self._args(term, scope)[0]
+
+    def _t_minval(self, term, scope):
+        return float('-inf')
+
+    def _t_maxval(self, term, scope):
+        return float('inf')
+
+    def _t_bracket(self, term, scope):
+        value, key = self._args(term, scope)
+        if value is None:
+            raise KeyError(key)
+        return value[key]
+
+    _t_get_field = _t_bracket
+    _t_nth = _t_bracket
+
+    def _t_count(self, term, scope):
+        return len(self._rows(term._args[0], scope))
+
+    def _t_is_empty(self, term, scope):
+        return not self._rows(term._args[0], scope)
+
+    def _t_without(self, term, scope):
+        value = self._eval(term._args[0], scope)
+        fields = [self._eval(a, scope) for a in term._args[1:]]
+        return dict((k, v) for k, v in value.items() if k not in fields)
+
+    # databases and tables
+    def _t_db(self, term, scope):
+        return ('db', self._eval(term._args[0], scope))
+
+    def _t_db_list(self, term, scope):
+        return list(self.dbs)
+
+    def _t_db_create(self, term, scope):
+        import rethinkdb as r
+        name = self._eval(term._args[0], scope)
+        if name in self.dbs:
+            raise r.ReqlOpFailedError('Database `%s` already exists.' % name)
+        self.dbs[name] = {}
+        return {'dbs_created': 1}
+
+    def _db_name(self, term, scope):
+        if term._args and len(term._args) > 0:
+            from rethinkdb import ast
+            if isinstance(term._args[0], ast.DB):
+                return self._eval(term._args[0], scope)[1]
+        return self.db
+
+    def _t_table_list(self, term, scope):
+        return list(self.dbs[self._db_name(term, scope)])
+
+    _t_table_list_tl = _t_table_list
+
+    def _t_table_create(self, term, scope):
+        import rethinkdb as r
+        from rethinkdb import ast
+        db = self._db_name(term, scope)
+        args = term._args[1:] if isinstance(term._args[0], ast.DB) \
+            else term._args
+        name = self._eval(args[0], scope)
+        if name in self.dbs[db]:
+            raise r.ReqlOpFailedError('Table `%s` already exists.' % name)
+        self.dbs[db][name] = {}
+        return {'tables_created': 1}
+
+    _t_table_create_tl = _t_table_create
+
+    def _t_table_drop(self, term, scope):
+        from rethinkdb import ast
+        db = self._db_name(term, scope)
+        args = term._args[1:] if isinstance(term._args[0], ast.DB) \
+            else term._args
+        name = self._eval(args[0], scope)
+        del self.dbs[db][name]
+        self.indexes.pop((db, name), None)
+        return {'tables_dropped': 1}
+
+    _t_table_drop_tl = _t_table_drop
+
+    def _t_table(self, term, scope):
+        import rethinkdb as r
+        from rethinkdb import ast
+        if isinstance(term._args[0], ast.DB):
+            db = self._eval(term._args[0], scope)[1]
+            name = self._eval(term._args[1], scope)
+        else:
+            db = self.db
+            name = self._eval(term._args[0], scope)
+        if db not in self.dbs or name not in self.dbs[db]:
+            raise r.ReqlOpFailedError(
+                'Table `%s.%s` does not exist.' % (db, name))
+        return ('table', db, name)
+
+    def _t_index_list(self, term, scope):
+        _, db, name = self._eval(term._args[0], scope)
+        return sorted(self.indexes.get((db, name), ()))
+
+    def _t_index_create(self, term, scope):
+        import rethinkdb as r
+        _, db, name = self._eval(term._args[0], scope)
+        index = self._eval(term._args[1], scope)
+        indexes = self.indexes.setdefault((db, name), set())
+        if index in indexes:
+            raise r.ReqlOpFailedError('Index `%s` already exists.' % index)
+        indexes.add(index)
+        return {'created': 1}
+
+    def _t_index_wait(self, term, scope):
+        _, db, name = self._eval(term._args[0], scope)
+        return [{'index': i, 'ready': True}
+                for i in sorted(self.indexes.get((db, name), ()))]
+
+    def _t_wait(self, term, scope):
+        self._eval(term._args[0], scope)
+        return {'ready': 1}
+
+    def _t_info(self, term, scope):
+        return self._eval(term._args[0], scope)
+
+    # selections
+    def _rows(self, term, scope):
+        """Return a list of ``(table, key)`` pairs for a selection term."""
+        name = _term_name(term)
+        if name == 'TABLE':
+            _, db, table = self._eval(term, scope)
+            return [(self.dbs[db][table], k)
+                    for k in sorted(self.dbs[db][table])]
+        if name == 'GET':
+            _, db, table = self._eval(term._args[0], scope)
+            key = self._eval(term._args[1], scope)
+            return [(self.dbs[db][table], key)]
+        if name == 'BETWEEN':
+            rows = self._rows(term._args[0], scope)
+            lower = self._eval(term._args[1], scope)
+            upper = self._eval(term._args[2], scope)
+            index = self._opt(term, 'index', scope, 'id')
+            selected = []
+            for table, key in rows:
+                value = table[key].get(index) if index != 'id' else key
+                if value is not None and lower <= value < upper:
+                    selected.append((value, table, key))
+            selected.sort(key=lambda item: item[0])
+            return [(table, key) for _, table, key in selected]
+        if name == 'LIMIT':
+            rows = self._rows(term._args[0], scope)
+            return rows[:self._eval(term._args[1], scope)]
+        if name == 'FILTER':
+            rows = self._rows(term._args[0], scope)
+            predicate = self._eval(term._args[1], scope)
+            return [(t, k) for t, k in rows if predicate(t[k])]
+        # plain sequences of documents are not selections
+        return list(self._eval(term, scope))
+
+    def _t_get(self, term, scope):
+        table, key = self._rows(term, scope)[0]
+        return table.get(key)
+
+    def _t_between(self, term, scope):
+        return [t[k] for t, k in self._rows(term, scope)]
+
+    _t_limit = _t_between
+
+    def _is_selection(self, term):
+        name = _term_name(term)
+        if name == 'TABLE':
+            return True
+        return name in ('BETWEEN', 'LIMIT', 'FILTER') and \
+            self._is_selection(term._args[0])
+
+    def _t_filter(self, term, scope):
+        if self._is_selection(term):
+            return self._t_between(term, scope)
+        predicate = self._eval(term._args[1], scope)
+        return [v for v in self._eval(term._args[0], scope)
+                if predicate(v) not in (None, False)]
+
+    def _t_map(self, term, scope):
+        func = self._eval(term._args[1], scope)
+        values = self._eval(term._args[0], scope)
+        if not isinstance(values, list):
+            # a changefeed
+            return (func(v) for v in values)
+        return [func(v) for v in values]
+
+    def _t_changes(self, term, scope):
+        import rethinkdb as r
+        self._eval(term._args[0], scope)
+
+        def feed():
+            while True:
+                change = self.changefeed.get()
+                if change is None or self.closed:
+                    raise r.ReqlDriverError('Connection is closed.')
+                yield change
+        return feed()
+
+    def _t_contains(self, term, scope):
+        values, value = self._args(term, scope)
+        return value in values
+
+    def _t_merge(self, term, scope):
+        value, patch = self._args(term, scope)
+        if value is None:
+            raise TypeError('Cannot merge into null')
+        return self._merge(value, patch)
+
+    def _write_result(self, **counts):
+        result = dict(inserted=0, replaced=0, unchanged=0, deleted=0,
+                      skipped=0, errors=0)
+        result.update(counts)
+        return result
+
+    def _t_insert(self, term, scope):
+        _, db, name = self._eval(term._args[0], scope)
+        table = self.dbs[db][name]
+        docs = self._eval(term._args[1], scope)
+        if isinstance(docs, dict):
+            docs = [docs]
+        conflict = self._opt(term, 'conflict', scope, 'error')
+        return_changes = self._opt(term, 'return_changes', scope, False)
+        result = self._write_result(changes=[])
+        for doc in docs:
+            key = doc['id']
+            old = table.get(key)
+            if old is not None and conflict == 'error':
+                result['errors'] += 1
+                result['first_error'] = (
+                    'Duplicate primary key `id`:\n%r' % key)
+                continue
+            table[key] = dict(doc)
+            result['replaced' if old is not None else 'inserted'] += 1
+            result['changes'].append({'old_val': old, 'new_val': table[key]})
+        if not return_changes:
+            del result['changes']
+        return result
+
+    def _t_replace(self, term, scope):
+        rows = self._rows(term._args[0], scope)
+        value = self._eval(term._args[1], scope)
+        result = self._write_result()
+        for table, key in rows:
+            old = table.get(key)
+            new = value(old) if callable(value) else value
+            if new is None:
+                if old is not None:
+                    del table[key]
+                    result['deleted'] += 1
+                else:
+                    result['skipped'] += 1
+            elif new == old:
+                result['unchanged'] += 1
+            else:
+                table[key] = dict(new)
+                result['replaced' if old is not None else 'inserted'] += 1
+        return result
+
+    def _merge(self, old, patch):
+        merged = dict(old)
+        for key, value in patch.items():
+            if isinstance(value, _Literal):
+                if value.value:
+                    merged[key] = value.value[0]
+                else:
+                    merged.pop(key, None)
+            elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+                merged[key] = self._merge(merged[key], value)
+            else:
+                merged[key] = value
+        return merged
+
+    def _t_update(self, term, scope):
+        rows = self._rows(term._args[0], scope)
+        value = self._eval(term._args[1], scope)
+        result = self._write_result()
+        for table, key in rows:
+            old = table.get(key)
+            if old is None:
+                result['skipped'] += 1
+                continue
+            patch = value(old) if callable(value) else value
+            new = self._merge(old, patch)
+            if new == old:
+                result['unchanged'] += 1
+            else:
+                table[key] = new
+                result['replaced'] += 1
+        return result
+
+    def _t_delete(self, term, scope):
+        rows = self._rows(term._args[0], scope)
+        result = self._write_result()
+        for table, key in rows:
+            if table.pop(key, None) is not None:
+                result['deleted'] += 1
+            else:
+                result['skipped'] += 1
+        return result
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import unittest
+
+from . import DummyConnection
+
+
+class AsyncDummyConnection(DummyConnection):
+    def _start(self, term, **global_optargs):
+        import asyncio
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(DummyConnection._start(self, term, **global_optargs))
+        return future
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio backend needs 3.5+')
+class TestAsyncRethinkDBSession(unittest.TestCase):
+    def setUp(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.conn = AsyncDummyConnection()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def _load(self, session_id=None, **kw):
+        from ..aio import AsyncRethinkDBSession
+        return self._run(AsyncRethinkDBSession.load(self.conn, session_id,
+                                                    **kw))
+
+    def test_new_session_is_not_stored_until_flushed_with_data(self):
+        session = self._load('missing')
+        self.assertTrue(session.new)
+        self.assertNotEqual(session.session_id, 'missing')
+        self.assertFalse(self._run(session.flush()))
+        self.assertEqual(self.conn.table(), {})
+        session['a'] = 1
+        self.assertTrue(self._run(session.flush()))
+        self.assertIn(session.session_id, self.conn.table())
+
+    def test_mutations_are_written_once(self):
+        session = self._load()
+        session['a'] = 1
+        session.update({'b': 2, 'c': 3})
+        del session['c']
+        before = self.conn.round_trips
+        self._run(session.flush())
+        self.assertEqual(self.conn.round_trips - before, 1)
+        loaded = self._load(session.session_id)
+        self.assertFalse(loaded.new)
+        self.assertEqual(dict(loaded), {'a': 1, 'b': 2})
+
+    def test_reads_sync_session_documents(self):
+        from ..compat import cPickle
+        from ..util import session_document
+        payload = cPickle.dumps({'managed_dict': {'user': 'bob'},
+                                 'created': 1.0, 'timeout': 60})
+        document = session_document('sid', 60, payload)
+        document['payload'] = payload
+        document['expires_at'] = self.conn.clock() + 60
+        self.conn.table()['sid'] = document
+        session = self._load('sid')
+        self.assertEqual(session['user'], 'bob')
+        self.assertEqual(session.timeout, 60)
+
+    def test_invalidate(self):
+        session = self._load()
+        session['a'] = 1
+        self._run(session.flush())
+        old_id = session.session_id
+        self._run(session.invalidate())
+        self.assertNotIn(old_id, self.conn.table())
+        self.assertNotEqual(session.session_id, old_id)
+        self.assertEqual(dict(session), {})
+
+    def test_flash(self):
+        session = self._load()
+        session.flash('hello')
+        session.flash('hello', allow_duplicate=False)
+        self.assertEqual(session.peek_flash(), ['hello'])
+        self.assertEqual(session.pop_flash(), ['hello'])
+        self.assertEqual(session.peek_flash(), [])
+
+    def test_taken_id_is_retried(self):
+        ids = iter(['taken', 'free'])
+        session = self._load(generator=lambda: next(ids))
+        self.conn.table()['taken'] = {'id': 'taken'}
+        session['a'] = 1
+        self.assertTrue(self._run(session.flush()))
+        self.assertEqual(session.session_id, 'free')
+        self.assertEqual(self.conn.table()['taken'], {'id': 'taken'})
+
+    def test_other_insert_errors_are_raised(self):
+        import rethinkdb as r
+        attempts = []
+
+        class FailingConnection(AsyncDummyConnection):
+            def _t_insert(self, term, scope):
+                attempts.append(1)
+                return self._write_result(errors=1, first_error=(
+                    'Cannot perform write: primary replica not available'))
+        self.conn = FailingConnection()
+        session = self._load()
+        session['a'] = 1
+        self.assertRaises(r.ReqlOpFailedError, self._run, session.flush())
+        self.assertEqual(len(attempts), 1)
+
+    def test_connect_fails_over_between_hosts(self):
+        import rethinkdb as r
+        from ..aio import _connect_selected
+        from ..cluster import HostSelector
+        selector = HostSelector([('db1', 1), ('db2', 2)])
+        attempts = []
+
+        async def open_connection(host, port):
+            attempts.append(host)
+            if host == 'db1':
+                raise r.ReqlDriverError('down')
+            return host
+        self.assertEqual(
+            self._run(_connect_selected(selector, open_connection)), 'db2')
+        self.assertEqual(attempts, ['db1', 'db2'])
+        self.assertEqual(selector.stats()['db1:1']['failures'], 1)
+
+    def test_pool_shares_connections(self):
+        from ..aio import AsyncConnectionPool
+        opened = []
+
+        async def connect():
+            conn = AsyncDummyConnection()
+            opened.append(conn)
+            return conn
+        pool = AsyncConnectionPool(connect, size=2)
+        conns = [self._run(pool.get()) for _ in range(4)]
+        self.assertEqual(len(opened), 2)
+        self.assertIs(conns[0], conns[2])
+        conns[0].closed = True
+        self.assertIsNot(self._run(pool.get()), conns[0])
+
+    def test_loading_asyncio_driver_keeps_sync_connections(self):
+        import rethinkdb.net
+        from ..aio import _get_asyncio_connection_type
+        sync_type = rethinkdb.net.connection_type
+        asyncio_type = _get_asyncio_connection_type()
+        self.assertIsNot(asyncio_type, sync_type)
+        self.assertIs(rethinkdb.net.connection_type, sync_type)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import unittest
+
+from . import DummyConnection
+
+# start of window 10 with hourly tables
+NOW = 36000.0
+
+
+class TestSessionBuckets(unittest.TestCase):
+    def setUp(self):
+        self.now = NOW + 100
+        self.conn = DummyConnection(now=lambda: self.now)
+
+    def _makeOne(self, interval=3600, timeout=1200, **kw):
+        from ..buckets import SessionBuckets
+        return SessionBuckets(interval, timeout, clock=lambda: self.now, **kw)
+
+    def _store(self, table, session_id, expires_at=None):
+        self.conn.dbs[self.conn.db].setdefault(table, {})[session_id] = {
+            'id': session_id,
+            'expires_at': expires_at or self.now + 600,
+        }
+
+    def test_rejects_bad_interval(self):
+        self.assertRaises(ValueError, self._makeOne, interval=0)
+
+    def test_table_names(self):
+        buckets = self._makeOne()
+        self.assertEqual(buckets.current(), 'pyramid_sessions_10')
+        self.assertEqual(buckets.bucket_of('pyramid_sessions_10'), 10)
+        self.assertEqual(buckets.bucket_of('pyramid_sessions'), None)
+        self.assertEqual(buckets.bucket_of('pyramid_sessions_x'), None)
+
+    def test_candidates_newest_first(self):
+        buckets = self._makeOne()
+        self.assertEqual(buckets.candidates(),
+                         ['pyramid_sessions_10', 'pyramid_sessions_9'])
+        # later in the window the previous table can no longer hold live
+        # sessions
+        self.assertEqual(buckets.candidates(NOW + 2000),
+                         ['pyramid_sessions_10'])
+
+    def test_lookup_finds_session_in_older_table(self):
+        from ..buckets import TABLE_FIELD
+        buckets = self._makeOne()
+        buckets.rotate(self.conn)
+        self._store('pyramid_sessions_9', 'sid')
+        trips = self.conn.round_trips
+        document = buckets.lookup('sid').run(self.conn)
+        self.assertEqual(document['id'], 'sid')
+        self.assertEqual(document[TABLE_FIELD], 'pyramid_sessions_9')
+        self.assertEqual(self.conn.round_trips, trips + 1)
+
+    def test_lookup_does_not_list_tables(self):
+        from . import _term_name
+
+        def names(term):
+            # every term in the query; datums have no term type
+            if hasattr(term, 'tt'):
+                yield _term_name(term)
+            for arg in list(term._args) + list(term.optargs.values()):
+                for name in names(arg):
+                    yield name
+        query = self._makeOne().lookup('sid')
+        self.assertIn('TABLE', set(names(query)))
+        self.assertNotIn('TABLE_LIST', set(names(query)))
+
+    def test_lookup_prefers_newest_table(self):
+        from ..buckets import TABLE_FIELD
+        self._makeOne().rotate(self.conn)
+        self._store('pyramid_sessions_9', 'sid')
+        self._store('pyramid_sessions_10', 'sid')
+        document = self._makeOne().lookup('sid').run(self.conn)
+        self.assertEqual(document[TABLE_FIELD], 'pyramid_sessions_10')
+
+    def test_lookup_missing_or_expired(self):
+        buckets = self._makeOne()
+        buckets.rotate(self.conn)
+        self.assertEqual(buckets.lookup('sid').run(self.conn), None)
+        self._store('pyramid_sessions_10', 'sid', expires_at=self.now - 1)
+        self.assertEqual(buckets.lookup('sid').run(self.conn), None)
+
+    def test_rotate_creates_tables_still_looked_up(self):
+        # on a first run the previous window's table may hold live sessions
+        # by the time the next request looks
+        result = self._makeOne().rotate(self.conn)
+        self.assertEqual(result['created'], [
+            'pyramid_sessions_9', 'pyramid_sessions_10',
+            'pyramid_sessions_11'])
+
+    def test_rotate(self):
+        buckets = self._makeOne()
+        self._store('pyramid_sessions_8', 'old')
+        self._store('pyramid_sessions_9', 'live')
+        result = buckets.rotate(self.conn)
+        self.assertEqual(result['created'],
+                         ['pyramid_sessions_10', 'pyramid_sessions_11'])
+        self.assertEqual(result['dropped'], ['pyramid_sessions_8'])
+        self.assertEqual(sorted(self.conn.dbs[self.conn.db]), [
+            'pyramid_sessions', 'pyramid_sessions_10', 'pyramid_sessions_11',
+            'pyramid_sessions_9'])
+        # nothing left to do
+        result = buckets.rotate(self.conn)
+        self.assertEqual(result, {'created': [], 'dropped': []})
+
+
+class TestBucketedSession(unittest.TestCase):
+    def setUp(self):
+        from ..buckets import SessionBuckets
+        self.now = NOW + 100
+        self.conn = DummyConnection(now=lambda: self.now)
+        self.buckets = SessionBuckets(3600, 1200, clock=lambda: self.now)
+        self.buckets.rotate(self.conn)
+
+    def _makeOne(self, session_id=None, **kw):
+        from ..compat import cPickle
+        from ..session import RethinkDBSession
+        from ..util import get_unique_session_id
+        new_session = functools.partial(
+            get_unique_session_id, conn=self.conn, timeout=1200,
+            serialize=cPickle.dumps)
+        persisted = None
+        if session_id is not None:
+            persisted = self.buckets.lookup(session_id).run(self.conn)
+        return RethinkDBSession(
+            self.conn, session_id, session_id is None, new_session,
+            persisted=persisted, buckets=self.buckets, **kw)
+
+    def _tables(self):
+        return self.conn.dbs[self.conn.db]
+
+    def _store(self, table, **kw):
+        session = self._makeOne(**kw)
+        session['a'] = 1
+        session.flush()
+        session_id = session.session_id
+        # as if it had been written an hour ago
+        document = self._tables()['pyramid_sessions_10'].pop(session_id)
+        self._tables()[table] = {session_id: document}
+        return session_id
+
+    def test_new_session_goes_to_current_table(self):
+        session = self._makeOne()
+        session['a'] = 1
+        session.flush()
+        self.assertIn(session.session_id, self._tables()['pyramid_sessions_10'])
+        self.assertEqual(self._tables()['pyramid_sessions'], {})
+
+    def test_write_moves_session_to_current_table(self):
+        session_id = self._store('pyramid_sessions_9')
+        session = self._makeOne(session_id)
+        self.assertEqual(session['a'], 1)
+        session['a'] = 2
+        session.flush()
+        self.assertNotIn(session_id, self._tables()['pyramid_sessions_9'])
+        self.assertIn(session_id, self._tables()['pyramid_sessions_10'])
+        self.assertEqual(self._makeOne(session_id)['a'], 2)
+
+    def test_touch_moves_session_to_current_table(self):
+        session_id = self._store('pyramid_sessions_9')
+        session = self._makeOne(session_id, refresh_fraction=0)
+        session.refresh()
+        session.flush()
+        self.assertNotIn(session_id, self._tables()['pyramid_sessions_9'])
+        document = self._tables()['pyramid_sessions_10'][session_id]
+        self.assertEqual(document['expires_at'], self.now + 1200)
+        self.assertEqual(self._makeOne(session_id)['a'], 1)
+
+    def test_field_update_moves_session_to_current_table(self):
+        session_id = self._store('pyramid_sessions_9', field_storage=True)
+        session = self._makeOne(session_id, field_storage=True)
+        session['b'] = 2
+        session.flush()
+        self.assertNotIn(session_id, self._tables()['pyramid_sessions_9'])
+        session = self._makeOne(session_id)
+        self.assertEqual((session['a'], session['b']), (1, 2))
+
+    def test_field_update_of_dropped_session_writes_it_whole(self):
+        session_id = self._store('pyramid_sessions_9', field_storage=True)
+        session = self._makeOne(session_id, field_storage=True)
+        self._tables()['pyramid_sessions_9'].clear()
+        session['b'] = 2
+        self.assertTrue(session.flush())
+        self.assertIn(session_id, self._tables()['pyramid_sessions_10'])
+        session = self._makeOne(session_id)
+        self.assertEqual((session['a'], session['b']), (1, 2))
+
+    def test_invalidate_deletes_from_its_table(self):
+        session_id = self._store('pyramid_sessions_9')
+        self._makeOne(session_id).invalidate()
+        self.assertEqual(self._tables()['pyramid_sessions_9'], {})
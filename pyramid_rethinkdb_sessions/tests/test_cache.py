@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+
+class TestSessionCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+
+    def _makeOne(self, **kw):
+        from ..cache import SessionCache
+        return SessionCache(clock=lambda: self.now, **kw)
+
+    def _document(self, session_id, payload=b'x', **kw):
+        return dict(kw, id=session_id, payload=payload)
+
+    def test_get_put(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.get('a'), None)
+        document = self._document('a')
+        cache.put('a', document)
+        self.assertIs(cache.get('a'), document)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['entries'], 1)
+
+    def test_ttl(self):
+        cache = self._makeOne(ttl=5)
+        cache.put('a', self._document('a'))
+        self.now += 5
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_expired_session_not_served(self):
+        cache = self._makeOne()
+        cache.put('a', self._document('a', expires_at=self.now + 1))
+        self.now += 1
+        self.assertEqual(cache.get('a'), None)
+
+    def test_evicts_least_recently_used(self):
+        cache = self._makeOne(max_entries=2)
+        cache.put('a', self._document('a'))
+        cache.put('b', self._document('b'))
+        cache.get('a')
+        cache.put('c', self._document('c'))
+        self.assertEqual(cache.get('b'), None)
+        self.assertNotEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_max_bytes(self):
+        from ..cache import document_size
+        size = document_size(self._document('a', b'x' * 100))
+        cache = self._makeOne(max_bytes=2 * size)
+        for key in 'abc':
+            cache.put(key, self._document(key, b'x' * 100))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['bytes'], 2 * size)
+        # too big to be cached at all
+        cache.put('d', self._document('d', b'x' * 1000))
+        self.assertEqual(cache.get('d'), None)
+
+    def test_field_documents_sized_by_payloads(self):
+        from ..cache import document_size, ENTRY_OVERHEAD
+        document = {'id': 'a', 'data': {'k': b'xx', 'kk': b'x'}}
+        self.assertEqual(document_size(document), ENTRY_OVERHEAD + 1 + 6)
+
+    def test_load(self):
+        cache = self._makeOne()
+        fetched = []
+
+        def fetch():
+            fetched.append(1)
+            return self._document('a')
+        cache.load('a', fetch)
+        cache.load('a', fetch)
+        self.assertEqual(len(fetched), 1)
+        self.assertEqual(cache.load('missing', lambda: None), None)
+        self.assertEqual(len(cache), 1)
+
+    def test_put_skipped_after_invalidation(self):
+        cache = self._makeOne()
+        generation = cache.generation
+        cache.discard('a')
+        cache.put('a', self._document('a'), generation)
+        self.assertEqual(len(cache), 0)
+        cache.put('a', self._document('a'), cache.generation)
+        self.assertEqual(len(cache), 1)
+
+    def test_put_not_skipped_after_invalidating_other_sessions(self):
+        cache = self._makeOne()
+        generation = cache.generation
+        cache.discard('other')
+        cache.changed('another', None)
+        cache.put('a', self._document('a'), generation)
+        self.assertEqual(len(cache), 1)
+
+    def test_put_skipped_after_write_through(self):
+        cache = self._makeOne()
+        generation = cache.generation
+        cache.put('a', self._document('a', b'new'))
+        # read before the write, so older than what was written through
+        cache.put('a', self._document('a', b'old'), generation)
+        self.assertEqual(cache.get('a')['payload'], b'new')
+
+    def test_put_skipped_once_invalidation_forgotten(self):
+        cache = self._makeOne(max_entries=2)
+        generation = cache.generation
+        for session_id in ('a', 'b', 'c'):
+            cache.discard(session_id)
+        # only the last two changed sessions are remembered
+        cache.put('x', self._document('x'), generation)
+        self.assertEqual(len(cache), 0)
+        cache.put('x', self._document('x'), cache.generation)
+        self.assertEqual(len(cache), 1)
+
+    def test_put_skipped_after_clear(self):
+        cache = self._makeOne()
+        generation = cache.generation
+        cache.clear()
+        cache.put('a', self._document('a'), generation)
+        self.assertEqual(len(cache), 0)
+
+    def test_changed_keeps_same_data(self):
+        cache = self._makeOne()
+        cache.put('a', self._document('a', expires_at=self.now + 10))
+        self.assertFalse(cache.changed(
+            'a', self._document('a', expires_at=self.now + 20)))
+        self.assertEqual(cache.get('a')['expires_at'], self.now + 20)
+
+    def test_changed_discards_other_data(self):
+        cache = self._makeOne()
+        cache.put('a', self._document('a'))
+        cache.put('b', self._document('b'))
+        self.assertTrue(cache.changed('a', self._document('a', b'y')))
+        self.assertTrue(cache.changed('b', None))
+        self.assertEqual(len(cache), 0)
+
+    def test_changed_compares_field_documents(self):
+        cache = self._makeOne()
+        document = {'id': 'a', 'created': 1.0, 'timeout': 60,
+                    'data': {'k': b'x'}}
+        cache.put('a', document)
+        self.assertFalse(cache.changed('a', dict(document)))
+        self.assertTrue(cache.changed(
+            'a', dict(document, data={'k': b'y'})))
+
+    def test_load_does_not_cache_document_invalidated_meanwhile(self):
+        cache = self._makeOne()
+
+        def fetch():
+            # a write elsewhere is seen while the document is being read
+            cache.discard('a')
+            return self._document('a')
+        self.assertNotEqual(cache.load('a', fetch), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_discard_and_clear(self):
+        cache = self._makeOne()
+        cache.put('a', self._document('a'))
+        cache.put('b', self._document('b'))
+        cache.discard('a')
+        self.assertEqual(cache.get('a'), None)
+        cache.clear()
+        self.assertEqual(cache.stats()['bytes'], 0)
+        self.assertEqual(len(cache), 0)
+
+
+class TestCacheInvalidator(unittest.TestCase):
+    def setUp(self):
+        from ..cache import SessionCache
+        self.cache = SessionCache(ttl=300)
+
+    def tearDown(self):
+        self.invalidator.stop(timeout=5)
+
+    def _connect(self):
+        from . import DummyConnection
+        self.conn = DummyConnection()
+        return self.conn
+
+    def _makeOne(self, **kw):
+        from ..cache import CacheInvalidator
+        self.invalidator = CacheInvalidator(
+            self.cache, self._connect, fallback_ttl=2, retry_interval=0.01,
+            **kw)
+        return self.invalidator
+
+    def _wait_for(self, condition):
+        import time
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.005)
+        self.assertTrue(condition())
+
+    def _document(self, session_id):
+        return {'id': session_id, 'payload': b'x'}
+
+    def test_evicts_changed_sessions(self):
+        invalidator = self._makeOne()
+        self.assertEqual(self.cache.ttl, 2)
+        self.cache.put('stale', self._document('stale'))
+        invalidator.start()
+        self._wait_for(lambda: invalidator.connected)
+        # cleared on subscribing, then trusted for the long TTL
+        self.assertEqual(self.cache.get('stale'), None)
+        self.assertEqual(self.cache.ttl, 300)
+
+        for session_id in ('a', 'b', 'c', 'd'):
+            self.cache.put(session_id, self._document(session_id))
+        self.conn.changefeed.put({'old_val': {'id': 'a'},
+                                  'new_val': {'id': 'a', 'payload': b'y'}})
+        self.conn.changefeed.put({'old_val': {'id': 'b'}, 'new_val': None})
+        # this process's own write of d coming back
+        self.conn.changefeed.put({'old_val': {'id': 'd'},
+                                  'new_val': self._document('d')})
+        self.conn.changefeed.put({'old_val': None,
+                                  'new_val': {'id': 'e', 'payload': b'x'}})
+        self._wait_for(lambda: invalidator.counters['invalidations'] == 3)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertNotEqual(self.cache.get('c'), None)
+        self.assertNotEqual(self.cache.get('d'), None)
+
+        invalidator.stop(timeout=5)
+        self.assertFalse(invalidator.connected)
+        self.assertEqual(self.cache.ttl, 2)
+
+    def test_resubscribes_after_feed_drops(self):
+        invalidator = self._makeOne()
+        invalidator.start()
+        self._wait_for(lambda: invalidator.connected)
+        self.cache.put('a', self._document('a'))
+        # the feed drops; changes may be missed until it is back, so the
+        # cache is cleared again on resubscribing
+        self.conn.changefeed.put(None)
+        self._wait_for(
+            lambda: invalidator.counters['subscriptions'] == 2)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.ttl, 300)
+
+    def test_resubscribing_leaves_shared_tier_alone(self):
+        cleared = []
+        self.cache.clear = lambda shared=True: cleared.append(shared)
+        invalidator = self._makeOne()
+        invalidator.start()
+        self._wait_for(lambda: invalidator.connected)
+        invalidator.stop(timeout=5)
+        self.assertEqual(cleared, [False])
+
+    def test_feed_uses_squashed_changes(self):
+        from . import _term_name
+        invalidator = self._makeOne()
+        changes = invalidator.feed()._args[0]
+        self.assertEqual(_term_name(changes), 'CHANGES')
+        self.assertIs(changes.optargs['squash'].data, True)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from . import DummyConnection
+
+
+class TestHostSelector(unittest.TestCase):
+    def _makeOne(self, hosts=(('db1', 1), ('db2', 2)), **kw):
+        from ..cluster import HostSelector
+        return HostSelector(list(hosts), **kw)
+
+    def _connector(self, down=()):
+        import rethinkdb as r
+        self.attempts = []
+
+        def connect(host, port, **options):
+            self.attempts.append(host)
+            if host in down:
+                raise r.ReqlDriverError('Could not connect to %s' % host)
+            return DummyConnection(host=host, port=port)
+        return connect
+
+    def test_connects_to_first_host(self):
+        inst = self._makeOne()
+        conn = inst.connect(self._connector())
+        self.assertEqual((conn.host, conn.port), ('db1', 1))
+
+    def test_fails_over_to_next_host(self):
+        inst = self._makeOne()
+        conn = inst.connect(self._connector(down=('db1',)))
+        self.assertEqual(conn.host, 'db2')
+        self.assertEqual(inst.stats()['db1:1']['failures'], 1)
+
+    def test_prefers_lowest_latency(self):
+        inst = self._makeOne()
+        db1, db2 = inst.nodes
+        inst.record_success(db1, 0.5)
+        inst.record_success(db2, 0.01)
+        conn = inst.connect(self._connector())
+        self.assertEqual(conn.host, 'db2')
+
+    def test_latency_is_a_moving_average(self):
+        inst = self._makeOne(latency_decay=0.5)
+        node = inst.nodes[0]
+        inst.record_success(node, 1.0)
+        inst.record_success(node, 0.0)
+        self.assertEqual(node.latency, 0.5)
+
+    def test_circuit_opens_after_threshold(self):
+        from ..cluster import NoHostAvailableError
+        inst = self._makeOne(hosts=[('db1', 1)], failure_threshold=2,
+                             backoff=60)
+        connect = self._connector(down=('db1',))
+        self.assertRaises(NoHostAvailableError, inst.connect, connect)
+        self.assertRaises(NoHostAvailableError, inst.connect, connect)
+        self.assertTrue(inst.stats()['db1:1']['open'])
+        # the open circuit fails fast without attempting to connect
+        self.assertRaises(NoHostAvailableError, inst.connect, connect)
+        self.assertEqual(self.attempts, ['db1', 'db1'])
+
+    def test_backoff_doubles(self):
+        inst = self._makeOne(hosts=[('db1', 1)], failure_threshold=1,
+                             backoff=1, max_backoff=3)
+        node = inst.nodes[0]
+        delays = []
+        for _ in range(4):
+            inst.record_failure(node)
+            delays.append(round(node.open_until - time.time()))
+        self.assertEqual(delays, [1, 2, 3, 3])
+
+    def test_half_open_node_is_probed_once(self):
+        inst = self._makeOne(hosts=[('db1', 1)], failure_threshold=1)
+        node = inst.nodes[0]
+        inst.record_failure(node)
+        node.open_until = 0
+        self.assertTrue(inst._claim(node))
+        self.assertFalse(inst._claim(node))
+        inst.record_success(node, 0.1)
+        self.assertTrue(inst._claim(node))
+        self.assertEqual(node.failures, 0)
+
+
+class Test_get_default_connection_pool(unittest.TestCase):
+    def setUp(self):
+        from ..connection import _selectors
+        _selectors.clear()
+
+    def test_multi_host_url_uses_selector(self):
+        from ..connection import get_default_connection_pool
+        from ..cluster import HostSelector
+        pool = get_default_connection_pool(
+            url='rethinkdb://admin@db1:1,db2:2/sessions', host='localhost')
+        selector = pool.connect.func.__self__
+        self.assertIsInstance(selector, HostSelector)
+        self.assertEqual([(n.host, n.port) for n in selector.nodes],
+                         [('db1', 1), ('db2', 2)])
+        self.assertNotIn('host', pool.connect.args[0].keywords)
+        self.assertEqual(pool.connect.args[0].keywords['db'], 'sessions')
+
+    def test_selector_shared_with_connect(self):
+        import rethinkdb as r
+        from .. import connection
+        pool = connection.get_default_connection_pool(
+            hosts=[('db1', 1), ('db2', 2)])
+        selector = pool.connect.func.__self__
+        self.assertIs(connection.host_selector([('db1', 1), ('db2', 2)]),
+                      selector)
+        attempts = []
+
+        def connect(host, port, **options):
+            attempts.append(host)
+            if host == 'db1':
+                raise r.ReqlDriverError('down')
+            return host
+        for _ in range(3):
+            selector.connect(connect)
+        # db1's circuit is open for scripts and the reaper too
+        original, connection.r.connect = connection.r.connect, connect
+        try:
+            del attempts[:]
+            connection.connect(hosts=[['db1', 1], ['db2', 2]])
+        finally:
+            connection.r.connect = original
+        self.assertEqual(attempts, ['db2'])
+
+    def test_single_host(self):
+        from ..connection import get_default_connection_pool
+        pool = get_default_connection_pool(host='db1', port=1)
+        self.assertEqual(pool.connect.keywords, {'host': 'db1', 'port': 1})
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+SESSION_ID = 'a' * 40
+
+
+class TestCookieCodec(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+
+    def _makeOne(self, secret='secret', **kw):
+        from ..cookie import CookieCodec
+        return CookieCodec(secret, clock=lambda: self.now, **kw)
+
+    def test_session_id_round_trip(self):
+        codec = self._makeOne()
+        cookieval = codec.encode_id(SESSION_ID)
+        cookie = codec.decode(cookieval)
+        self.assertEqual(cookie.session_id, SESSION_ID)
+        self.assertEqual(cookie.payload, None)
+        self.assertEqual(cookie.expires_at, 0)
+        # 5 header bytes, the id and a 16 byte MAC, base64url encoded
+        self.assertEqual(len(cookieval), 82)
+        self.assertTrue(all(c.isalnum() or c in '-_' for c in cookieval))
+
+    def test_session_round_trip(self):
+        codec = self._makeOne()
+        cookie = codec.decode(codec.encode_session(b'\x00data', 2000, True))
+        self.assertEqual(cookie.session_id, None)
+        self.assertEqual(cookie.payload, b'\x00data')
+        self.assertIs(cookie.compressed, True)
+        self.assertEqual(cookie.expires_at, 2000)
+
+    def test_expiry(self):
+        codec = self._makeOne()
+        cookieval = codec.encode_id(SESSION_ID, expires_at=1010)
+        self.assertNotEqual(codec.decode(cookieval), None)
+        self.now = 1010
+        self.assertEqual(codec.decode(cookieval), None)
+
+    def test_tampered(self):
+        import base64
+        codec = self._makeOne()
+        cookieval = codec.encode_id(SESSION_ID)
+        raw = bytearray(base64.urlsafe_b64decode(cookieval + '=='))
+        raw[5] ^= 1
+        tampered = base64.urlsafe_b64encode(bytes(raw)).decode('ascii')
+        self.assertEqual(codec.decode(tampered.rstrip('=')), None)
+        self.assertEqual(self._makeOne('other').decode(cookieval), None)
+
+    def test_malformed(self):
+        codec = self._makeOne()
+        for cookieval in ('', 'x', '!!!!', 'abc', u'€' * 30):
+            self.assertEqual(codec.decode(cookieval), None)
+
+    def test_rotation(self):
+        old = self._makeOne('old')
+        codec = self._makeOne('new', old_secrets=('old',))
+        cookie = codec.decode(old.encode_id(SESSION_ID))
+        self.assertEqual(cookie.session_id, SESSION_ID)
+        # new cookies are signed with the current secret only
+        self.assertEqual(old.decode(codec.encode_id(SESSION_ID)), None)
+
+    def test_mac_size(self):
+        codec = self._makeOne(mac_size=8)
+        cookieval = codec.encode_id(SESSION_ID)
+        self.assertEqual(len(cookieval), 71)
+        self.assertEqual(codec.decode(cookieval).session_id, SESSION_ID)
+        self.assertEqual(self._makeOne().decode(cookieval), None)
+        self.assertRaises(ValueError, self._makeOne, mac_size=4)
+
+    def test_verified_cookies_cached(self):
+        codec = self._makeOne(cache_size=1)
+        calls = []
+        verify = codec._verify
+
+        def counting_verify(cookieval):
+            calls.append(cookieval)
+            return verify(cookieval)
+        codec._verify = counting_verify
+        first = codec.encode_id('first', expires_at=1010)
+        second = codec.encode_id('second')
+        codec.decode(first)
+        codec.decode(first)
+        self.assertEqual(len(calls), 1)
+        codec.decode(second)
+        codec.decode(first)
+        self.assertEqual(len(calls), 3)
+        # expiry is still checked on cached cookies
+        self.now = 1010
+        self.assertEqual(codec.decode(first), None)
+        # invalid cookies are not cached
+        codec.decode('bogus')
+        codec.decode('bogus')
+        self.assertEqual(calls.count('bogus'), 2)
@@ -486,3 +486,755 @@ class TestRedisSessionFactory(unittest.TestCase):
                     'redis.sessions.timeout': '999'}
         inst = session_factory_from_settings(settings)(request)
         self.assertEqual(inst.timeout, 999)
+
+
+class TestRethinkSessionFactory(unittest.TestCase):
+    def _makeFactory(self, secret='secret', **kw):
+        from .. import RethinkSessionFactory
+        from ..pool import ConnectionPool
+        from . import DummyConnection
+        self.conn = DummyConnection()
+        kw.setdefault('connection_pool', ConnectionPool(lambda: self.conn))
+        return RethinkSessionFactory(secret, **kw)
+
+    def _make_request(self):
+        request = testing.DummyRequest()
+        request.exception = None
+        return request
+
+    def _set_session_cookie(self, request, session_id, cookie_name='session',
+                            secret='secret'):
+        from ..cookie import CookieCodec
+        request.cookies[cookie_name] = CookieCodec(secret).encode_id(
+            session_id)
+
+    def test_connection_released_when_request_finishes(self):
+        factory = self._makeFactory()
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        factory(request).get('a')
+        pool = factory.connection_pool
+        self.assertEqual(pool.stats()['in_use'], 1)
+        request._process_finished_callbacks()
+        self.assertEqual(pool.stats()['in_use'], 0)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def test_builds_pool_from_options(self):
+        from .. import RethinkSessionFactory
+        factory = RethinkSessionFactory('secret', pool_size=3,
+                                        pool_wait_timeout=1.5,
+                                        socket_timeout=2.0)
+        pool = factory.connection_pool
+        self.assertEqual(pool.max_size, 3)
+        self.assertEqual(pool.wait_timeout, 1.5)
+        self.assertEqual(pool.connect.keywords['timeout'], 2.0)
+
+    def _store_session(self, session_id, managed_dict=None, timeout=1200):
+        from ..compat import cPickle
+        from ..util import session_document
+        import time
+        document = session_document(session_id, timeout, b'')
+        document['payload'] = cPickle.dumps({
+            'managed_dict': managed_dict or {},
+            'created': time.time(),
+            'timeout': timeout,
+        })
+        document['expires_at'] = time.time() + timeout
+        self.conn.table()[session_id] = document
+
+    def test_valid_cookie_loads_session_in_one_round_trip(self):
+        factory = self._makeFactory()
+        self._store_session('sid', {'user': 'bob'})
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        self.assertEqual(session['user'], 'bob')
+        self.assertEqual(self.conn.round_trips, 1)
+        self.assertIs(session.new, False)
+        self.assertEqual(session.session_id, 'sid')
+
+    def test_session_is_loaded_lazily(self):
+        factory = self._makeFactory()
+        self._store_session('sid', {'user': 'bob'})
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        self.assertFalse(session.loaded)
+        self.assertEqual(self.conn.round_trips, 0)
+        self.assertEqual(factory.connection_pool.stats()['checkouts'], 0)
+        self.assertEqual(len(request.response_callbacks), 0)
+        self.assertIn('user', session)
+        self.assertTrue(session.loaded)
+        self.assertEqual(self.conn.round_trips, 1)
+        self.assertEqual(len(request.response_callbacks), 2)
+
+    def test_untouched_session_sets_no_cookie(self):
+        import webob
+        factory = self._makeFactory()
+        request = self._make_request()
+        factory(request)
+        response = webob.Response()
+        request._process_response_callbacks(response)
+        self.assertEqual(response.headers.getall('Set-Cookie'), [])
+
+    def test_lazy_session_conforms(self):
+        from pyramid.interfaces import ISession
+        from zope.interface.verify import verifyObject
+        factory = self._makeFactory()
+        verifyObject(ISession, factory(self._make_request()))
+
+    def test_new_session_read_writes_nothing(self):
+        import webob
+        factory = self._makeFactory()
+        request = self._make_request()
+        session = factory(request)
+        self.assertEqual(session.get('a'), None)
+        self.assertIs(session.new, True)
+        self.assertEqual(self.conn.round_trips, 0)
+        response = webob.Response()
+        request._process_response_callbacks(response)
+        self.assertEqual(response.headers.getall('Set-Cookie'), [])
+        self.assertEqual(self.conn.table(), {})
+
+    def test_new_session_inserted_on_first_write(self):
+        import webob
+        factory = self._makeFactory()
+        request = self._make_request()
+        session = factory(request)
+        self.assertEqual(session.session_id, None)
+        session['a'] = 1
+        self.assertEqual(self.conn.table(), {})
+        response = webob.Response()
+        request._process_response_callbacks(response)
+        session_id = session.session_id
+        self.assertIn(session_id, self.conn.table())
+        self.assertEqual(len(response.headers.getall('Set-Cookie')), 1)
+
+        request = self._make_request()
+        self._set_session_cookie(request, session_id)
+        self.assertEqual(factory(request)['a'], 1)
+
+    def test_invalidated_session_without_writes_deletes_cookie(self):
+        import webob
+        factory = self._makeFactory()
+        self._store_session('sid', {'user': 'bob'})
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        session.invalidate()
+        self.assertEqual(session.get('user'), None)
+        self.assertNotIn('sid', self.conn.table())
+        self.assertEqual(self.conn.table(), {})
+        response = webob.Response()
+        request._process_response_callbacks(response)
+        cookie = response.headers.getall('Set-Cookie')
+        self.assertEqual(len(cookie), 1)
+        self.assertIn('Max-Age=0', cookie[0])
+
+    def test_eager_create_sets_cookie_for_new_session(self):
+        import webob
+        factory = self._makeFactory(defer_create=False)
+        request = self._make_request()
+        self._set_session_cookie(request, 'gone')
+        session = factory(request)
+        self.assertIs(session.new, True)
+        self.assertNotEqual(session.session_id, 'gone')
+        self.assertIn(session.session_id, self.conn.table())
+        self.assertEqual(self.conn.round_trips, 1)
+        response = webob.Response()
+        request._process_response_callbacks(response)
+        self.assertEqual(len(response.headers.getall('Set-Cookie')), 1)
+
+    def test_eager_create_loads_valid_cookie(self):
+        factory = self._makeFactory(defer_create=False)
+        self._store_session('sid', {'user': 'bob'})
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        self.assertEqual(session['user'], 'bob')
+        self.assertIs(session.new, False)
+        self.assertEqual(self.conn.round_trips, 1)
+
+    def test_writes_are_flushed_once_per_request(self):
+        import webob
+        factory = self._makeFactory()
+        self._store_session('sid')
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        session['a'] = 1
+        session.update({'b': 2, 'c': 3})
+        session.flash('hello')
+        self.assertEqual(self.conn.round_trips, 1)
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(self.conn.round_trips, 2)
+
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        self.assertEqual(session['c'], 3)
+        self.assertEqual(session.pop_flash(), ['hello'])
+
+    def test_explicit_flush_writes_immediately(self):
+        import webob
+        factory = self._makeFactory()
+        self._store_session('sid')
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        session['a'] = 1
+        self.assertTrue(session.flush())
+        self.assertEqual(self.conn.round_trips, 2)
+        self.assertFalse(session.flush())
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(self.conn.round_trips, 2)
+
+    def test_loader_attribute_error_propagates(self):
+        from pyramid_rethinkdb_sessions.session import LazyRethinkDBSession
+        def loader():
+            raise AttributeError('registry')
+        session = LazyRethinkDBSession(loader)
+        with self.assertRaises(AttributeError) as caught:
+            session.get('a')
+        self.assertEqual(caught.exception.args, ('registry',))
+
+    def test_flush_of_unloaded_session_does_nothing(self):
+        factory = self._makeFactory()
+        session = factory(self._make_request())
+        self.assertFalse(session.flush())
+        self.assertFalse(session.loaded)
+
+    def test_unchanged_session_is_not_written(self):
+        import webob
+        factory = self._makeFactory()
+        self._store_session('sid', {'a': 1})
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        session['a'] = session['a']
+        session.changed()
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(self.conn.round_trips, 1)
+        self.assertEqual(factory.counters['writes_skipped'], 1)
+        self.assertEqual(factory.counters['writes_performed'], 0)
+
+    def test_changed_session_is_written(self):
+        factory = self._makeFactory()
+        self._store_session('sid', {'a': 1})
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        session['a'] = 2
+        self.assertTrue(session.flush())
+        session['a'] = 2
+        self.assertFalse(session.flush())
+        self.assertEqual(self.conn.round_trips, 2)
+        self.assertEqual(factory.counters.snapshot(),
+                         {'writes_performed': 1, 'writes_skipped': 1,
+                          'touches': 0})
+
+    def test_tracked_values_mark_session_dirty(self):
+        import webob
+        factory = self._makeFactory(track_mutations=True)
+        self._store_session('sid', {'cart': ['a']})
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        session['cart'].append('b')
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(factory.counters['writes_performed'], 1)
+
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        session = factory(request)
+        self.assertEqual(session['cart'], ['a', 'b'])
+        session['cart'][0] = 'a'
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(factory.counters['writes_performed'], 1)
+        self.assertEqual(factory.counters['writes_skipped'], 0)
+
+    def test_untracked_in_place_changes_need_changed(self):
+        import webob
+        factory = self._makeFactory()
+        self._store_session('sid', {'cart': ['a']})
+        request = self._make_request()
+        self._set_session_cookie(request, 'sid')
+        factory(request)['cart'].append('b')
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(factory.counters['writes_performed'], 0)
+
+    def _cookie_request(self, factory, session_id='sid'):
+        request = self._make_request()
+        self._set_session_cookie(request, session_id)
+        return request, factory(request)
+
+    def test_bucket_interval_stores_sessions_in_bucket_tables(self):
+        import time
+        import webob
+        factory = self._makeFactory(bucket_interval=3600)
+        factory.buckets.rotate(self.conn)
+        request = self._make_request()
+        session = factory(request)
+        session['a'] = 1
+        request._process_response_callbacks(webob.Response())
+        table = 'pyramid_sessions_%d' % (time.time() // 3600)
+        self.assertIn(session.session_id, self.conn.table(table))
+        self.assertEqual(self.conn.table(), {})
+
+        request, session = self._cookie_request(factory, session.session_id)
+        self.assertEqual(session['a'], 1)
+        self.assertIs(session.new, False)
+
+    def test_bucket_interval_eager_create(self):
+        import time
+        factory = self._makeFactory(bucket_interval=3600, defer_create=False)
+        factory.buckets.rotate(self.conn)
+        session = factory(self._make_request())
+        session.session_id
+        table = 'pyramid_sessions_%d' % (time.time() // 3600)
+        self.assertIn(session.session_id, self.conn.table(table))
+        self.assertEqual(session._session_state.table, table)
+
+    def test_cache_serves_repeat_requests(self):
+        import webob
+        factory = self._makeFactory(cache_max_entries=10)
+        self._store_session('sid', {'a': 1})
+        request, session = self._cookie_request(factory)
+        self.assertEqual(session['a'], 1)
+        request, session = self._cookie_request(factory)
+        trips = self.conn.round_trips
+        self.assertEqual(session['a'], 1)
+        self.assertIs(session.new, False)
+        self.assertEqual(self.conn.round_trips, trips)
+        stats = factory.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        # written through on flush
+        session['a'] = 2
+        request._process_response_callbacks(webob.Response())
+        request, session = self._cookie_request(factory)
+        trips = self.conn.round_trips
+        self.assertEqual(session['a'], 2)
+        self.assertEqual(self.conn.round_trips, trips)
+
+    def test_cache_write_through_field_storage(self):
+        import webob
+        factory = self._makeFactory(cache_max_entries=10, field_storage=True)
+        request = self._make_request()
+        session = factory(request)
+        session.update({'a': 1, 'b': 2})
+        request._process_response_callbacks(webob.Response())
+        request, session = self._cookie_request(factory, session.session_id)
+        trips = self.conn.round_trips
+        self.assertEqual(dict(session.items()), {'a': 1, 'b': 2})
+        self.assertEqual(self.conn.round_trips, trips)
+
+    def test_cache_dropped_on_invalidate(self):
+        factory = self._makeFactory(cache_max_entries=10)
+        self._store_session('sid', {'a': 1})
+        request, session = self._cookie_request(factory)
+        session.invalidate()
+        self.assertEqual(len(factory.cache), 0)
+        request, session = self._cookie_request(factory)
+        self.assertIs(session.new, True)
+
+    def test_cache_invalidation(self):
+        factory = self._makeFactory(cache_max_entries=10, cache_ttl=300,
+                                    cache_invalidation=True)
+        try:
+            self.assertIs(factory.cache_invalidator.cache, factory.cache)
+        finally:
+            factory.cache_invalidator.stop(timeout=5)
+
+    def test_cache_invalidation_not_with_buckets(self):
+        self.assertRaises(ValueError, self._makeFactory,
+                          cache_max_entries=10, cache_invalidation=True,
+                          bucket_interval=3600)
+
+    def test_shared_cache_between_workers(self):
+        import os
+        import shutil
+        import tempfile
+        import webob
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'sessions')
+        worker = self._makeFactory(cache_max_entries=10,
+                                   cache_shared_path=path)
+        request = self._make_request()
+        session = worker(request)
+        session['a'] = 1
+        request._process_response_callbacks(webob.Response())
+
+        other_worker = self._makeFactory(cache_max_entries=10,
+                                         cache_shared_path=path)
+        request, session = self._cookie_request(other_worker,
+                                                session.session_id)
+        self.assertEqual(session['a'], 1)
+        self.assertEqual(self.conn.round_trips, 0)
+
+    def _respond(self, request):
+        # run the response callbacks; returns the session cookie's new value,
+        # '' when it is deleted or None when it is left alone
+        import webob
+        response = webob.Response()
+        request._process_response_callbacks(response)
+        for header in response.headers.getall('Set-Cookie'):
+            name, value = header.split(';')[0].split('=', 1)
+            if name == 'session':
+                return value
+        return None
+
+    def test_cookie_of_missing_session_is_deleted(self):
+        factory = self._makeFactory()
+        request, session = self._cookie_request(factory, 'gone')
+        self.assertIs(session.new, True)
+        self.assertEqual(self._respond(request), '')
+        # a client that drops the cookie stops paying for the lookup
+        request = self._make_request()
+        factory(request)
+        self.assertEqual(self._respond(request), None)
+        self.assertEqual(self.conn.round_trips, 1)
+
+    def test_replayed_cookie_of_missing_session_is_deleted_again(self):
+        factory = self._makeFactory()
+        for _ in range(2):
+            request, session = self._cookie_request(factory, 'gone')
+            self.assertIs(session.new, True)
+            self.assertEqual(session.session_id, None)
+            self.assertEqual(self._respond(request), '')
+        # nothing is remembered about the dead id; the cookie is cleared
+        self.assertEqual(self.conn.round_trips, 2)
+
+    def _inline_request(self, factory, cookieval):
+        request = self._make_request()
+        request.cookies['session'] = cookieval
+        return request, factory(request)
+
+    def test_small_session_kept_in_cookie(self):
+        factory = self._makeFactory(cookie_storage_threshold=500)
+        request = self._make_request()
+        session = factory(request)
+        session['user'] = 42
+        cookieval = self._respond(request)
+        self.assertTrue(cookieval)
+        self.assertEqual(self.conn.table(), {})
+        self.assertEqual(self.conn.round_trips, 0)
+
+        request, session = self._inline_request(factory, cookieval)
+        self.assertEqual(session['user'], 42)
+        self.assertIs(session.new, False)
+        self.assertEqual(session.session_id, None)
+        # unchanged and recently issued: no new cookie
+        self.assertEqual(self._respond(request), None)
+        self.assertEqual(self.conn.round_trips, 0)
+
+    def test_cookie_session_works_while_rethinkdb_is_down(self):
+        import rethinkdb as r
+        from ..pool import ConnectionPool
+        factory = self._makeFactory(cookie_storage_threshold=500)
+        request = self._make_request()
+        factory(request)['user'] = 42
+        cookieval = self._respond(request)
+
+        def connect():
+            raise r.ReqlDriverError('db down')
+        factory = self._makeFactory(cookie_storage_threshold=500,
+                                    connection_pool=ConnectionPool(connect))
+        request, session = self._inline_request(factory, cookieval)
+        self.assertEqual(session['user'], 42)
+        session['user'] = 43
+        self.assertTrue(self._respond(request))
+        request._process_finished_callbacks()
+        self.assertEqual(factory.connection_pool.stats()['checkouts'], 0)
+
+    def test_cookie_session_spills_to_rethinkdb(self):
+        factory = self._makeFactory(cookie_storage_threshold=500)
+        request = self._make_request()
+        session = factory(request)
+        session['user'] = 42
+        cookieval = self._respond(request)
+
+        request, session = self._inline_request(factory, cookieval)
+        session['big'] = 'x' * 1000
+        cookieval = self._respond(request)
+        session_id = session.session_id
+        self.assertIn(session_id, self.conn.table())
+
+        request, session = self._inline_request(factory, cookieval)
+        self.assertEqual(session.session_id, session_id)
+        self.assertEqual(session['user'], 42)
+        # back under the threshold it stays in RethinkDB
+        del session['big']
+        self.assertEqual(self._respond(request), None)
+        self.assertIn(session_id, self.conn.table())
+
+    def test_cookie_session_stored_once_cookie_storage_turned_off(self):
+        factory = self._makeFactory(cookie_storage_threshold=500)
+        request = self._make_request()
+        factory(request)['user'] = 42
+        cookieval = self._respond(request)
+
+        # cookie sessions still live when the threshold is set back to 0
+        factory = self._makeFactory()
+        request, session = self._inline_request(factory, cookieval)
+        self.assertEqual(session['user'], 42)
+        session['user'] = 43
+        cookieval = self._respond(request)
+        session_id = session.session_id
+        self.assertIn(session_id, self.conn.table())
+        self.assertFalse(session._in_cookie)
+
+        request, session = self._inline_request(factory, cookieval)
+        self.assertEqual(session.session_id, session_id)
+        self.assertEqual(session['user'], 43)
+
+    def test_cookie_session_compressed(self):
+        plain = self._makeFactory(cookie_storage_threshold=1000)
+        compressed = self._makeFactory(cookie_storage_threshold=1000,
+                                       cookie_compress=True)
+        cookies = []
+        for factory in (plain, compressed):
+            request = self._make_request()
+            factory(request)['text'] = 'abc' * 100
+            cookies.append(self._respond(request))
+        self.assertTrue(len(cookies[1]) < len(cookies[0]) / 2)
+        request, session = self._inline_request(compressed, cookies[1])
+        self.assertEqual(session['text'], 'abc' * 100)
+
+    def test_cookie_session_expiry(self):
+        import time
+        from ..compat import cPickle
+        from ..cookie import CookieCodec
+        factory = self._makeFactory(cookie_storage_threshold=500)
+        payload = cPickle.dumps({'managed_dict': {'a': 1},
+                                 'created': time.time(), 'timeout': 1200})
+        codec = CookieCodec('secret')
+        expired = codec.encode_session(payload, time.time() - 1)
+        request, session = self._inline_request(factory, expired)
+        self.assertIs(session.new, True)
+        self.assertNotIn('a', session)
+
+        # touched, like a stored session, once a quarter of the timeout has
+        # passed since it was last issued
+        stale = codec.encode_session(payload, time.time() + 600)
+        request, session = self._inline_request(factory, stale)
+        self.assertEqual(session['a'], 1)
+        cookieval = self._respond(request)
+        self.assertTrue(cookieval)
+        request, session = self._inline_request(factory, cookieval)
+        self.assertTrue(session._session_state.expires_at > time.time() + 1000)
+
+    def test_cookie_session_invalidate(self):
+        factory = self._makeFactory(cookie_storage_threshold=500)
+        request = self._make_request()
+        factory(request)['user'] = 42
+        request, session = self._inline_request(
+            factory, self._respond(request))
+        session.invalidate()
+        self.assertEqual(self._respond(request), '')
+
+    def test_cookie_storage_needs_defer_create(self):
+        self.assertRaises(ValueError, self._makeFactory,
+                          cookie_storage_threshold=500, defer_create=False)
+
+    def test_cookie_signed_with_old_secret(self):
+        from ..cookie import CookieCodec
+        factory = self._makeFactory(secret='new', old_secrets=['secret'])
+        self._store_session('sid', {'a': 1})
+        request, session = self._cookie_request(factory)
+        self.assertEqual(session['a'], 1)
+        self.assertIs(session.new, False)
+        cookieval = CookieCodec('new').encode_id('sid')
+        self.assertEqual(factory.cookie_codec.decode(cookieval).session_id,
+                         'sid')
+
+    def test_legacy_cookie(self):
+        from pyramid.session import signed_serialize
+        for legacy, new in ((True, False), (False, True)):
+            factory = self._makeFactory(cookie_legacy=legacy)
+            self._store_session('sid', {'a': 1})
+            request = self._make_request()
+            request.cookies['session'] = signed_serialize('sid', 'secret')
+            self.assertIs(factory(request).new, new)
+
+    def test_cookie_expires_with_max_age(self):
+        import time
+        factory = self._makeFactory(cookie_max_age=60)
+        request = self._make_request()
+        factory(request)['a'] = 1
+        cookie = factory.cookie_codec.decode(self._respond(request))
+        self.assertTrue(time.time() < cookie.expires_at <= time.time() + 60)
+
+    def test_no_cache_by_default(self):
+        factory = self._makeFactory()
+        self.assertIs(factory.cache, None)
+
+    def test_field_storage_updates_changed_keys_only(self):
+        import webob
+        from ..compat import cPickle
+        factory = self._makeFactory(field_storage=True)
+        request = self._make_request()
+        session = factory(request)
+        session.update({'big': 'x' * 1000, 'small': 1, 'gone': 2})
+        request._process_response_callbacks(webob.Response())
+        session_id = session.session_id
+        document = self.conn.table()[session_id]
+        self.assertEqual(sorted(document['data']), ['big', 'gone', 'small'])
+        self.assertNotIn('payload', document)
+
+        request, session = self._cookie_request(factory, session_id)
+        session['small'] = 3
+        del session['gone']
+        self.conn.queries[:] = []
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(len(self.conn.queries), 1)
+        query = self.conn.queries[0][0]
+        from . import _term_name
+        self.assertEqual(_term_name(query), 'UPDATE')
+        changes = query._args[1].optargs['data'].optargs
+        self.assertEqual(sorted(changes), ['gone', 'small'])
+        document = self.conn.table()[session_id]
+        self.assertEqual(sorted(document['data']), ['big', 'small'])
+        self.assertEqual(cPickle.loads(document['data']['small']), 3)
+
+        request, session = self._cookie_request(factory, session_id)
+        self.assertEqual(dict(session.items()),
+                         {'big': 'x' * 1000, 'small': 3})
+
+    def test_field_storage_rewrites_row_deleted_meanwhile(self):
+        import webob
+        factory = self._makeFactory(cache_max_entries=10, field_storage=True)
+        request = self._make_request()
+        session = factory(request)
+        session.update({'a': 1, 'b': 2})
+        request._process_response_callbacks(webob.Response())
+        session_id = session.session_id
+
+        request, session = self._cookie_request(factory, session_id)
+        self.assertEqual(session['a'], 1)
+        # reaped, or deleted by another worker, before this write
+        del self.conn.table()[session_id]
+        session['a'] = 3
+        self.assertTrue(session.flush())
+        self.assertEqual(sorted(self.conn.table()[session_id]['data']),
+                         ['a', 'b'])
+        request, session = self._cookie_request(factory, session_id)
+        self.assertEqual(dict(session.items()), {'a': 3, 'b': 2})
+
+    def test_field_storage_skips_unchanged(self):
+        import webob
+        factory = self._makeFactory(field_storage=True)
+        self._store_session('sid', {'a': 1})
+        request, session = self._cookie_request(factory)
+        session['a'] = 2
+        request._process_response_callbacks(webob.Response())
+        request, session = self._cookie_request(factory)
+        self.assertEqual(session['a'], 2)
+        session['a'] = 2
+        session.changed()
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(factory.counters.snapshot(),
+                         {'writes_performed': 1, 'writes_skipped': 1,
+                          'touches': 0})
+
+    def test_field_storage_document_read_by_payload_sessions(self):
+        import webob
+        from ..compat import cPickle
+        factory = self._makeFactory()
+        self.conn.table()['sid'] = {'id': 'sid', 'created': 0, 'timeout': 1200,
+                               'data': {'a': cPickle.dumps(1)}}
+        request, session = self._cookie_request(factory)
+        self.assertEqual(session['a'], 1)
+        session['b'] = 2
+        request._process_response_callbacks(webob.Response())
+        self.assertIn('payload', self.conn.table()['sid'])
+
+    def test_write_policy_applies_to_session_writes(self):
+        import webob
+        factory = self._makeFactory(write_durability='soft',
+                                    noreply=['write', 'invalidate'])
+        self._store_session('sid')
+        request, session = self._cookie_request(factory)
+        session['a'] = 1
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(self.conn.queries[-1][1],
+                         {'durability': 'soft', 'noreply': True})
+        request, session = self._cookie_request(factory)
+        self.assertEqual(session['a'], 1)
+        session.invalidate()
+        self.assertEqual(self.conn.queries[-1][1],
+                         {'durability': 'soft', 'noreply': True})
+        self.assertEqual(self.conn.table(), {})
+
+    def _age_session(self, session_id, seconds):
+        self.conn.table()[session_id]['expires_at'] -= seconds
+
+    def test_fresh_session_read_is_not_touched(self):
+        import webob
+        factory = self._makeFactory()
+        self._store_session('sid', {'a': 1})
+        request, session = self._cookie_request(factory)
+        self.assertEqual(session['a'], 1)
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(self.conn.round_trips, 1)
+        self.assertEqual(factory.counters['touches'], 0)
+
+    def test_stale_session_read_touches_expiry_only(self):
+        import webob
+        from . import _term_name
+        factory = self._makeFactory(refresh_fraction=0.25)
+        self._store_session('sid', {'a': 1}, timeout=1200)
+        self._age_session('sid', 600)
+        before = self.conn.table()['sid']['expires_at']
+        request, session = self._cookie_request(factory)
+        self.assertEqual(session['a'], 1)
+        self.assertEqual(session.get('a'), 1)
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(self.conn.round_trips, 2)
+        query = self.conn.queries[-1][0]
+        self.assertEqual(_term_name(query), 'UPDATE')
+        self.assertEqual(list(query._args[1].optargs), ['expires_at'])
+        self.assertGreater(self.conn.table()['sid']['expires_at'], before + 500)
+        self.assertEqual(factory.counters['touches'], 1)
+
+    def test_write_extends_expiry_without_separate_touch(self):
+        import webob
+        factory = self._makeFactory()
+        self._store_session('sid', {'a': 1})
+        self._age_session('sid', 900)
+        request, session = self._cookie_request(factory)
+        session['a'] = session['a'] + 1
+        request._process_response_callbacks(webob.Response())
+        self.assertEqual(self.conn.round_trips, 2)
+        self.assertEqual(factory.counters['touches'], 0)
+        self.assertGreater(self.conn.table()['sid']['expires_at'],
+                           self.conn.clock() + 1100)
+
+    def test_legacy_row_without_expiry_is_touched(self):
+        import webob
+        factory = self._makeFactory()
+        self._store_session('sid', {'a': 1})
+        del self.conn.table()['sid']['expires_at']
+        request, session = self._cookie_request(factory)
+        session.get('a')
+        request._process_response_callbacks(webob.Response())
+        self.assertIn('expires_at', self.conn.table()['sid'])
+
+    def test_expired_session_is_not_loaded(self):
+        factory = self._makeFactory()
+        self._store_session('sid', {'user': 'bob'}, timeout=60)
+        self._age_session('sid', 61)
+        request, session = self._cookie_request(factory)
+        self.assertEqual(session.get('user'), None)
+        self.assertIs(session.new, True)
+        self.assertEqual(self.conn.round_trips, 1)
+
+    def test_eager_create_replaces_expired_session(self):
+        factory = self._makeFactory(defer_create=False)
+        self._store_session('sid', {'user': 'bob'}, timeout=60)
+        self._age_session('sid', 61)
+        request, session = self._cookie_request(factory)
+        self.assertNotEqual(session.session_id, 'sid')
+        self.assertEqual(session.get('user'), None)
+        self.assertEqual(self.conn.round_trips, 1)
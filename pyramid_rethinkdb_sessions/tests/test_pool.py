@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from . import DummyConnection
+
+
+class TestConnectionPool(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from ..pool import ConnectionPool
+        self.opened = []
+
+        def connect():
+            conn = DummyConnection()
+            self.opened.append(conn)
+            return conn
+        return ConnectionPool(connect, **kw)
+
+    def test_acquire_opens_connection(self):
+        pool = self._makeOne()
+        conn = pool.acquire()
+        self.assertIs(conn, self.opened[0])
+        self.assertEqual(pool.stats()['in_use'], 1)
+
+    def test_release_reuses_connection(self):
+        pool = self._makeOne()
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_concurrent_checkouts_get_distinct_connections(self):
+        pool = self._makeOne(max_size=2)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+
+    def test_exhausted_pool_times_out(self):
+        from ..pool import PoolTimeoutError
+        pool = self._makeOne(max_size=1, wait_timeout=0.01)
+        pool.acquire()
+        self.assertRaises(PoolTimeoutError, pool.acquire)
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['wait_timeouts'], 1)
+        self.assertGreater(stats['wait_time'], 0)
+
+    def test_waiter_gets_released_connection(self):
+        pool = self._makeOne(max_size=1, wait_timeout=5)
+        conn = pool.acquire()
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+        waiter.start()
+        pool.release(conn)
+        waiter.join(5)
+        self.assertEqual(acquired, [conn])
+
+    def test_closed_connection_is_replaced(self):
+        pool = self._makeOne()
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.close()
+        replacement = pool.acquire()
+        self.assertIsNot(replacement, conn)
+        self.assertEqual(pool.stats()['discarded'], 1)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_max_lifetime_discards_on_release(self):
+        pool = self._makeOne(max_lifetime=0)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_idle_connection_is_pinged(self):
+        pool = self._makeOne(idle_check=0)
+        conn = pool.acquire()
+        pool.release(conn)
+        pool.acquire()
+        self.assertEqual(conn.round_trips, 1)
+
+    def test_failed_connect_frees_slot(self):
+        from ..pool import ConnectionPool
+
+        def connect():
+            raise IOError('down')
+        pool = ConnectionPool(connect, max_size=1)
+        self.assertRaises(IOError, pool.acquire)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_connection_context_manager(self):
+        pool = self._makeOne()
+        with pool.connection() as conn:
+            self.assertEqual(pool.stats()['in_use'], 1)
+        self.assertEqual(pool.stats()['idle'], 1)
+        self.assertIs(pool.acquire(), conn)
+
+    def test_prewarm_opens_idle_connections(self):
+        pool = self._makeOne(max_size=3)
+        self.assertEqual(pool.prewarm(2), 2)
+        self.assertEqual(pool.stats()['idle'], 2)
+        pool.acquire()
+        self.assertEqual(len(self.opened), 2)
+
+    def test_prewarm_is_bounded_by_max_size(self):
+        pool = self._makeOne(max_size=2)
+        self.assertEqual(pool.prewarm(5), 2)
+
+    def test_fork_drops_inherited_connections(self):
+        pool = self._makeOne()
+        inherited = pool.acquire()
+        pool.release(inherited)
+        pool._pid = -1  # pretend the pool was created in a parent process
+        conn = pool.acquire()
+        self.assertIsNot(conn, inherited)
+        self.assertFalse(inherited.closed)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_fork_closes_copies_of_inherited_sockets(self):
+        class Socket(object):
+            closed = False
+
+            def close(self):
+                self.closed = True
+        pool = self._makeOne()
+        idle, in_use = pool.acquire(), pool.acquire()
+        pool.release(idle)
+        sockets = []
+        for conn in (idle, in_use):
+            conn._instance = type('Instance', (object,), {})()
+            conn._instance._socket = type('Wrapper', (object,), {})()
+            conn._instance._socket._socket = socket = Socket()
+            sockets.append(socket)
+        pool._pid = -1
+        pool.acquire()
+        self.assertTrue(all(socket.closed for socket in sockets))
+        # the connections themselves are left alone: closing them would shut
+        # the sockets down for the parent process too
+        self.assertFalse(idle.closed or in_use.closed)
+
+    def test_release_after_fork_is_ignored(self):
+        pool = self._makeOne()
+        inherited = pool.acquire()
+        pool._pid = -1
+        pool.release(inherited)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+
+class Test_prewarm_connection_pool(unittest.TestCase):
+    def test_prewarm_failure_is_logged(self):
+        from ..connection import _prewarm
+        from ..pool import ConnectionPool
+
+        def connect():
+            raise IOError('down')
+        pool = ConnectionPool(connect)
+        _prewarm(pool, 2)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def _prewarm_pool(self, **kw):
+        import os
+        from ..connection import prewarm_connection_pool
+        from ..pool import ConnectionPool
+        from . import DummyConnection
+        hooks = []
+        original = getattr(os, 'register_at_fork', None)
+        os.register_at_fork = lambda **kw: hooks.append(kw)
+        try:
+            pool = ConnectionPool(DummyConnection)
+            prewarm_connection_pool(pool, 2, **kw)
+        finally:
+            if original is None:
+                del os.register_at_fork
+            else:
+                os.register_at_fork = original
+        return pool, hooks
+
+    def test_prewarm_only_after_fork(self):
+        pool, hooks = self._prewarm_pool()
+        self.assertEqual(pool.stats()['size'], 0)
+        self.assertEqual(len(hooks), 1)
+        hooks[0]['after_in_child']()
+        self.assertEqual(pool.stats()['idle'], 2)
+
+    def test_prewarm_now_without_fork(self):
+        pool, hooks = self._prewarm_pool(after_fork=False)
+        self.assertEqual(pool.stats()['idle'], 2)
+        self.assertEqual(hooks, [])
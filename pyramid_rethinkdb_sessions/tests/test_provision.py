@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:  # pragma: no cover
+    from io import StringIO
+
+from . import DummyConnection
+
+
+class Test_provision(unittest.TestCase):
+    def _callFUT(self, conn, **kw):
+        from ..provision import provision
+        return provision(conn, **kw)
+
+    def test_creates_configured_db_and_table(self):
+        conn = DummyConnection(db='other', tables=())
+        del conn.dbs['other']
+        result = self._callFUT(conn, db='mysessions')
+        self.assertEqual(result, {'db': True, 'table': True,
+                                  'lease_table': True,
+                                  'indexes': ['expires_at']})
+        self.assertIn('pyramid_sessions', conn.dbs['mysessions'])
+        self.assertIn('pyramid_session_leases', conn.dbs['mysessions'])
+        self.assertNotIn('rsessions', conn.dbs)
+
+    def test_existing_schema_is_left_alone(self):
+        conn = DummyConnection(
+            tables=('pyramid_sessions', 'pyramid_session_leases'))
+        conn.table()['id'] = {'id': 'id'}
+        result = self._callFUT(conn)
+        self.assertEqual(result, {'db': False, 'table': False,
+                                  'lease_table': False,
+                                  'indexes': ['expires_at']})
+        self.assertEqual(conn.table(), {'id': {'id': 'id'}})
+
+    def test_creates_indexes(self):
+        conn = DummyConnection()
+        result = self._callFUT(conn, indexes=('expires',))
+        self.assertEqual(result['indexes'], ['expires'])
+        self.assertEqual(conn.indexes[('rsessions', 'pyramid_sessions')],
+                         set(['expires']))
+        result = self._callFUT(conn, indexes=('expires',))
+        self.assertEqual(result['indexes'], [])
+
+    def test_lost_create_race_is_not_an_error(self):
+        from ..provision import _create
+        import rethinkdb as r
+        conn = DummyConnection()
+        self.assertFalse(_create(r.db_create('rsessions'), conn))
+
+
+class Test_provision_main(unittest.TestCase):
+    def test_it(self):
+        from .. import scripts
+        conn = DummyConnection(tables=())
+        opened = []
+
+        def connect(**options):
+            opened.append(options)
+            return conn
+        original, scripts.connect = scripts.connect, connect
+        try:
+            out = StringIO()
+            code = scripts.provision_main(
+                ['provision', '--host', 'db1', '--port', '1234'], out=out)
+        finally:
+            scripts.connect = original
+        self.assertEqual(code, 0)
+        self.assertEqual(opened, [{'host': 'db1', 'port': 1234,
+                                   'db': 'rsessions'}])
+        self.assertIn('table created: True', out.getvalue())
+        self.assertIn('lease table created: True', out.getvalue())
+        self.assertTrue(conn.closed)
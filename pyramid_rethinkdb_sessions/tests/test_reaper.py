@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:  # pragma: no cover
+    from io import StringIO
+
+from . import DummyConnection
+from ..util import R_LEASE_TABLE, R_TABLE
+
+
+def _connection(**kw):
+    # a provisioned database, with the lease table
+    return DummyConnection(tables=(R_TABLE, R_LEASE_TABLE), **kw)
+
+
+class Test_reap_expired(unittest.TestCase):
+    def _makeConnection(self, expired=0, live=0):
+        conn = DummyConnection(now=lambda: 1000.0)
+        table = conn.table()
+        for i in range(expired):
+            table['old%s' % i] = {'id': 'old%s' % i, 'expires_at': 900.0 + i}
+        for i in range(live):
+            table['new%s' % i] = {'id': 'new%s' % i, 'expires_at': 2000.0}
+        return conn
+
+    def _callFUT(self, conn, **kw):
+        from ..reaper import reap_expired
+        return reap_expired(conn, **kw)
+
+    def test_deletes_expired_in_batches(self):
+        conn = self._makeConnection(expired=5, live=2)
+        result = self._callFUT(conn, batch_size=2)
+        self.assertEqual(result['deleted'], 5)
+        self.assertEqual(result['batches'], 3)
+        self.assertEqual(result['backlog'], 0)
+        self.assertEqual(sorted(conn.table()), ['new0', 'new1'])
+
+    def test_max_batches_leaves_backlog(self):
+        conn = self._makeConnection(expired=5)
+        result = self._callFUT(conn, batch_size=2, max_batches=1)
+        self.assertEqual(result['deleted'], 2)
+        self.assertEqual(result['backlog'], 3)
+        # the oldest sessions go first
+        self.assertNotIn('old0', conn.table())
+
+    def test_rate_limit_sleeps_between_batches(self):
+        conn = self._makeConnection(expired=4)
+        pauses = []
+        self._callFUT(conn, batch_size=2, max_rate=1, sleep=pauses.append)
+        self.assertEqual(len(pauses), 2)
+        self.assertTrue(all(1 < pause <= 2 for pause in pauses))
+
+    def test_uses_expiry_index(self):
+        from . import _term_name
+        conn = self._makeConnection(expired=1)
+        self._callFUT(conn)
+        query = conn.queries[0][0]
+        self.assertEqual(_term_name(query), 'DELETE')
+        between = query._args[0]._args[0]
+        self.assertEqual(_term_name(between), 'BETWEEN')
+        self.assertEqual(between.optargs['index'].data, 'expires_at')
+
+
+class Test_reap_main(unittest.TestCase):
+    def test_it(self):
+        from .. import scripts
+        conn = DummyConnection(now=lambda: 1000.0)
+        conn.table()['old'] = {'id': 'old', 'expires_at': 1.0}
+        original, scripts.connect = scripts.connect, lambda **kw: conn
+        try:
+            out = StringIO()
+            code = scripts.reap_main(['reap', '--batch-size', '10'], out=out)
+        finally:
+            scripts.connect = original
+        self.assertEqual(code, 0)
+        self.assertIn('deleted: 1', out.getvalue())
+        self.assertIn('backlog: 0', out.getvalue())
+        self.assertTrue(conn.closed)
+
+
+    def test_bucket_interval_rotates_tables(self):
+        import time
+        from .. import scripts
+        conn = DummyConnection()
+        conn.dbs[conn.db]['pyramid_sessions_1'] = {}
+        original, scripts.connect = scripts.connect, lambda **kw: conn
+        try:
+            out = StringIO()
+            code = scripts.reap_main(
+                ['reap', '--bucket-interval', '3600', '--timeout', '1200'],
+                out=out)
+        finally:
+            scripts.connect = original
+        self.assertEqual(code, 0)
+        self.assertIn('tables dropped: pyramid_sessions_1', out.getvalue())
+        self.assertIn('pyramid_sessions_%d' % (time.time() // 3600),
+                      conn.dbs[conn.db])
+
+    def _reap_with_settings(self, conn, settings, argv):
+        from .. import scripts
+        originals = scripts.connect, scripts._app_settings
+        scripts.connect = lambda **kw: conn
+        scripts._app_settings = lambda args: settings
+        try:
+            out = StringIO()
+            code = scripts.reap_main(['reap', 'app.ini'] + argv, out=out)
+        finally:
+            scripts.connect, scripts._app_settings = originals
+        return code, out.getvalue()
+
+    def test_bucket_rotation_uses_ini_settings(self):
+        import time
+        conn = DummyConnection()
+        bucket = int(time.time() // 3600)
+        tables = conn.dbs[conn.db]
+        tables['pyramid_sessions_1'] = {}
+        # still holds sessions under the application's one day timeout
+        tables['pyramid_sessions_%d' % (bucket - 2)] = {}
+        code, out = self._reap_with_settings(
+            conn, {'bucket_interval': 3600, 'timeout': 86400}, [])
+        self.assertEqual(code, 0)
+        self.assertIn('tables dropped: pyramid_sessions_1\n', out)
+        self.assertIn('pyramid_sessions_%d' % (bucket - 2), tables)
+        self.assertIn('pyramid_sessions_%d' % bucket, tables)
+
+    def test_bucket_rotation_keeps_ini_timeout(self):
+        import time
+        conn = DummyConnection()
+        bucket = int(time.time() // 3600)
+        tables = conn.dbs[conn.db]
+        tables['pyramid_sessions_%d' % (bucket - 2)] = {}
+        code, out = self._reap_with_settings(
+            conn, {'timeout': 86400}, ['--bucket-interval', '3600'])
+        self.assertEqual(code, 0)
+        self.assertIn('tables dropped: none', out)
+        self.assertIn('pyramid_sessions_%d' % (bucket - 2), tables)
+
+    def test_bucket_rotation_refused_without_timeout(self):
+        conn = DummyConnection()
+        conn.dbs[conn.db]['pyramid_sessions_1'] = {}
+        with self.assertRaises(SystemExit):
+            self._reap_with_settings(conn, {}, ['--bucket-interval', '3600'])
+        self.assertIn('pyramid_sessions_1', conn.dbs[conn.db])
+
+
+class Test_lease(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.conn = _connection(now=lambda: self.now)
+
+    def _lease(self):
+        return self.conn.table(R_LEASE_TABLE)['_reaper_lease']
+
+    def _acquire(self, holder, ttl=30):
+        from ..reaper import acquire_lease
+        return acquire_lease(self.conn, holder, ttl)
+
+    def test_first_holder_wins(self):
+        self.assertTrue(self._acquire('a'))
+        self.assertFalse(self._acquire('b'))
+        self.assertEqual(self._lease()['holder'], 'a')
+
+    def test_holder_renews(self):
+        self._acquire('a')
+        self.now += 20
+        self.assertTrue(self._acquire('a'))
+        self.assertEqual(self._lease()['expires_at'], 1050.0)
+
+    def test_expired_lease_fails_over(self):
+        self._acquire('a')
+        self.now += 30
+        self.assertTrue(self._acquire('b'))
+        self.assertFalse(self._acquire('a'))
+
+    def test_release(self):
+        from ..reaper import release_lease
+        self._acquire('a')
+        release_lease(self.conn, 'b')
+        self.assertIn('_reaper_lease', self.conn.table(R_LEASE_TABLE))
+        release_lease(self.conn, 'a')
+        self.assertTrue(self._acquire('b'))
+
+
+class TestReaper(unittest.TestCase):
+    def _makeOne(self, conn, **kw):
+        from ..pool import ConnectionPool
+        from ..reaper import Reaper
+        reaper = Reaper(ConnectionPool(lambda: conn), **kw)
+        return reaper
+
+    def test_only_the_leader_reaps(self):
+        conn = _connection(now=lambda: 1000.0)
+        conn.table()['old'] = {'id': 'old', 'expires_at': 1.0}
+        leader = self._makeOne(conn)
+        leader.holder = 'leader'
+        follower = self._makeOne(conn)
+        follower.holder = 'follower'
+        self.assertEqual(leader.run_once()['deleted'], 1)
+        conn.table()['old'] = {'id': 'old', 'expires_at': 1.0}
+        self.assertIs(follower.run_once(), None)
+        self.assertIn('old', conn.table())
+        # the lease lives in its own table, out of the sessions' way
+        self.assertEqual(leader.run_once()['deleted'], 1)
+        self.assertEqual(list(conn.table()), [])
+        self.assertIn('_reaper_lease', conn.table(R_LEASE_TABLE))
+
+    def test_rotates_bucketed_tables(self):
+        from ..buckets import SessionBuckets
+        conn = _connection(now=lambda: 36100.0)
+        conn.dbs[conn.db]['pyramid_sessions_8'] = {}
+        buckets = SessionBuckets(3600, 1200, clock=lambda: 36100.0)
+        reaper = self._makeOne(conn, buckets=buckets)
+        reaper.holder = 'leader'
+        result = reaper.run_once()
+        self.assertEqual(result['dropped'], ['pyramid_sessions_8'])
+        self.assertIn('pyramid_sessions_10', conn.dbs[conn.db])
+
+    def test_thread_reaps_and_stop_releases_lease(self):
+        import time
+        conn = _connection()
+        conn.table()['old'] = {'id': 'old', 'expires_at': 1.0}
+        reaper = self._makeOne(conn, interval=0.01)
+        reaper.start()
+        deadline = time.time() + 5
+        while 'old' in conn.table() and time.time() < deadline:
+            time.sleep(0.01)
+        reaper.stop(timeout=5)
+        self.assertNotIn('old', conn.table())
+        self.assertEqual(conn.table(R_LEASE_TABLE), {})
+
+    def test_failed_round_keeps_thread_alive(self):
+        import time
+        conn = _connection()
+        conn.close()
+        reaper = self._makeOne(conn, interval=0.01)
+        reaper.start()
+        time.sleep(0.05)
+        self.assertTrue(reaper._thread.is_alive())
+        reaper.stop(timeout=5)
+
+
+class Test_reaper_options(unittest.TestCase):
+    def test_split_from_factory_options(self):
+        from .. import _reaper_options
+        from ..util import _parse_settings
+        options = _parse_settings({
+            'rethink.sessions.secret': 'secret',
+            'rethink.sessions.reaper': 'true',
+            'rethink.sessions.reaper_interval': '30',
+            'rethink.sessions.reaper_batch_size': '500',
+        })
+        reaper_options = _reaper_options(options)
+        self.assertEqual(reaper_options, {'reaper': True, 'interval': 30.0,
+                                          'batch_size': 500})
+        self.assertEqual(options, {'secret': 'secret'})
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestSharedSessionCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sessions')
+        self.now = 1000.0
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.dir)
+
+    def _makeOne(self, **kw):
+        from ..shared import SharedSessionCache
+        kw.setdefault('slots', 8)
+        kw.setdefault('slot_size', 1024)
+        cache = SharedSessionCache(self.path, clock=lambda: self.now, **kw)
+        self.caches.append(cache)
+        return cache
+
+    def _document(self, session_id, payload=b'x', **kw):
+        return dict(kw, id=session_id, payload=payload)
+
+    def test_put_get(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.get('a'), None)
+        cache.put('a', self._document('a'))
+        self.assertEqual(cache.get('a'), (1000.0, self._document('a')))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_shared_between_mappings(self):
+        writer = self._makeOne()
+        reader = self._makeOne()
+        writer.put('a', self._document('a'))
+        self.assertEqual(reader.get('a')[1], self._document('a'))
+        writer.put('a', self._document('a', b'y'))
+        self.assertEqual(reader.get('a')[1]['payload'], b'y')
+        writer.discard('a')
+        self.assertEqual(reader.get('a'), None)
+
+    def test_ttl_and_expiry(self):
+        cache = self._makeOne(ttl=5)
+        cache.put('a', self._document('a'))
+        cache.put('b', self._document('b', expires_at=self.now + 1))
+        self.now += 1
+        self.assertNotEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', ttl=1), None)
+        self.assertEqual(cache.get('b'), None)
+        self.now += 4
+        self.assertEqual(cache.get('a'), None)
+
+    def test_too_big_replaces_older_copy(self):
+        cache = self._makeOne()
+        cache.put('a', self._document('a'))
+        cache.put('a', self._document('a', b'x' * 2000))
+        self.assertEqual(cache.get('a'), None)
+
+    def test_clock_eviction(self):
+        cache = self._makeOne(slots=2, ways=2)
+        cache.put('a', self._document('a'))
+        cache.put('b', self._document('b'))
+        cache.get('a')
+        cache.put('c', self._document('c'))
+        self.assertNotEqual(cache.get('a'), None)
+        self.assertNotEqual(cache.get('c'), None)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_slot_being_written_is_a_miss(self):
+        import struct
+        from ..shared import HEADER_SIZE
+        cache = self._makeOne(slots=1, ways=1)
+        cache.put('a', self._document('a'))
+        version = struct.unpack_from('<Q', cache._map, HEADER_SIZE)[0]
+        self.assertEqual(version % 2, 0)
+        struct.pack_into('<Q', cache._map, HEADER_SIZE, version + 1)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_clear(self):
+        cache = self._makeOne()
+        for key in 'abc':
+            cache.put(key, self._document(key))
+        cache.clear()
+        self.assertEqual([cache.get(key) for key in 'abc'], [None] * 3)
+
+    def test_other_layout_is_reset(self):
+        cache = self._makeOne()
+        cache.put('a', self._document('a'))
+        other = self._makeOne(slots=16)
+        self.assertEqual(other.get('a'), None)
+        self.assertEqual(os.path.getsize(self.path), other._size)
+
+    def test_bad_layout(self):
+        self.assertRaises(ValueError, self._makeOne, slots=6)
+        self.assertRaises(ValueError, self._makeOne, slot_size=64)
+
+
+class TestTieredCache(unittest.TestCase):
+    def setUp(self):
+        from ..cache import SessionCache
+        from ..shared import SharedSessionCache
+        self.dir = tempfile.mkdtemp()
+        self.now = 1000.0
+        self.shared = SharedSessionCache(
+            os.path.join(self.dir, 'sessions'), slots=8, slot_size=1024,
+            clock=lambda: self.now)
+        self.cache = SessionCache(ttl=5, clock=lambda: self.now,
+                                  shared=self.shared)
+
+    def tearDown(self):
+        self.shared.close()
+        shutil.rmtree(self.dir)
+
+    def test_miss_falls_through_to_shared_tier(self):
+        self.shared.put('a', {'id': 'a', 'payload': b'x'})
+        self.now += 3
+        self.assertEqual(self.cache.get('a')['payload'], b'x')
+        self.assertEqual(len(self.cache), 1)
+        # promoted with its age: it expires from both tiers together
+        self.now += 2
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_written_through_and_discarded_from_both(self):
+        self.cache.put('a', {'id': 'a', 'payload': b'x'})
+        self.assertNotEqual(self.shared.get('a'), None)
+        self.cache.discard('a')
+        self.assertEqual(self.shared.get('a'), None)
+
+    def test_local_clear_leaves_shared_tier_to_other_processes(self):
+        from ..cache import SessionCache
+        other = SessionCache(ttl=5, clock=lambda: self.now,
+                             shared=self.shared)
+        self.cache.put('a', {'id': 'a', 'payload': b'x'})
+        self.now += 1
+        self.cache.clear(shared=False)
+        self.assertEqual(len(self.cache), 0)
+        # other processes still use it, this one no longer trusts it
+        self.assertNotEqual(other.get('a'), None)
+        self.assertEqual(self.cache.get('a'), None)
+        # entries written after the clear are shared again
+        self.cache.put('a', {'id': 'a', 'payload': b'y'})
+        self.cache._entries.clear()
+        self.assertEqual(self.cache.get('a')['payload'], b'y')
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import pickle
+import unittest
+
+
+class TestTracked(unittest.TestCase):
+    def setUp(self):
+        self.changes = []
+
+    def _track(self, value):
+        from ..tracking import track
+        return track(value, lambda: self.changes.append(1))
+
+    def test_dict_mutations_are_reported(self):
+        tracked = self._track({'a': 1})
+        tracked['b'] = 2
+        del tracked['a']
+        tracked.update(c=3)
+        tracked.pop('c')
+        self.assertEqual(tracked, {'b': 2})
+        self.assertEqual(len(self.changes), 4)
+
+    def test_dict_noops_are_not_reported(self):
+        tracked = self._track({'a': 1})
+        tracked['a'] = 1
+        tracked.setdefault('a', 2)
+        tracked.pop('missing', None)
+        tracked.update({})
+        self.assertEqual(self.changes, [])
+
+    def test_list_mutations_are_reported(self):
+        tracked = self._track([3, 1])
+        tracked.append(2)
+        tracked.sort()
+        tracked[0] = 0
+        tracked += [4]
+        tracked.remove(4)
+        self.assertEqual(tracked, [0, 2, 3])
+        self.assertEqual(len(self.changes), 5)
+
+    def test_list_noops_are_not_reported(self):
+        tracked = self._track([1, 2])
+        tracked[0] = 1
+        tracked.sort()
+        tracked.extend([])
+        self.assertEqual(self.changes, [])
+
+    def test_nested_values_are_tracked(self):
+        tracked = self._track({'cart': [{'sku': 'a'}]})
+        tracked['cart'][0]['qty'] = 2
+        tracked['other'] = {}
+        tracked['other']['x'] = []
+        tracked['other']['x'].append(1)
+        self.assertEqual(len(self.changes), 4)
+
+    def test_pickles_and_copies_as_plain_types(self):
+        from ..tracking import TrackedDict, TrackedList
+        tracked = self._track({'cart': [1, {'a': 2}]})
+        for clone in (pickle.loads(pickle.dumps(tracked)),
+                      copy.deepcopy(tracked)):
+            self.assertIs(type(clone), dict)
+            self.assertIs(type(clone['cart']), list)
+            self.assertIs(type(clone['cart'][1]), dict)
+            self.assertEqual(clone, {'cart': [1, {'a': 2}]})
+        self.assertIsInstance(tracked['cart'], TrackedList)
+        self.assertIsInstance(tracked['cart'][1], TrackedDict)
+
+    def test_untrack(self):
+        from ..tracking import untrack
+        tracked = self._track({'cart': [1]})
+        plain = untrack(tracked)
+        self.assertIs(type(plain['cart']), list)
+        self.assertEqual(pickle.dumps(plain), pickle.dumps({'cart': [1]}))
@@ -4,6 +4,7 @@ import itertools
 import time
 import unittest
 
+from ..compat import cPickle
 from . import (
     DummyRedis,
     DummySession,
@@ -61,41 +62,53 @@ class Test_parse_settings(unittest.TestCase):
 
 
 class Test__insert_session_id_if_unique(unittest.TestCase):
-    def _makeOne(self, redis, timeout=1, session_id='id',
-                 serialize=lambda x: x):
+    def _makeOne(self, conn, timeout=1, session_id='id',
+                 serialize=cPickle.dumps, **kw):
         from ..util import _insert_session_id_if_unique
-        return _insert_session_id_if_unique(redis, timeout, session_id,
-                                            serialize)
+        return _insert_session_id_if_unique(conn, timeout, session_id,
+                                            serialize, **kw)
+
+    def _makeConnection(self):
+        from . import DummyConnection
+        return DummyConnection()
 
     def test_id_is_unique(self):
-        redis = DummyRedis()
+        conn = self._makeConnection()
         before = time.time()
-        result = self._makeOne(redis)
+        result = self._makeOne(conn)
         after = time.time()
-        persisted = redis.get('id')
-        managed_dict = persisted['managed_dict']
-        created = persisted['created']
-        timeout = persisted['timeout']
-        self.assertDictEqual(managed_dict, {})
-        self.assertGreaterEqual(created, before)
-        self.assertLessEqual(created, after)
-        self.assertEqual(timeout, 1)
+        persisted = cPickle.loads(conn.table()['id']['payload'])
+        self.assertDictEqual(persisted['managed_dict'], {})
+        self.assertGreaterEqual(persisted['created'], before)
+        self.assertLessEqual(persisted['created'], after)
+        self.assertEqual(persisted['timeout'], 1)
         self.assertEqual(result, 'id')
 
     def test_id_not_unique(self):
-        redis = DummyRedis()
-        original_value = object()
-        redis.set('id', original_value)
-        result = self._makeOne(redis)
-        # assert value under key has not been changed
-        self.assertEqual(redis.get('id'), original_value)
+        conn = self._makeConnection()
+        original_value = {'id': 'id', 'payload': b'original'}
+        conn.table()['id'] = original_value
+        result = self._makeOne(conn)
+        # assert the stored session has not been changed
+        self.assertEqual(conn.table()['id'], original_value)
         self.assertEqual(result, None)
 
-    def test_watcherror_returns_none(self):
-        redis = DummyRedis(raise_watcherror=True)
-        result = self._makeOne(redis)
-        self.assertIs(redis.get('id'), None)
-        self.assertEqual(result, None)
+    def test_other_write_errors_are_raised(self):
+        import rethinkdb as r
+        from . import DummyConnection
+        class FailingConnection(DummyConnection):
+            def _t_insert(self, term, scope):
+                return self._write_result(errors=1, first_error=(
+                    'Cannot perform write: primary replica not available'))
+        conn = FailingConnection()
+        self.assertRaises(r.ReqlOpFailedError, self._makeOne, conn)
+        self.assertNotIn('id', conn.table())
+
+    def test_connection_errors_are_raised(self):
+        import rethinkdb as r
+        conn = self._makeConnection()
+        conn.close()
+        self.assertRaises(r.ReqlDriverError, self._makeOne, conn)
 
 
 class Test_get_unique_session_id(unittest.TestCase):
@@ -172,18 +185,235 @@ class Test_refresh_decorator(unittest.TestCase):
     def _makeSession(self, timeout):
         redis = DummyRedis()
         session_id = 'session.session_id'
-        redis.timeouts[session_id] = timeout
         session = DummySession(session_id, redis, timeout)
         return session
 
     def test_it(self):
+        refreshed = []
         def wrapped(session, *arg, **kwarg):
+            refreshed.append(session.refreshed)
             return 'expected result'
         inst = self._makeOne(wrapped)
-        timeout = 300
-        session = self._makeSession(timeout)
+        session = self._makeSession(300)
         result = inst(session)
-        ttl = session.redis.ttl(session.session_id)
         self.assertEqual(result, 'expected result')
-        self.assertEqual(timeout, ttl)
+        # refreshed once, after the wrapped read
+        self.assertEqual(refreshed, [0])
+        self.assertEqual(session.refreshed, 1)
 
+
+class Test_parse_url(unittest.TestCase):
+    def _callFUT(self, url):
+        from ..util import parse_url
+        return parse_url(url)
+
+    def test_single_host(self):
+        result = self._callFUT('rethinkdb://bob:pw@db1:1234/sessions')
+        self.assertEqual(result, {'host': 'db1', 'port': 1234,
+                                  'db': 'sessions', 'user': 'bob',
+                                  'password': 'pw'})
+
+    def test_multiple_hosts(self):
+        result = self._callFUT('rethinkdb://bob:pw@db1:1,db2/sessions')
+        self.assertEqual(result['hosts'], [('db1', 1), ('db2', 28015)])
+        self.assertNotIn('host', result)
+        self.assertEqual(result['user'], 'bob')
+
+
+class Test_parse_hosts(unittest.TestCase):
+    def _callFUT(self, hosts):
+        from ..util import parse_hosts
+        return parse_hosts(hosts)
+
+    def test_string(self):
+        self.assertEqual(self._callFUT('db1:1, db2\n db3:3'),
+                         [('db1', 1), ('db2', 28015), ('db3', 3)])
+
+    def test_list(self):
+        self.assertEqual(self._callFUT(['db1:1', ('db2', 2)]),
+                         [('db1', 1), ('db2', 2)])
+
+
+class Test_get_unique_session_id_rethinkdb(unittest.TestCase):
+    def _makeOne(self, conn, ids=('a', 'b'), **kw):
+        from ..util import get_unique_session_id
+        ids = iter(ids)
+        return get_unique_session_id(conn, 300, lambda x: b'',
+                                     generator=lambda: next(ids), **kw)
+
+    def _makeConnection(self):
+        from . import DummyConnection
+        return DummyConnection()
+
+    def test_insert_is_one_round_trip(self):
+        conn = self._makeConnection()
+        self.assertEqual(self._makeOne(conn), 'a')
+        self.assertIn('a', conn.table())
+        self.assertEqual(conn.round_trips, 1)
+
+    def test_taken_id_is_retried(self):
+        conn = self._makeConnection()
+        conn.table()['a'] = {'id': 'a'}
+        self.assertEqual(self._makeOne(conn), 'b')
+        self.assertEqual(conn.table()['a'], {'id': 'a'})
+        self.assertEqual(conn.round_trips, 2)
+
+    def test_gives_up_after_attempts(self):
+        conn = self._makeConnection()
+        conn.table()['a'] = {'id': 'a'}
+        conn.table()['b'] = {'id': 'b'}
+        self.assertRaises(KeyError, self._makeOne, conn, attempts=2)
+        self.assertEqual(conn.round_trips, 2)
+
+    def test_connection_errors_propagate(self):
+        import rethinkdb as r
+        conn = self._makeConnection()
+        conn.close()
+        self.assertRaises(r.ReqlDriverError, self._makeOne, conn)
+
+
+class Test_get_or_create_session(unittest.TestCase):
+    def _makeOne(self, conn, session_id, ids=('new1', 'new2')):
+        from ..util import get_or_create_session
+        ids = iter(ids)
+        return get_or_create_session(conn, session_id, 300, lambda x: b'',
+                                     generator=lambda: next(ids))
+
+    def _makeConnection(self):
+        from . import DummyConnection
+        return DummyConnection()
+
+    def test_existing_session_is_returned(self):
+        conn = self._makeConnection()
+        conn.table()['sid'] = {'id': 'sid', 'payload': b'x'}
+        persisted = self._makeOne(conn, 'sid')
+        self.assertEqual(persisted, {'id': 'sid', 'payload': b'x'})
+        self.assertEqual(list(conn.table()), ['sid'])
+        self.assertEqual(conn.round_trips, 1)
+
+    def test_missing_session_is_created_under_new_id(self):
+        conn = self._makeConnection()
+        persisted = self._makeOne(conn, 'gone')
+        self.assertEqual(persisted['id'], 'new1')
+        self.assertEqual(list(conn.table()), ['new1'])
+        self.assertEqual(conn.round_trips, 1)
+
+    def test_no_session_id_creates(self):
+        conn = self._makeConnection()
+        self.assertEqual(self._makeOne(conn, None)['id'], 'new1')
+        self.assertEqual(conn.round_trips, 1)
+
+    def test_taken_id_is_retried(self):
+        conn = self._makeConnection()
+        conn.table()['new1'] = {'id': 'new1'}
+        self.assertEqual(self._makeOne(conn, 'gone')['id'], 'new2')
+        self.assertEqual(conn.round_trips, 2)
+
+
+class TestWritePolicy(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from ..util import WritePolicy
+        return WritePolicy(**kw)
+
+    def _query(self):
+        import rethinkdb as r
+        return r.table('pyramid_sessions').get('sid').delete()
+
+    def _makeConnection(self):
+        from . import DummyConnection
+        conn = DummyConnection()
+        conn.table()['sid'] = {'id': 'sid'}
+        return conn
+
+    def test_default_waits_for_reply(self):
+        conn = self._makeConnection()
+        result = self._makeOne().run('invalidate', self._query(), conn)
+        self.assertEqual(result['deleted'], 1)
+        self.assertEqual(conn.queries[0][1], {})
+
+    def test_durability_and_noreply(self):
+        conn = self._makeConnection()
+        policy = self._makeOne(durability='soft', noreply=['invalidate'])
+        self.assertIs(policy.run('invalidate', self._query(), conn), None)
+        self.assertEqual(conn.queries[0][1],
+                         {'durability': 'soft', 'noreply': True})
+        self.assertEqual(conn.table(), {})
+
+    def test_wait_overrides_noreply(self):
+        conn = self._makeConnection()
+        policy = self._makeOne(noreply=['invalidate'])
+        result = policy.run('invalidate', self._query(), conn, wait=True)
+        self.assertEqual(result['deleted'], 1)
+
+    def test_noreply_errors_go_to_hook(self):
+        conn = self._makeConnection()
+        conn.close()
+        errors = []
+        policy = self._makeOne(noreply=['invalidate'],
+                               on_error=lambda *a: errors.append(a))
+        policy.run('invalidate', self._query(), conn)
+        self.assertEqual(errors[0][0], 'invalidate')
+
+    def test_errors_are_raised_when_waiting(self):
+        import rethinkdb as r
+        conn = self._makeConnection()
+        conn.close()
+        self.assertRaises(r.ReqlDriverError, self._makeOne().run,
+                          'invalidate', self._query(), conn)
+
+    def test_invalid_options(self):
+        self.assertRaises(ValueError, self._makeOne, durability='fast')
+        self.assertRaises(ValueError, self._makeOne, noreply=['reads'])
+
+
+class Test_parse_settings_write_policy(unittest.TestCase):
+    def test_noreply_list(self):
+        from ..util import _parse_settings
+        options = _parse_settings({
+            'rethink.sessions.secret': 'secret',
+            'rethink.sessions.noreply': 'touch, invalidate',
+        })
+        self.assertEqual(options['noreply'], ['touch', 'invalidate'])
+
+    def test_cookie_options(self):
+        from ..util import _parse_settings
+        options = _parse_settings({
+            'rethink.sessions.secret': 'secret',
+            'rethink.sessions.old_secrets': 'older\n oldest',
+            'rethink.sessions.cookie_storage_threshold': '1000',
+            'rethink.sessions.cookie_compress': 'true',
+            'rethink.sessions.cookie_legacy': 'false',
+        })
+        self.assertEqual(options['old_secrets'], ['older', 'oldest'])
+        self.assertEqual(options['cookie_storage_threshold'], 1000)
+        self.assertIs(options['cookie_compress'], True)
+        self.assertIs(options['cookie_legacy'], False)
+
+
+class Test_live_session(unittest.TestCase):
+    def _run(self, conn, session_id='sid'):
+        from ..util import live_session
+        return live_session(session_id).run(conn)
+
+    def _makeConnection(self, **document):
+        from . import DummyConnection
+        conn = DummyConnection(now=lambda: 1000.0)
+        if document:
+            document['id'] = 'sid'
+            conn.table()['sid'] = document
+        return conn
+
+    def test_live(self):
+        conn = self._makeConnection(expires_at=1001.0)
+        self.assertEqual(self._run(conn)['id'], 'sid')
+
+    def test_expired(self):
+        conn = self._makeConnection(expires_at=1000.0)
+        self.assertIs(self._run(conn), None)
+
+    def test_missing(self):
+        self.assertIs(self._run(self._makeConnection()), None)
+
+    def test_legacy_row_without_expiry(self):
+        conn = self._makeConnection(expired=1200)
+        self.assertEqual(self._run(conn)['id'], 'sid')
@@ -0,0 +1,200 @@
+"""
+ # Copyright (c) 2017 Boolein Integer Indonesia, PT.
+ # suryakencana 1/8/17 @author nanang.suryadi@boolein.id
+ #
+ # You are hereby granted a non-exclusive, worldwide, royalty-free license to
+ # use, copy, modify, and distribute this software in source code or binary
+ # form for use in connection with the web services and APIs provided by
+ # Boolein.
+ #
+ # As with any software that integrates with the Boolein platform, your use
+ # of this software is subject to the Boolein Developer Principles and
+ # Policies [http://developers.Boolein.com/policy/]. This copyright notice
+ # shall be included in all copies or substantial portions of the software.
+ #
+ # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ # IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ # FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+ # THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+ # DEALINGS IN THE SOFTWARE
+ #
+ # tracking
+"""
+# Containers that report their own mutations, used for session values when
+# ``track_mutations`` is enabled so that code changing a stored list or dict
+# in place does not have to call ``session.changed()``.
+
+_missing = object()
+
+
+def _same(a, b):
+    if a is b:
+        return True
+    try:
+        return type(a) is type(b) and bool(a == b)
+    except Exception:
+        return False
+
+
+def track(value, on_change):
+    """
+    Return ``value`` wrapped in a tracked container calling ``on_change()``
+    whenever it is modified, nested dicts and lists included. Other values
+    are returned unchanged.
+    """
+    if isinstance(value, (TrackedDict, TrackedList)):
+        if value._on_change == on_change:
+            return value
+        value = untrack(value)
+    if isinstance(value, dict):
+        return TrackedDict(value, on_change)
+    if isinstance(value, list):
+        return TrackedList(value, on_change)
+    return value
+
+
+def untrack(value):
+    """
+    Return a copy of ``value`` with tracked containers replaced by plain
+    ``dict`` and ``list`` objects, recursively.
+    """
+    if isinstance(value, TrackedDict):
+        return dict((k, untrack(v)) for k, v in dict.items(value))
+    if isinstance(value, TrackedList):
+        return [untrack(v) for v in list.__iter__(value)]
+    return value
+
+
+class TrackedDict(dict):
+    """
+    A ``dict`` calling ``on_change()`` when its contents change. It pickles
+    and copies as a plain ``dict``.
+    """
+    def __init__(self, value, on_change):
+        self._on_change = on_change
+        dict.__init__(self, ((k, track(v, on_change))
+                             for k, v in value.items()))
+
+    def __reduce__(self):
+        return dict, (untrack(self),)
+
+    def __setitem__(self, key, value):
+        if _same(self.get(key, _missing), value):
+            return
+        dict.__setitem__(self, key, track(value, self._on_change))
+        self._on_change()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._on_change()
+
+    def clear(self):
+        if self:
+            dict.clear(self)
+            self._on_change()
+
+    def pop(self, key, default=_missing):
+        if key in self:
+            value = dict.pop(self, key)
+            self._on_change()
+            return value
+        if default is _missing:
+            raise KeyError(key)
+        return default
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self._on_change()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kw):
+        for key, value in dict(*args, **kw).items():
+            self[key] = value
+
+
+class TrackedList(list):
+    """
+    A ``list`` calling ``on_change()`` when its contents change. It pickles
+    and copies as a plain ``list``.
+    """
+    def __init__(self, value, on_change):
+        self._on_change = on_change
+        list.__init__(self, (track(v, on_change) for v in value))
+
+    def __reduce__(self):
+        return list, (untrack(self),)
+
+    def _track(self, values):
+        return [track(v, self._on_change) for v in values]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = self._track(value)
+        elif _same(self[index], value):
+            return
+        else:
+            value = track(value, self._on_change)
+        list.__setitem__(self, index, value)
+        self._on_change()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._on_change()
+
+    # Python 2 routes simple slices through these
+    def __setslice__(self, i, j, values):
+        self[max(0, i):max(0, j)] = values
+
+    def __delslice__(self, i, j):
+        del self[max(0, i):max(0, j)]
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, n):
+        if self and n != 1:
+            list.__imul__(self, n)
+            self._on_change()
+        return self
+
+    def append(self, value):
+        list.append(self, track(value, self._on_change))
+        self._on_change()
+
+    def extend(self, values):
+        values = self._track(values)
+        if values:
+            list.extend(self, values)
+            self._on_change()
+
+    def insert(self, index, value):
+        list.insert(self, index, track(value, self._on_change))
+        self._on_change()
+
+    def pop(self, index=-1):
+        value = list.pop(self, index)
+        self._on_change()
+        return value
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._on_change()
+
+    def reverse(self):
+        if len(self) > 1:
+            list.reverse(self)
+            self._on_change()
+
+    def sort(self, *args, **kw):
+        before = list(self)
+        list.sort(self, *args, **kw)
+        if any(a is not b for a, b in zip(before, self)):
+            self._on_change()
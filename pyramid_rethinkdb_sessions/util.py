@@ -24,16 +24,27 @@
 """
 from functools import partial
 from hashlib import sha256
+import logging
 import os
+import threading
 import time
-from .compat import urlparse
+from .compat import string_types, urlparse
 from pyramid.exceptions import ConfigurationError
-from pyramid.settings import asbool
+from pyramid.settings import asbool, aslist
 
 import rethinkdb as r
 
+LOG = logging.getLogger(__name__)
+
 R_DB = 'rsessions'
 R_TABLE = 'pyramid_sessions'
+# holds the lease electing the worker that reaps, kept out of the sessions
+# table so that it never shows up in its index or changefeed
+R_LEASE_TABLE = 'pyramid_session_leases'
+# secondary indexes the sessions table needs, created by ``provision``
+R_INDEXES = ('expires_at',)
+# generated ids tried before giving up on creating a session
+NEW_SESSION_ATTEMPTS = 5
 
 
 def parse_url(url):
@@ -44,6 +55,10 @@ def parse_url(url):
         user=user,
         password=password,
         ssl=ssl
+
+    A comma separated list of hosts, as in
+    ``rethinkdb://admin@db1:28015,db2:28015/rsessions``, is returned as
+    ``hosts`` (a list of ``(host, port)`` tuples) instead of host and port.
     """
     options = dict()
     parse = urlparse(url)
@@ -51,12 +66,15 @@ def parse_url(url):
     if 'rethinkdb' not in parse.scheme:
         raise Exception('unsupported protocol: ', parse.scheme)
 
-    options['host'] = parse.hostname or 'localhost'
+    netloc = parse.netloc.rpartition('@')[2]
+    if ',' in netloc:
+        options['hosts'] = parse_hosts(netloc)
+    else:
+        options['host'] = parse.hostname or 'localhost'
 
-    if parse.port:
-        options['port'] = parse.port
+        if parse.port:
+            options['port'] = parse.port
 
-    print(parse.path)
     if parse.path and '/' not in parse.path[1:]:
         options['db'] = parse.path[1:]
 
@@ -66,6 +84,25 @@ def parse_url(url):
     return options
 
 
+def parse_hosts(hosts, default_port=28015):
+    """
+    Normalize a list of RethinkDB hosts to ``(host, port)`` tuples. ``hosts``
+    may be a string of ``host[:port]`` entries separated by commas or
+    whitespace, or a list of such strings or of tuples.
+    """
+    if isinstance(hosts, string_types):
+        hosts = hosts.replace(',', ' ').split()
+    parsed = []
+    for host in hosts:
+        if isinstance(host, string_types):
+            name, _, port = host.strip().rpartition(':')
+            if not name:
+                name, port = port, default_port
+            host = (name, int(port))
+        parsed.append(tuple(host))
+    return parsed
+
+
 def _generate_session_id():
     """
     Produces a random 64 character hex-encoded string. The implementation of
@@ -87,57 +124,293 @@ def prefixed_id(prefix='session:'):
     return prefix + session_id
 
 
+def new_session_state(timeout):
+    """
+    The state of a freshly created session, as serialized into the
+    ``payload`` of its document.
+    """
+    return {
+        'managed_dict': {},
+        'created': time.time(),
+        'timeout': timeout,
+    }
+
+
+def expires_at(timeout):
+    """
+    ReQL expression for the epoch time ``timeout`` seconds from now, taken
+    from the server's clock so every application server agrees on it.
+    """
+    return r.now().to_epoch_time() + timeout
+
+
+def if_live(document):
+    """
+    ReQL expression for ``document``, or ``None`` when it has expired. Rows
+    without ``expires_at``, written before expiry times were stored, count
+    as live.
+    """
+    expiry = document['expires_at'].default(None)
+    return r.branch(
+        expiry.eq(None).or_(expiry.gt(r.now().to_epoch_time())),
+        document,
+        None,
+    )
+
+
+def live_session(session_id, table=R_TABLE):
+    """
+    ReQL query returning the document of the session ``session_id``, or
+    ``None`` when it does not exist or has expired, so expired rows waiting
+    to be reaped are never loaded.
+    """
+    return r.table(table).get(session_id).do(if_live)
+
+
+def session_document(session_id, timeout, payload):
+    """
+    Build the RethinkDB document stored for a session from its serialized
+    ``payload``. Every backend writes this same layout, so sync and async
+    sessions can read each other's rows.
+    """
+    return {
+        'id': session_id,
+        'expires_at': expires_at(timeout),
+        'payload': r.binary(payload),
+    }
+
+
+def fields_document(session_id, timeout, created, payloads):
+    """
+    Build the document stored for a session in field storage mode, where
+    each ``managed_dict`` key is serialized on its own into ``payloads`` and
+    stored as a field of ``data``, so that changing one key rewrites only
+    that field.
+    """
+    return {
+        'id': session_id,
+        'expires_at': expires_at(timeout),
+        'created': created,
+        'timeout': timeout,
+        'data': dict((key, r.binary(payload))
+                     for key, payload in payloads.items()),
+    }
+
+
+def state_from_document(document, deserialize):
+    """
+    Return the session state stored in ``document``, whichever layout it was
+    written with.
+    """
+    if 'data' in document:
+        return {
+            'managed_dict': dict((key, deserialize(payload))
+                                 for key, payload in document['data'].items()),
+            'created': document['created'],
+            'timeout': document['timeout'],
+        }
+    return deserialize(document['payload'])
+
+
+def payload_fingerprint(payload):
+    """
+    Digest of a serialized session payload, compared at flush time to skip
+    writing a session whose state did not actually change.
+    """
+    return sha256(payload).digest()
+
+
+def _log_write_error(operation, error):
+    LOG.error('unacknowledged session %s failed: %s', operation, error)
+
+
+class WritePolicy(object):
+    """
+    How session writes are run, by class of write: ``touch`` (expiry
+    refreshes), ``write`` (session data), ``create`` (inserting a new
+    session) and ``invalidate`` (deleting one).
+
+    Parameters:
+
+    ``durability``
+    ``'soft'`` to have RethinkDB acknowledge writes before they reach disk,
+    or ``'hard'``. Default: ``None`` (the table's setting, normally hard).
+
+    ``noreply``
+    The classes of writes that are sent without waiting for RethinkDB to
+    reply. Default: ``()``.
+
+    ``on_error``
+    A callable taking the write class and the exception, called instead of
+    raising when sending a ``noreply`` write fails. RethinkDB does not
+    report failures of ``noreply`` writes that reached the server.
+    Default: logs the error.
+    """
+    OPERATIONS = ('touch', 'write', 'create', 'invalidate')
+
+    def __init__(self, durability=None, noreply=(), on_error=None):
+        if durability not in (None, 'soft', 'hard'):
+            raise ValueError('durability must be soft or hard, not %r'
+                             % durability)
+        unknown = set(noreply) - set(self.OPERATIONS)
+        if unknown:
+            raise ValueError('unknown write classes: %s'
+                             % ', '.join(sorted(unknown)))
+        self.durability = durability
+        self.noreply = frozenset(noreply)
+        self.on_error = on_error or _log_write_error
+
+    def run(self, operation, query, conn, wait=False):
+        """
+        Run the write ``query`` of class ``operation``, returning its result,
+        or ``None`` when it was sent without waiting for a reply. ``wait``
+        forces waiting, for callers that need the result.
+        """
+        options = {}
+        if self.durability is not None:
+            options['durability'] = self.durability
+        if wait or operation not in self.noreply:
+            return query.run(conn, **options)
+        try:
+            query.run(conn, noreply=True, **options)
+        except Exception as e:
+            self.on_error(operation, e)
+        return None
+
+
+DEFAULT_WRITE_POLICY = WritePolicy()
+
+
 def _insert_session_id_if_unique(
         conn,
         timeout,
         session_id,
-        serialize,):
+        serialize,
+        state=None,
+        make_document=None,
+        write_policy=DEFAULT_WRITE_POLICY,
+        table=R_TABLE,):
     """ Attempt to insert a given ``session_id`` and return the successful id
-    or ``None``."""
-
-    try:
-        value = r.table(R_TABLE).get(session_id).run(conn)
-        if value is not None:
+    or ``None`` if it is taken. The session starts out empty unless ``state``
+    is given, or ``make_document(session_id)`` builds the whole document.
+
+    This is a single ``insert`` that fails on conflict, so there is no window
+    between checking the id and claiming it. Errors other than a duplicate
+    id, including connection errors, are raised. When ``write_policy``
+    sends creates without waiting for a reply the id is assumed to be free,
+    which is safe with the default 160 bit random ids."""
+    if make_document is not None:
+        session_dict = make_document(session_id)
+    else:
+        session_dict = session_document(
+            session_id, timeout,
+            serialize(state or new_session_state(timeout)))
+    results = write_policy.run(
+        'create', r.table(table).insert(session_dict, conflict='error'),
+        conn)
+
+    if results is not None and results['errors'] > 0:
+        if 'Duplicate primary key' in results.get('first_error', ''):
             return None
+        raise r.ReqlOpFailedError(results['first_error'])
 
-        session_dict = {
-            'id': session_id,
-            'expired': timeout,
-            'payload': r.binary(
-                serialize({
-                    'managed_dict':  {},
-                    'created': time.time(),
-                    'timeout': timeout
-                })),
-        }
-        results = r.table(R_TABLE).insert(session_dict).run(conn)
-
-        if results['errors'] > 0:
-            raise KeyError(u'Session ID (%s) conflicts with an existing session' % session_id)
-
-        return session_id
-    except Exception:
-        return None
+    return session_id
 
 
 def get_unique_session_id(
         conn,
         timeout,
         serialize,
-        generator=_generate_session_id,):
+        generator=_generate_session_id,
+        state=None,
+        attempts=NEW_SESSION_ATTEMPTS,
+        make_document=None,
+        write_policy=DEFAULT_WRITE_POLICY,
+        table=R_TABLE,):
     """
-    Returns a unique session id after inserting it successfully in RethinkDB.
+    Returns a unique session id after inserting it successfully in RethinkDB
+    ``table``, along with ``state`` when given, or the document built by
+    ``make_document(session_id)``. Gives up with a ``KeyError`` when
+    ``attempts`` generated ids in a row are already taken.
     """
-    while 1:
+    for _ in range(attempts):
         session_id = generator()
         attempt = _insert_session_id_if_unique(
             conn,
             timeout,
             session_id,
             serialize,
+            state,
+            make_document,
+            write_policy,
+            table,
         )
         if attempt is not None:
             return attempt
+    raise KeyError(u'Could not insert a unique session id after %s attempts'
+                   % attempts)
+
+
+def get_or_create_session(
+        conn,
+        session_id,
+        timeout,
+        serialize,
+        generator=_generate_session_id,
+        attempts=NEW_SESSION_ATTEMPTS,
+        write_policy=DEFAULT_WRITE_POLICY,
+        table=R_TABLE,
+        lookup=live_session,):
+    """
+    Returns the document of the session ``session_id``, or inserts a new
+    empty session under a generated id and returns its document when
+    ``session_id`` is ``None`` or not found. Looking the session up and
+    creating it is a single composed query. The session is looked up with
+    the query built by ``lookup(session_id)`` and created in ``table``.
+
+    The id given is never reused for a new session, so a caller can tell a
+    new session from the returned document's ``id``.
+    """
+    table = r.table(table)
+    for _ in range(attempts):
+        document = session_document(
+            generator(), timeout, serialize(new_session_state(timeout)))
+        created = table.insert(
+            document, conflict='error', return_changes=True,
+        )['changes'][0]['new_val'].default(None)
+        if session_id is None:
+            query = created
+        else:
+            query = lookup(session_id).do(
+                lambda persisted: r.branch(persisted.eq(None), created,
+                                           persisted))
+        persisted = write_policy.run('create', query, conn, wait=True)
+        if persisted is not None:
+            return persisted
+    raise KeyError(u'Could not insert a unique session id after %s attempts'
+                   % attempts)
+
+
+class Counters(object):
+    """
+    A small thread-safe collection of named counters, used to expose metrics
+    such as pool checkouts or wait times without pulling in a metrics library.
+    """
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._values = dict((name, 0) for name in names)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def __getitem__(self, name):
+        return self._values.get(name, 0)
+
+    def snapshot(self):
+        """Return a point-in-time copy of all counters as a dict."""
+        with self._lock:
+            return dict(self._values)
 
 
 def _parse_settings(settings):
@@ -159,18 +432,39 @@ def _parse_settings(settings):
         raise ConfigurationError('rethink.sessions.secret is a required setting')
 
     # coerce bools
-    for b in ('cookie_secure', 'cookie_httponly', 'cookie_on_exception'):
+    for b in ('cookie_secure', 'cookie_httponly', 'cookie_on_exception',
+              'defer_create', 'track_mutations', 'field_storage', 'reaper',
+              'cache_invalidation', 'cookie_compress', 'cookie_legacy',
+              'pool_prewarm_after_fork'):
         if b in options:
             options[b] = asbool(options[b])
 
     # coerce ints
-    for i in ('timeout', 'port', 'db', 'cookie_max_age'):
+    for i in ('timeout', 'port', 'cookie_max_age', 'pool_size',
+              'pool_prewarm', 'host_failure_threshold', 'reaper_batch_size',
+              'reaper_max_batches', 'bucket_interval', 'cache_max_entries',
+              'cache_max_bytes', 'cache_shared_slots',
+              'cache_shared_slot_size', 'cookie_storage_threshold',
+              'cookie_verify_cache_size'):
         if i in options:
             options[i] = int(options[i])
 
-    # coerce float
-    if 'socket_timeout' in options:
-        options['socket_timeout'] = float(options['socket_timeout'])
+    # coerce floats
+    for f in ('socket_timeout', 'pool_wait_timeout', 'pool_max_lifetime',
+              'pool_idle_check', 'host_backoff', 'host_max_backoff',
+              'refresh_fraction', 'reaper_interval', 'reaper_lease_ttl',
+              'reaper_max_rate', 'cache_ttl', 'cache_fallback_ttl'):
+        if f in options:
+            options[f] = float(options[f])
+
+    if 'hosts' in options:
+        options['hosts'] = parse_hosts(options['hosts'])
+
+    if 'old_secrets' in options:
+        options['old_secrets'] = aslist(options['old_secrets'])
+
+    if 'noreply' in options:
+        options['noreply'] = aslist(options['noreply'].replace(',', ' '))
 
     # check for settings conflict
     if 'prefix' in options and 'id_generator' in options:
@@ -185,27 +479,14 @@ def _parse_settings(settings):
     return options
 
 
-"""
-    @classmethod
-  def clear_expired(cls):
-
-      # A method to remove all expired sessions
-
-    rethinkdb_handler  = cls.__establish_rethinkdb()
-    reference_time = time.mktime(timezone.now().timetuple())
-
-    delete_request = rethinkdb.table(SESSION_RETHINK_TABLE).filter(rethinkdb.row["expire"] < reference_time).delete()
-    delete_result  = delete_request.run(rethinkdb_handler)
-"""
-
-
 def refresh(wrapped):
     """
-    Decorator to reset the expire time for this session's key in RethinkDB.
+    Decorator extending the session's expiry time in RethinkDB on reads,
+    throttled by ``session.refresh()``.
     """
     def wrapped_refresh(session, *arg, **kw):
         result = wrapped(session, *arg, **kw)
-        # session.expire(session.session_id, session.timeout)
+        session.refresh()
         return result
 
     return wrapped_refresh
@@ -213,11 +494,13 @@ def refresh(wrapped):
 
 def persist(wrapped):
     """
-    Decorator to reset the expire time for this session's key in RethinkDB.
+    Decorator marking the session as modified. Changes are collected and
+    written to RethinkDB once, when the session is flushed at the end of the
+    request.
     """
-    def wrapped_refresh(session, *arg, **kw):
+    def wrapped_persist(session, *arg, **kw):
         result = wrapped(session, *arg, **kw)
-        session.expire(session.session_id, session.timeout)
+        session.changed()
         return result
 
-    return wrapped_refresh
+    return wrapped_persist
@@ -52,7 +52,14 @@ def main():
         zip_safe=False,
         tests_require=testing_requires,
         install_requires=install_requires,
-        entry_points='',
+        entry_points={
+            'console_scripts': [
+                'rethinkdb_sessions_provision = '
+                'pyramid_rethinkdb_sessions.scripts:provision_main',
+                'rethinkdb_sessions_reap = '
+                'pyramid_rethinkdb_sessions.scripts:reap_main',
+            ],
+        },
         extras_require={
             'testing': testing_extras,
             'docs': docs_extras,